@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+# 	vim:fileencoding=utf-8:noet
+# (c) 2026 Michał Górny <mgorny@gentoo.org>
+# Released under the terms of the 2-clause BSD license.
+
+"""Measure the memory footprint of VCS job objects.
+
+Creates a number of GitR3Support instances from a fake package
+environment and reports the memory allocated per instance.
+
+Usage: python benchmarks/jobmem.py [count]
+"""
+
+import os.path, sys, tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+
+class FakeEnviron(object):
+    def __init__(self, i):
+        self._env = {
+            "EGIT_REPO_URI": "https://example.com/repo%d.git" % i,
+            "EGIT_VERSION": "%040x" % i,
+        }
+
+    def copy(self, *keys):
+        return dict((k, self._env.get(k, "")) for k in keys)
+
+
+class FakeOptions(object):
+    jobs = 1
+    timeout = 0
+
+
+def measure(count):
+    from smartliverebuild.vcs.git_r3 import GitR3Support
+
+    opts = FakeOptions()
+    cache = {}
+    envs = [FakeEnviron(i) for i in range(count)]
+
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    jobs = [
+        GitR3Support("dev-libs/foo%d:0" % i, environ=envs[i], opts=opts, cache=cache)
+        for i in range(count)
+    ]
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    assert len(jobs) == count
+    return (after - before) / count
+
+
+def main(argv):
+    count = int(argv[1]) if len(argv) > 1 else 10000
+    print("%d jobs: %.1f bytes per job" % (count, measure(count)))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,450 @@
+#!/usr/bin/env python
+# 	vim:fileencoding=utf-8:noet
+# (c) 2026 Michał Górny <mgorny@gentoo.org>
+# Released under the terms of the 2-clause BSD license.
+
+"""Measure how a run scales with the size of the installed package
+database.
+
+Generates a synthetic /var/db/pkg tree with the requested number
+of packages, share of live packages, VCS eclass mix and environment
+file size, and runs the checks against it with the update commands
+stubbed out (every repository reports the installed revision without
+spawning any process). The installed packages are read directly from
+the tree, by a minimal package manager providing the subset
+of the gentoopm API used by smart-live-rebuild.
+
+The run is performed in a separate process, and the total run time,
+the time spent enumerating the packages and reading their
+environment, the peak RSS and the per-package overheads are reported.
+The results are appended to a history file, along with the git
+revision, and compared to the previous result for the same parameters.
+If any of the totals has grown by more than --threshold percent (and
+more than the measurement noise), the exit status is 1.
+
+Usage: python benchmarks/vdbscale.py [options]
+"""
+
+import bz2, json, optparse, os, os.path, random, resource, shutil
+import subprocess, sys, tempfile, time
+
+topdir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, topdir)
+
+# the metrics compared to the previous results (lower is better), along
+# with the absolute changes considered noise (seconds or bytes); since
+# the number of packages is a part of the parameters, the per-package
+# values change in the same proportion
+metrics = {"time": 0.05, "enumerate": 0.02, "environ": 0.02, "rss": 1048576}
+
+# the environment variables of the VCS eclasses, with their values
+vcs_env = {
+    "git-r3": lambda rng, pn: {
+        "EGIT_REPO_URI": "https://git.example.com/%s.git" % pn,
+        "EGIT_VERSION": "%040x" % rng.getrandbits(160),
+    },
+    "mercurial": lambda rng, pn: {
+        "EHG_REPO_URI": "https://hg.example.com/%s" % pn,
+        "EHG_REVISION": "default",
+        "HG_REV_ID": "%012x" % rng.getrandbits(48),
+    },
+    "subversion": lambda rng, pn: {
+        "ESVN_REPO_URI": "https://svn.example.com/%s/trunk" % pn,
+        "ESVN_STORE_DIR": "/var/cache/distfiles/svn-src",
+        "ESVN_WC_REVISION": str(rng.randrange(1, 100000)),
+    },
+}
+
+# the non-VCS eclasses inherited by the packages
+common_eclasses = ["flag-o-matic", "multilib", "toolchain-funcs", "cmake", "meson"]
+
+
+def parse_mix(v):
+    """Parse the eclass mix (comma-separated ECLASS=WEIGHT pairs)."""
+    ret = []
+    for x in v.split(","):
+        k, w = x.split("=", 1)
+        if k not in vcs_env:
+            raise ValueError("Unsupported eclass: %s" % k)
+        ret.append((k, float(w)))
+    return ret
+
+
+def environment(rng, env, size):
+    """Generate the saved environment declaring the variables `env',
+    padded with random variables and functions to about `size' bytes."""
+    decls = dict((k, 'declare -x %s="%s"' % (k, v)) for k, v in env.items())
+    total = sum(len(v) for v in decls.values())
+    while total < size // 2:
+        name = "".join(rng.choice("ABCDEFGHIJKLMNOPQRSTUVWXYZ_") for i in range(10))
+        decls[name] = 'declare -- %s="%s"' % (name, "x" * rng.randrange(10, 200))
+        total += len(decls[name])
+    lines = [decls[k] for k in sorted(decls)]
+    i = 0
+    while total < size:
+        body = "\n".join(
+            "    einfo %s" % ("y" * rng.randrange(10, 80)) for j in range(20)
+        )
+        lines.append("func_%d () \n{ \n%s\n}" % (i, body))
+        total += len(lines[-1])
+        i += 1
+    return "\n".join(lines) + "\n"
+
+
+def generate(root, packages, live, mix, env_size, seed):
+    """Generate the synthetic package database in `root'."""
+    rng = random.Random(seed)
+    vdb = os.path.join(root, "var/db/pkg")
+    ncats = max(packages // 100, 1)
+    weights = [w for k, w in mix]
+    for i in range(packages):
+        cat = "cat-%03d" % (i % ncats)
+        pn = "pkg%d" % i
+        inherits = rng.sample(common_eclasses, rng.randrange(len(common_eclasses)))
+        if rng.random() < live:
+            eclass = rng.choices([k for k, w in mix], weights)[0]
+            inherits.append(eclass)
+            env = vcs_env[eclass](rng, pn)
+            pv = "9999"
+        else:
+            env = {}
+            pv = "1.%d" % rng.randrange(100)
+
+        d = os.path.join(vdb, cat, "%s-%s" % (pn, pv))
+        os.makedirs(d)
+        for fn, v in (
+            ("CATEGORY", cat),
+            ("PF", "%s-%s" % (pn, pv)),
+            ("SLOT", "0"),
+            ("EAPI", "8"),
+            ("INHERITED", " ".join(sorted(inherits))),
+        ):
+            with open(os.path.join(d, fn), "w") as f:
+                f.write(v + "\n")
+        with bz2.open(os.path.join(d, "environment.bz2"), "wt", compresslevel=1) as f:
+            f.write(environment(rng, env, env_size))
+
+
+class VdbEnviron(object):
+    """The environment accessor of VdbPackage."""
+
+    def __init__(self, path):
+        self._path = path
+
+    def copy(self, *keys):
+        from smartliverebuild.environ import parse_environ
+
+        with bz2.open(os.path.join(self._path, "environment.bz2"), "rt") as f:
+            env = parse_environ(f, keys)
+        return dict((k, env.get(k, "")) for k in keys)
+
+
+class VdbPackage(object):
+    """An installed package, reading the metadata lazily like
+    the package managers do."""
+
+    def __init__(self, path, key):
+        self.path = path
+        self.key = key
+
+    def _read(self, fn):
+        with open(os.path.join(self.path, fn)) as f:
+            return f.read().strip()
+
+    @property
+    def inherits(self):
+        return frozenset(self._read("INHERITED").split())
+
+    @property
+    def slotted_atom(self):
+        return "%s:%s" % (self.key, self._read("SLOT"))
+
+    @property
+    def environ(self):
+        return VdbEnviron(self.path)
+
+    def __str__(self):
+        return "%s/%s" % (self.key.split("/")[0], os.path.basename(self.path))
+
+
+class VdbInstalled(object):
+    def __init__(self, vdb):
+        self._vdb = vdb
+
+    def filter(self, key):
+        from smartliverebuild.core import pf_re
+
+        cat, pn = key.split("/")
+        d = os.path.join(self._vdb, cat)
+        for pf in sorted(os.listdir(d)):
+            m = pf_re.match(pf)
+            if m is not None and m.group(1) == pn:
+                yield VdbPackage(os.path.join(d, pf), key)
+
+
+class AnyStack(object):
+    def __contains__(self, atom):
+        return True
+
+
+class VdbConfig(object):
+    userpriv_enabled = False
+    userpriv_uid = None
+    userpriv_gid = None
+
+
+class VdbPM(object):
+    """A minimal package manager for the synthetic database."""
+
+    config = VdbConfig()
+    stack = AnyStack()
+
+    def __init__(self, root):
+        self.root = root
+        self.installed = VdbInstalled(os.path.join(root, "var/db/pkg"))
+
+    def Atom(self, s):
+        return s
+
+
+def maxrss():
+    """The peak RSS of the process, in bytes."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def measure(root):
+    """Run the checks against the database in `root', and return
+    the metrics."""
+    from smartliverebuild.config import Config
+    from smartliverebuild.core import LiveRebuildRun
+    from smartliverebuild.profiling import timers
+    from smartliverebuild.vcs import BaseVCSSupport
+
+    def stub_check(self, blocking=False):
+        return self._setrev(self.savedrev)
+
+    BaseVCSSupport.__call__ = stub_check
+
+    pm = VdbPM(root)
+    statedir = tempfile.mkdtemp(prefix="slr-bench-")
+    try:
+        c = Config(pm.config)
+        c.apply_dict(
+            dict(
+                config_file="",
+                pretend=True,
+                setuid=False,
+                state_dir=statedir,
+                unprivileged_user=True,
+            )
+        )
+        c.parse_configfiles()
+        opts = c.get_options()
+
+        base_rss = maxrss()
+        start = time.perf_counter()
+        run = LiveRebuildRun(opts, [pm], output=False)
+        results = list(run)
+        duration = time.perf_counter() - start
+    finally:
+        shutil.rmtree(statedir)
+
+    packages = sum(
+        len(os.listdir(os.path.join(root, "var/db/pkg", cat)))
+        for cat in os.listdir(os.path.join(root, "var/db/pkg"))
+    )
+    rss = maxrss()
+    return {
+        "packages": packages,
+        "live": len(results),
+        "errors": sum(1 for r in results if r.error is not None),
+        "time": duration,
+        # the vdb walk plus the VCS initialization (timed separately),
+        # comparable with the earlier results
+        "enumerate": timers.totals.get("enumerate", 0)
+        + timers.totals.get("vcs_init", 0),
+        "environ": timers.totals.get("environ", 0),
+        "rss": rss,
+        "time_per_package": duration / packages,
+        "rss_per_package": (rss - base_rss) / packages,
+    }
+
+
+def git_revision():
+    try:
+        return (
+            subprocess.check_output(
+                ["git", "-C", topdir, "describe", "--always", "--dirty"],
+                stderr=subprocess.DEVNULL,
+            )
+            .decode()
+            .strip()
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(history, entry, threshold):
+    """Compare `entry' to the last entry with the same parameters
+    in `history'. Returns the list of regressed metrics."""
+    prev = None
+    for e in history:
+        if e["params"] == entry["params"]:
+            prev = e
+    if prev is None:
+        print("No previous results for these parameters.")
+        return []
+
+    print("Compared to %s (%s):" % (prev["revision"], prev["date"]))
+    ret = []
+    for k, noise in metrics.items():
+        old, new = prev["results"][k], entry["results"][k]
+        change = (new - old) / old * 100 if old else 0
+        mark = ""
+        if change > threshold and new - old > noise:
+            mark = " (regression)"
+            ret.append(k)
+        print("  %-18s %+7.1f%%%s" % (k, change, mark))
+    return ret
+
+
+def main(argv):
+    opt = optparse.OptionParser(usage="%prog [options]")
+    opt.add_option(
+        "--packages",
+        type="int",
+        default=10000,
+        help="The number of installed packages (default: 10000).",
+    )
+    opt.add_option(
+        "--live",
+        type="float",
+        default=0.1,
+        help="The share of live packages (default: 0.1).",
+    )
+    opt.add_option(
+        "--eclasses",
+        default="git-r3=8,subversion=1,mercurial=1",
+        help="The VCS eclass mix of the live packages, as comma-separated ECLASS=WEIGHT pairs (default: git-r3=8,subversion=1,mercurial=1).",
+    )
+    opt.add_option(
+        "--env-size",
+        type="int",
+        default=32,
+        help="The size of the saved environments, in KiB (default: 32).",
+    )
+    opt.add_option(
+        "--runs",
+        type="int",
+        default=3,
+        help="The number of runs to take the best result of (default: 3).",
+    )
+    opt.add_option(
+        "--seed",
+        type="int",
+        default=0,
+        help="The random seed for the generator (default: 0).",
+    )
+    opt.add_option(
+        "--vdb",
+        help="Generate the tree in (or reuse the one in) the specified directory, instead of a temporary one.",
+    )
+    opt.add_option(
+        "--history",
+        default=os.path.join(os.path.dirname(__file__), "vdbscale.jsonl"),
+        help="The file to append the results to (default: benchmarks/vdbscale.jsonl).",
+    )
+    opt.add_option(
+        "--no-record",
+        action="store_false",
+        dest="record",
+        default=True,
+        help="Do not append the results to the history file.",
+    )
+    opt.add_option(
+        "--threshold",
+        type="float",
+        default=10,
+        help="Report the metrics grown by more than the specified percentage as regressions (default: 10).",
+    )
+    opt.add_option("--measure", help=optparse.SUPPRESS_HELP)
+    opts, args = opt.parse_args(argv[1:])
+
+    if opts.measure:
+        json.dump(measure(opts.measure), sys.stdout)
+        return 0
+
+    params = {
+        "packages": opts.packages,
+        "live": opts.live,
+        "eclasses": opts.eclasses,
+        "env_size": opts.env_size,
+        "seed": opts.seed,
+    }
+    root = opts.vdb or tempfile.mkdtemp(prefix="slr-vdb-")
+    try:
+        if not os.path.isdir(os.path.join(root, "var/db/pkg")):
+            print("Generating %d packages in %s ..." % (opts.packages, root))
+            generate(
+                root,
+                opts.packages,
+                opts.live,
+                parse_mix(opts.eclasses),
+                opts.env_size * 1024,
+                opts.seed,
+            )
+
+        # run in a fresh process, for a meaningful peak RSS, and take
+        # the best result to reduce the noise
+        runs = [
+            json.loads(
+                subprocess.check_output(
+                    [sys.executable, os.path.abspath(__file__), "--measure", root]
+                )
+            )
+            for i in range(opts.runs)
+        ]
+        res = dict(runs[0])
+        for k in metrics:
+            res[k] = min(r[k] for r in runs)
+        res["time_per_package"] = res["time"] / res["packages"]
+        res["rss_per_package"] = min(r["rss_per_package"] for r in runs)
+    finally:
+        if not opts.vdb:
+            shutil.rmtree(root)
+
+    print(
+        "%d packages (%d live, %d errors):"
+        % (res["packages"], res["live"], res["errors"])
+    )
+    print("  run time:     %8.3f s" % res["time"])
+    print("  enumeration:  %8.3f s" % res["enumerate"])
+    print("  environment:  %8.3f s" % res["environ"])
+    print("  peak RSS:     %8.1f MiB" % (res["rss"] / 1048576))
+    print(
+        "  per package:  %8.1f us, %.0f bytes"
+        % (res["time_per_package"] * 1e6, res["rss_per_package"])
+    )
+
+    entry = {
+        "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "revision": git_revision(),
+        "params": params,
+        "results": res,
+    }
+    history = []
+    try:
+        with open(opts.history) as f:
+            history = [json.loads(l) for l in f if l.strip()]
+    except IOError:
+        pass
+    regressions = compare(history, entry, opts.threshold)
+
+    if opts.record:
+        with open(opts.history, "a") as f:
+            f.write(json.dumps(entry) + "\n")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
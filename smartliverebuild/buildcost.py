@@ -0,0 +1,197 @@
+# 	vim:fileencoding=utf-8:noet
+# (c) 2026 Michał Górny <mgorny@gentoo.org>
+# Released under the terms of the 2-clause BSD license.
+
+"""Ordering the rebuild list by the historical build durations.
+
+>>> order_packages(['a/x:0', 'a/y:0', 'a/z:0'],
+...     {'a/x:0': 10, 'a/y:0': 300, 'a/z:0': 20},
+...     {'a/y:0': set(['a/x:0'])})
+['a/x:0', 'a/y:0', 'a/z:0']
+>>> order_packages(['a/x:0', 'a/y:0', 'a/z:0'],
+...     {'a/x:0': 10, 'a/y:0': 300, 'a/z:0': 20}, {})
+['a/y:0', 'a/z:0', 'a/x:0']
+>>> format_duration(3725)
+'1h 02m'
+"""
+
+import os, re
+
+from .output import out
+from .state import StateFile, state_path
+
+emerge_start_re = re.compile(r"^(\d+):\s+>>> emerge \(\d+ of \d+\) (\S+) to ")
+emerge_end_re = re.compile(r"^(\d+):\s+::: completed emerge \(\d+ of \d+\) (\S+) to ")
+cpv_re = re.compile(r"^(.+?)-\d[^-/]*(?:-r\d+)?$")
+
+# the number of most recent builds used to estimate the duration
+history_length = 5
+
+
+class EmergeLogIndex(object):
+    """The merge durations found in emerge.log, per package key.
+
+    The results are kept in a state file, along with the position
+    in emerge.log, so that only the entries added since the previous
+    run need to be parsed.
+    """
+
+    def __init__(self, logpath, statepath):
+        self._logpath = logpath
+        self._state = StateFile(statepath)
+        self._state.setdefault("durations", {})
+        self._state.setdefault("started", {})
+
+    def update(self):
+        """Parse the new emerge.log entries and save the index."""
+        try:
+            st = os.stat(self._logpath)
+        except OSError:
+            return
+        offset = self._state.get("offset", 0)
+        if self._state.get("inode") != st.st_ino or st.st_size < offset:
+            # log rotated or truncated
+            offset = 0
+            self._state["started"] = {}
+
+        durations = self._state["durations"]
+        started = self._state["started"]
+        with open(self._logpath, "rb") as f:
+            f.seek(offset)
+            for l in f:
+                if not l.endswith(b"\n"):
+                    break
+                offset += len(l)
+                l = l.decode("UTF-8", "replace")
+                m = emerge_start_re.match(l)
+                if m is not None:
+                    started[m.group(2)] = int(m.group(1))
+                    continue
+                m = emerge_end_re.match(l)
+                if m is not None and m.group(2) in started:
+                    key = cpv_re.match(m.group(2))
+                    if key is not None:
+                        d = durations.setdefault(key.group(1), [])
+                        d.append(int(m.group(1)) - started.pop(m.group(2)))
+                        del d[:-history_length]
+
+        self._state["offset"] = offset
+        self._state["inode"] = st.st_ino
+        self._state.save()
+
+    def estimate(self, key):
+        """Estimate the build duration of package `key' (in seconds).
+        Returns None if the package was never built."""
+        d = self._state["durations"].get(key)
+        if not d:
+            return None
+        return sum(d) / len(d)
+
+
+def order_packages(packages, costs, deps):
+    """Order `packages' so that the packages with the longest chain
+    of builds depending on them come first, while keeping every package
+    after its dependencies. `costs' maps packages to the build
+    durations, `deps' maps packages to the sets of their dependencies
+    (within `packages')."""
+
+    rdeps = dict((p, set()) for p in packages)
+    for p, pdeps in deps.items():
+        for d in pdeps:
+            rdeps[d].add(p)
+
+    # the duration of the longest chain starting with the package
+    chain = {}
+
+    def get_chain(p, seen=()):
+        if p not in chain:
+            seen += (p,)
+            chain[p] = costs[p] + max(
+                [get_chain(r, seen) for r in rdeps[p] if r not in seen] or [0]
+            )
+        return chain[p]
+
+    remaining = dict((p, set(deps.get(p, ()))) for p in packages)
+    ret = []
+    while remaining:
+        ready = [p for p in packages if p in remaining and not remaining[p]]
+        if not ready:  # circular dependencies
+            ready = [p for p in packages if p in remaining]
+        p = max(ready, key=get_chain)
+        ret.append(p)
+        del remaining[p]
+        for r in remaining.values():
+            r.discard(p)
+    return ret
+
+
+def get_dependencies(pm, packages):
+    """Find the build and runtime dependencies between the installed
+    `packages' (slotted atoms)."""
+
+    keys = {}
+    for p in packages:
+        keys.setdefault(pm.Atom(p).key, []).append(p)
+
+    def atoms(dep):
+        for d in dep:
+            if hasattr(d, "key"):
+                yield d
+            else:
+                for a in atoms(d):
+                    yield a
+
+    deps = {}
+    for p in packages:
+        deps[p] = set()
+        for pkg in pm.installed.filter(pm.Atom(p)):
+            for depset in (pkg.build_dependencies, pkg.run_dependencies):
+                for a in atoms(depset.without_conditionals):
+                    if not getattr(a, "blocking", False):
+                        deps[p].update(d for d in keys.get(a.key, ()) if d != p)
+    return deps
+
+
+def format_duration(secs):
+    secs = int(secs)
+    if secs >= 3600:
+        return "%dh %02dm" % (secs // 3600, secs % 3600 // 60)
+    return "%dm %02ds" % (secs // 60, secs % 60)
+
+
+def order_by_cost(opts, pm, packages):
+    """Order the rebuild list by the historical build durations,
+    and report the estimated total build time."""
+
+    index = EmergeLogIndex(opts.emerge_log, state_path(opts, "emerge-log.json"))
+    index.update()
+
+    costs = {}
+    unknown = 0
+    for p in packages:
+        costs[p] = index.estimate(str(pm.Atom(p).key))
+        if costs[p] is None:
+            unknown += 1
+    known = [c for c in costs.values() if c is not None]
+    default = sorted(known)[len(known) // 2] if known else 0
+    for p in packages:
+        if costs[p] is None:
+            costs[p] = default
+
+    try:
+        deps = get_dependencies(pm, packages)
+    except Exception as e:
+        out.err("Unable to get package dependencies: %s" % e)
+        deps = {}
+
+    packages = order_packages(packages, costs, deps)
+
+    msg = "Estimated total build time: %s%s%s" % (
+        out.white,
+        format_duration(sum(costs.values())),
+        out.s1reset,
+    )
+    if unknown:
+        msg += " (%d packages with no build history)" % unknown
+    out.result(msg)
+    return packages
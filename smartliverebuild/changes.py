@@ -0,0 +1,84 @@
+# 	vim:fileencoding=utf-8:noet
+# (c) 2026 Michał Górny <mgorny@gentoo.org>
+# Released under the terms of the 2-clause BSD license.
+
+"""Adaptive check frequency.
+
+The revisions found by the checks are recorded per repository, along
+with the number of changes observed and the time span of the history.
+From these, the change rate of the repository is estimated (starting
+with a prior of one change per `prior' seconds), and the probability
+that it has changed since the last check is computed assuming
+the changes happen at random (a Poisson process).
+
+>>> log = ChangeLog('/nonexistent/changes.json')
+>>> log.probability('git://example.com/foo [HEAD]', now=0)
+1.0
+>>> log.observed('git://example.com/foo [HEAD]', 'aaa', now=0)
+>>> for t in range(1, 31):
+...     log.observed('git://example.com/foo [HEAD]', 'aaa', now=t * 86400)
+>>> log['git://example.com/foo [HEAD]']['changes']
+0
+>>> round(log.probability('git://example.com/foo [HEAD]', now=31 * 86400), 3)
+0.032
+>>> log.should_check('git://example.com/foo [HEAD]', 0.1, 0, now=31 * 86400)
+False
+>>> log.should_check('git://example.com/foo [HEAD]', 0.1, 0, now=60 * 86400)
+True
+>>> log.observed('git://example.com/foo [HEAD]', 'bbb', now=31 * 86400)
+>>> log['git://example.com/foo [HEAD]']['changes']
+1
+"""
+
+import math, random, time
+
+from .state import StateFile
+
+
+class ChangeLog(StateFile):
+    """The revision history of the repositories (repo key -> dict
+    of the last 'rev' found, the time of the 'first' and 'last' check
+    and the number of 'changes' observed)."""
+
+    # the prior change interval, used until enough history is collected
+    prior = 86400
+
+    def observed(self, key, rev, now=None):
+        """Record the revision `rev' found by a check."""
+        if now is None:
+            now = time.time()
+        ent = self.get(key)
+        if ent is None:
+            self[key] = {"rev": rev, "first": now, "last": now, "changes": 0}
+        else:
+            if ent["rev"] != rev:
+                ent["changes"] += 1
+                ent["rev"] = rev
+            ent["last"] = now
+        self.modified = True
+
+    def rev(self, key):
+        """The last revision found for the repository, or None."""
+        ent = self.get(key)
+        return ent["rev"] if ent is not None else None
+
+    def rate(self, key):
+        """The estimated number of changes per second."""
+        ent = self[key]
+        return (ent["changes"] + 1) / (ent["last"] - ent["first"] + self.prior)
+
+    def probability(self, key, now=None):
+        """The probability that the repository has changed since
+        the last check."""
+        if key not in self:
+            return 1.0
+        if now is None:
+            now = time.time()
+        elapsed = max(now - self[key]["last"], 0)
+        return 1 - math.exp(-self.rate(key) * elapsed)
+
+    def should_check(self, key, threshold, sample, now=None):
+        """Check whether the repository should be checked: if the change
+        probability reaches `threshold', or otherwise with probability
+        `sample'."""
+        return self.probability(key, now) >= threshold or random.random() < sample
@@ -2,15 +2,18 @@
 # (c) 2011-2023 Michał Górny <mgorny@gentoo.org>
 # Released under the terms of the 2-clause BSD license.
 
-import itertools, os, sys, shlex
+import itertools, os, subprocess, sys, shlex
 from copy import copy
 from optparse import OptionParser, Option, OptionValueError
 
 from gentoopm import get_package_manager
 
-from . import __version__
+from . import __version__, profiling
+from .buildcost import order_by_cost
 from .config import Config, conf_getvcs
-from .core import SmartLiveRebuild, SLRFailure
+from .core import LiveRebuildRun, SLRFailure, root_package_manager
+from .distributed import worker_main
+from .revcache import server_main
 from .output import out
 
 
@@ -58,6 +61,39 @@ def parse_options(argv):
         description="Enumerate all live packages in system, check their repositories for updates and remerge the updated ones.",
         option_class=SLROption,
     )
+    opt.add_option(
+        "--adaptive-checks",
+        action="store_true",
+        dest="adaptive_checks",
+        help="Check only the repositories likely to have changed since the last check (estimated from the changes observed in the past), and a random sample of the others.",
+    )
+    opt.add_option(
+        "--adaptive-timeout",
+        action="store_true",
+        dest="adaptive_timeout",
+        help="Derive the update timeouts from the past update durations of each repository (--timeout-factor times the 99th percentile, within --timeout-min and --timeout-max), or use the VCS-specific default if the repository has no history.",
+    )
+    opt.add_option(
+        "--always-check",
+        action="append",
+        type="cslist",
+        dest="always_check",
+        help="With --adaptive-checks, always check the named packages (wildcards on package name or cat/pn, can be used multiple times).",
+    )
+    opt.add_option(
+        "--check-sample",
+        action="store",
+        type="int",
+        dest="check_sample",
+        help="With --adaptive-checks, the percentage of the repositories unlikely to have changed that are checked anyway (default: 5).",
+    )
+    opt.add_option(
+        "--check-threshold",
+        action="store",
+        type="int",
+        dest="check_threshold",
+        help="With --adaptive-checks, the minimal probability of change (in percent) for a repository to be checked (default: 10).",
+    )
     opt.add_option(
         "-c",
         "--config-file",
@@ -79,6 +115,40 @@ def parse_options(argv):
         dest="debug",
         help="Die on first failure (useful to debug VCS errors, otherwise missed).",
     )
+    opt.add_option(
+        "--deadline",
+        action="store",
+        type="int",
+        dest="deadline",
+        help="Stop starting new checks after the specified time (in seconds), and terminate the remaining ones after --deadline-grace. The repositories not checked are checked first in the next run (0 to disable).",
+    )
+    opt.add_option(
+        "--deadline-grace",
+        action="store",
+        type="int",
+        dest="deadline_grace",
+        help="Time (in seconds) given to the running checks after --deadline expires (default: 10).",
+    )
+    opt.add_option(
+        "-D",
+        "--dashboard",
+        action="store_true",
+        dest="dashboard",
+        help="Replace the per-repository messages with a live progress line (when running on a terminal).",
+    )
+    opt.add_option(
+        "--dashboard-rate",
+        action="store",
+        type="int",
+        dest="dashboard_rate",
+        help="Maximum number of progress line redraws per second (default: 4).",
+    )
+    opt.add_option(
+        "--emerge-log",
+        action="store",
+        dest="emerge_log",
+        help="The emerge log used by --order-by-cost (default: /var/log/emerge.log).",
+    )
     opt.add_option(
         "-E",
         "--no-erraneous-merge",
@@ -86,6 +156,26 @@ def parse_options(argv):
         dest="erraneous_merge",
         help="Disable emerging packages for which the update has failed.",
     )
+    opt.add_option(
+        "--event-log",
+        action="store",
+        dest="event_log",
+        help="Append a machine-readable log of check events (one JSON object per line) to the specified file.",
+    )
+    opt.add_option(
+        "--failure-backoff",
+        action="store",
+        type="int",
+        dest="failure_backoff",
+        help="Skip checking repositories which failed to update for the specified time (in seconds), doubled for every consecutive failure (default: 0, i.e. disabled).",
+    )
+    opt.add_option(
+        "--failure-backoff-max",
+        action="store",
+        type="int",
+        dest="failure_backoff_max",
+        help="Maximum time (in seconds) for which failing repositories are skipped (default: 2592000, i.e. 30 days).",
+    )
     opt.add_option(
         "-f",
         "--filter-packages",
@@ -94,6 +184,18 @@ def parse_options(argv):
         dest="filter_packages",
         help="Update only named packages (wildcard on package name or cat/pn, prefix with ! for exclusive, can be used multiple times).",
     )
+    opt.add_option(
+        "--forge-api",
+        action="store_true",
+        dest="forge_api",
+        help="Resolve the git-r3 repositories hosted on GitHub and GitLab through the forge APIs, in batches, instead of running git ls-remote for each of them (see the 'forges' configuration option).",
+    )
+    opt.add_option(
+        "--git-store-dir",
+        action="store",
+        dest="git_store_dir",
+        help="The git-r3 store directory used by --prefetch if the package environment does not specify it (default: /var/cache/distfiles/git3-src).",
+    )
     opt.add_option(
         "-j",
         "--jobs",
@@ -102,6 +204,40 @@ def parse_options(argv):
         dest="jobs",
         help="Spawn JOBS parallel processes to perform repository updates.",
     )
+    opt.add_option(
+        "--jobs-checkout",
+        action="store",
+        type="int",
+        dest="jobs_checkout",
+        help="Run up to JOBS_CHECKOUT checkout updates (cvs, darcs) in parallel, independently of the remote checks (default: --jobs, shared with the remote checks).",
+    )
+    opt.add_option(
+        "--jobs-remote",
+        action="store",
+        type="int",
+        dest="jobs_remote",
+        help="Run up to JOBS_REMOTE remote checks in parallel, independently of the checkout updates (default: --jobs, shared with the checkout updates).",
+    )
+    opt.add_option(
+        "--mirror-max-age",
+        action="store",
+        type="int",
+        dest="mirror_max_age",
+        help="Accept the 'no changes' answers from the repository mirrors (see the 'mirrors' configuration option) only if the original repository was found at the same revision within the specified time (in seconds, default: 86400), and check the original repository otherwise. 0 means the mirrors are always trusted.",
+    )
+    opt.add_option(
+        "--prefetch",
+        action="store_true",
+        dest="prefetch",
+        help="Fetch the changed git-r3 repositories into the git-r3 store while checking, so that emerge does not have to fetch them again.",
+    )
+    opt.add_option(
+        "-o",
+        "--order-by-cost",
+        action="store_true",
+        dest="order_by_cost",
+        help="Order the packages so that the builds taking the longest (according to emerge.log) start first, respecting the dependencies between them. Prints the estimated total build time.",
+    )
     opt.add_option(
         "-p",
         "--pretend",
@@ -116,6 +252,12 @@ def parse_options(argv):
         dest="profile",
         help="Configuration profile (config file section) to use (default: smart-live-rebuild)",
     )
+    opt.add_option(
+        "--profile-out",
+        action="store",
+        dest="profile_out",
+        help="Profile the run using cProfile and write the statistics (in pstats format) to the specified file.",
+    )
     opt.add_option(
         "-q",
         "--quiet",
@@ -130,12 +272,63 @@ def parse_options(argv):
         dest="quickpkg",
         help="Call quickpkg to create binary backups of packages which are going to be updated.",
     )
+    opt.add_option(
+        "--remote-checks",
+        action="store_true",
+        dest="remote_checks",
+        help="Check cvs and darcs repositories remotely (using 'cvs rdiff' and 'darcs log --count') instead of updating their checkouts. Implied by --remote-only.",
+    )
     opt.add_option(
         "-r",
         "--remote-only",
         action="store_true",
         dest="remote_only",
-        help="Update remote-capable VCSes only (useful with --unprivileged-user).",
+        help="Update remote-capable VCSes only (useful with --unprivileged-user). Implies --remote-checks.",
+    )
+    opt.add_option(
+        "--resume",
+        action="store_true",
+        dest="resume",
+        help="Record the results of the checks in a journal, and resume the interrupted run (if it used --resume as well): reuse the results of the checks it has finished, and check only the remaining repositories.",
+    )
+    opt.add_option(
+        "--resume-max-age",
+        action="store",
+        type="int",
+        dest="resume_max_age",
+        help="With --resume, ignore the results older than the specified time (in seconds, default: 3600).",
+    )
+    opt.add_option(
+        "--revcache",
+        action="store",
+        dest="revcache",
+        help="Use the shared revision cache server at the specified address (HOST:PORT or unix:PATH).",
+    )
+    opt.add_option(
+        "--revcache-server",
+        action="store",
+        dest="revcache_server",
+        help="Run the shared revision cache server on the specified address (HOST:PORT or unix:PATH).",
+    )
+    opt.add_option(
+        "--revcache-secret",
+        action="store",
+        dest="revcache_secret",
+        help="The secret shared by the revision cache server and its clients. The server refuses the requests without it. Preferably set in the configuration file, since the command line is visible to the other users.",
+    )
+    opt.add_option(
+        "--revcache-ttl",
+        action="store",
+        type="int",
+        dest="revcache_ttl",
+        help="Time (in seconds) the revisions are kept by the revision cache server (default: 600).",
+    )
+    opt.add_option(
+        "--root",
+        action="append",
+        type="cslist",
+        dest="roots",
+        help="Check the live packages installed in the specified ROOT (e.g. a chroot, using its own configuration). Can be used multiple times; every repository is checked only once, and a separate rebuild list is produced for every ROOT.",
     )
     opt.add_option(
         "-S",
@@ -144,6 +337,25 @@ def parse_options(argv):
         dest="setuid",
         help="Do not switch UID to portage when FEATURES=userpriv is set.",
     )
+    opt.add_option(
+        "--skipped-erraneous",
+        action="store_true",
+        dest="skipped_erraneous",
+        help="Treat the packages whose repositories were skipped due to repeated failures as erraneous (i.e. rebuild them unless --no-erraneous-merge is used).",
+    )
+    opt.add_option(
+        "--state-dir",
+        action="store",
+        dest="state_dir",
+        help="Directory to keep the state between runs in (default: /var/cache/smart-live-rebuild).",
+    )
+    opt.add_option(
+        "--step-timeout",
+        action="store",
+        type="int",
+        dest="step_timeout",
+        help="Timeout for the additional git-r3 steps (the path filter fetch and the prefetch). The adaptive update timeouts are not applied to them (default: --timeout, 0 to disable).",
+    )
     opt.add_option(
         "-t",
         "--type",
@@ -159,6 +371,40 @@ def parse_options(argv):
         dest="timeout",
         help="Update timeout (0 to disable)",
     )
+    opt.add_option(
+        "--timeout-factor",
+        action="store",
+        type="int",
+        dest="timeout_factor",
+        help="With --adaptive-timeout, the multiplier applied to the 99th percentile of past update durations (default: 3).",
+    )
+    opt.add_option(
+        "--timeout-max",
+        action="store",
+        type="int",
+        dest="timeout_max",
+        help="With --adaptive-timeout, the maximum timeout (default: 600).",
+    )
+    opt.add_option(
+        "--timeout-min",
+        action="store",
+        type="int",
+        dest="timeout_min",
+        help="With --adaptive-timeout, the minimum timeout (default: 10).",
+    )
+    opt.add_option(
+        "--trace-file",
+        action="store",
+        dest="trace_file",
+        help="Write the timeline of the run to the specified file, in the Chrome trace event format (viewable in chrome://tracing or Perfetto).",
+    )
+    opt.add_option(
+        "--trace-malloc",
+        action="store",
+        type="int",
+        dest="trace_malloc",
+        help="Trace the memory allocations and report the specified number of top allocation sites.",
+    )
     opt.add_option(
         "-U",
         "--unprivileged-user",
@@ -166,6 +412,25 @@ def parse_options(argv):
         dest="unprivileged_user",
         help="Allow running as an unprivileged user.",
     )
+    opt.add_option(
+        "--worker",
+        action="store_true",
+        dest="worker",
+        help="Run as a worker: read check requests on stdin and write the results to stdout (used by --workers).",
+    )
+    opt.add_option(
+        "--worker-socket",
+        action="store",
+        dest="worker_socket",
+        help="With --worker, serve the requests on the specified local socket instead of stdin/stdout.",
+    )
+    opt.add_option(
+        "--workers",
+        action="append",
+        type="cslist",
+        dest="workers",
+        help="Distribute the checks of remote-capable repositories among the specified workers. Each worker is either a command (e.g. 'ssh host smart-live-rebuild --worker') or a local socket (unix:PATH). Can be used multiple times.",
+    )
 
     return opt.parse_args(argv[1:])
 
@@ -188,6 +453,16 @@ def main(argv):
     c.apply_optparse(opts)
     opts = c.get_options()
 
+    if opts.worker:
+        return worker_main(opts)
+    if opts.revcache_server:
+        return server_main(opts)
+
+    if not opts.color:
+        out.monochromize()
+    if opts.quiet:
+        out.silence()
+
     if not opts.pretend:
         try:
             import psutil
@@ -224,32 +499,73 @@ def main(argv):
         if opts.quickpkg:
             out.err("Running as an unprivileged user, --quickpkg probably won't work")
 
+    profiling.start(opts)
+    if opts.roots:
+        pms = [root_package_manager(pm, r) for r in opts.roots]
+    else:
+        pms = [pm]
+
+    run = LiveRebuildRun(opts, pms, filters=args)
     try:
-        packages = SmartLiveRebuild(opts, pm, cliargs=args)
+        for res in run:
+            pass
     except SLRFailure:
         return 1
+    finally:
+        profiling.finish(opts)
+    results = run.packages
+    # the remaining arguments are passed to emerge
+    args = run.unmatched
 
-    if not packages and not any(filter(lambda a: not a.startswith("-"), args)):
+    if not any(results.values()) and not any(
+        filter(lambda a: not a.startswith("-"), args)
+    ):
         return 0
 
+    for pm in pms:
+        packages = results[pm.root]
+        if opts.order_by_cost and len(packages) > 1:
+            results[pm.root] = order_by_cost(opts, pm, packages)
+
     if opts.pretend:
-        for p in packages:
-            print(p)
+        for pm in pms:
+            for p in results[pm.root]:
+                if len(pms) > 1:
+                    print("%s %s" % (pm.root, p))
+                else:
+                    print(p)
         return 0
+    elif len(pms) > 1:
+        ret = 0
+        for pm in pms:
+            packages = results[pm.root]
+            if not packages:
+                continue
+            cmd = emerge_command(packages, args)
+            out.s2("ROOT=%s %s" % (shlex.quote(pm.root), shlex.join(cmd)))
+            env = dict(os.environ, ROOT=pm.root, PORTAGE_CONFIGROOT=pm.root)
+            ret = max(ret, subprocess.call(cmd, executable="/usr/bin/emerge", env=env))
+        return ret
     else:
-        cmd = [
-            "emerge",
-            "--oneshot",
-            "--getbinpkg=n",
-            "--usepkg-exclude",
-            " ".join(packages),
-        ]
-        cmd.extend(args)
-        cmd.extend(packages)
+        packages = results[pm.root]
+        cmd = emerge_command(packages, args)
         out.s2(shlex.join(cmd))
         os.execv("/usr/bin/emerge", cmd)
         return 126
 
 
+def emerge_command(packages, args):
+    cmd = [
+        "emerge",
+        "--oneshot",
+        "--getbinpkg=n",
+        "--usepkg-exclude",
+        " ".join(packages),
+    ]
+    cmd.extend(args)
+    cmd.extend(packages)
+    return cmd
+
+
 def setuptools_main():
     sys.exit(main(sys.argv))
@@ -15,24 +15,143 @@ from .vcsload import VCSLoader
 conf_getvcs = VCSLoader()
 
 
+def parse_path_filter(v):
+    """Parse the path_filter option. Each line lists a package key
+    followed by a colon and the paths (or wildcards) relevant to it.
+
+    >>> parse_path_filter('''
+    ... dev-libs/foo: src/ include/*.h
+    ... app-misc/bar: lib''')
+    {'dev-libs/foo': ['src/', 'include/*.h'], 'app-misc/bar': ['lib']}
+    """
+    ret = {}
+    for l in v.splitlines():
+        if ":" in l:
+            k, paths = l.split(":", 1)
+            ret[k.strip()] = paths.split()
+    return ret
+
+
+def parse_vcs_timeouts(v):
+    """Parse the vcs_timeouts option, listing VCS eclass names
+    followed by an equals sign and the default timeout.
+
+    >>> parse_vcs_timeouts('git-r3=20, subversion=300')
+    {'git-r3': 20, 'subversion': 300}
+    """
+    ret = {}
+    for x in v.replace(",", " ").split():
+        k, t = x.split("=", 1)
+        try:
+            ret[k] = int(t)
+        except ValueError:
+            out.err("Incorrect int value: vcs_timeouts %s=%s" % (k, t))
+    return ret
+
+
+def parse_forges(v):
+    """Parse the forges option. Each line lists a host name followed
+    by a colon, the forge type (github or gitlab), the API URL
+    and optionally the access token.
+
+    >>> parse_forges('''
+    ... github.com: github https://api.github.com ghp_xxx
+    ... git.example.com: gitlab https://git.example.com/api/v4''')
+    {'github.com': ('github', 'https://api.github.com', 'ghp_xxx'), 'git.example.com': ('gitlab', 'https://git.example.com/api/v4', None)}
+    """
+    ret = {}
+    for l in v.splitlines():
+        if ":" in l:
+            k, spec = l.split(":", 1)
+            spec = spec.split()
+            if len(spec) not in (2, 3):
+                out.err("Incorrect forges value: %s" % l.strip())
+                continue
+            ret[k.strip()] = (spec[0], spec[1], spec[2] if len(spec) > 2 else None)
+    return ret
+
+
+def parse_mirrors(v):
+    """Parse the mirrors option. Each line lists an URI prefix
+    followed by the prefix of the mirror URIs to use instead.
+
+    >>> parse_mirrors('''
+    ... https://github.com/ git://mirror.lan/github/
+    ... svn://svn.example.com/ http://mirror.lan/svn/''')
+    [('https://github.com/', 'git://mirror.lan/github/'), ('svn://svn.example.com/', 'http://mirror.lan/svn/')]
+    """
+    ret = []
+    for l in v.splitlines():
+        spec = l.split()
+        if len(spec) == 2:
+            ret.append(tuple(spec))
+        elif spec:
+            out.err("Incorrect mirrors value: %s" % l.strip())
+    return ret
+
+
 class Config(ConfigParser):
     def __init__(self, pm_conf):
         self._real_defaults = {
+            "adaptive_checks": "False",
+            "adaptive_timeout": "False",
+            "always_check": "",
+            "check_sample": "5",
+            "check_threshold": "10",
             "color": "True",
             "config_file": "/etc/portage/smart-live-rebuild.conf",
+            "dashboard": "False",
+            "dashboard_rate": "4",
+            "deadline": "0",
+            "deadline_grace": "10",
             "debug": "False",
+            "emerge_log": "/var/log/emerge.log",
             "erraneous_merge": "True",
+            "event_log": "",
+            "failure_backoff": "0",
+            "failure_backoff_max": "2592000",
             "filter_packages": "",
+            "forge_api": "False",
+            "forges": "",
+            "git_store_dir": "/var/cache/distfiles/git3-src",
             "jobs": "1",
+            "jobs_checkout": "0",
+            "jobs_remote": "0",
+            "mirror_max_age": "86400",
+            "mirrors": "",
+            "order_by_cost": "False",
+            "path_filter": "",
+            "prefetch": "False",
             "pretend": "False",
             "profile": "smart-live-rebuild",
+            "profile_out": "",
             "quickpkg": "False",
             "quiet": "False",
+            "remote_checks": "False",
             "remote_only": "False",
+            "resume": "False",
+            "resume_max_age": "3600",
+            "revcache": "",
+            "revcache_secret": "",
+            "revcache_server": "",
+            "revcache_ttl": "600",
+            "roots": "",
             "setuid": str(pm_conf.userpriv_enabled),
+            "skipped_erraneous": "False",
+            "state_dir": "/var/cache/smart-live-rebuild",
+            "step_timeout": "0",
             "timeout": "0",
+            "timeout_factor": "3",
+            "timeout_max": "600",
+            "timeout_min": "10",
+            "trace_file": "",
+            "trace_malloc": "0",
             "type": "",
             "unprivileged_user": "False",
+            "vcs_timeouts": "",
+            "worker": "False",
+            "worker_socket": "",
+            "workers": "",
         }
 
         self._current_section = "DEFAULT"
@@ -96,13 +215,21 @@ class Config(ConfigParser):
                 except ValueError:
                     out.err("Incorrect boolean value: %s=%s" % (k, v))
                     val[k] = self._real_defaults[k] == "True"
-            elif self._real_defaults[k] in ("0", "1"):  # int
+            elif self._real_defaults[k].isdigit():  # int
                 try:
                     val[k] = int(v)
                 except ValueError:
                     out.err("Incorrect int value: %s=%s" % (k, v))
                     val[k] = int(self._real_defaults[k])
-            elif k == "filter_packages":  # list
+            elif k == "path_filter":
+                val[k] = parse_path_filter(v)
+            elif k == "vcs_timeouts":
+                val[k] = parse_vcs_timeouts(v)
+            elif k == "forges":
+                val[k] = parse_forges(v)
+            elif k == "mirrors":
+                val[k] = parse_mirrors(v)
+            elif k in ("always_check", "filter_packages", "roots", "workers"):  # list
                 if v != "":
                     val[k] = v.split(",")
                 else:
@@ -2,11 +2,25 @@
 # (c) 2011 Michał Górny <mgorny@gentoo.org>
 # Released under the terms of the 2-clause BSD license.
 
-import os, os.path, pickle, signal, subprocess, sys, time
+import os, os.path, pickle, re, signal, subprocess, sys, time
 
+from .buildcost import format_duration
+from .changes import ChangeLog
+from .distributed import Coordinator
+from .environ import PackageEnviron, env_keys
+from .failures import FailureLog
+from .journal import Journal
+from .mirrors import MirrorLog
 from .filtering import PackageFilter
-from .output import out
-from .vcs import NonLiveEbuild, OtherEclass
+from .forge import ForgeResolver, get_apis
+from .output import out, DashboardSink, JSONLinesSink, TextSink
+from .profiling import timers
+from . import profiling
+from .revcache import SharedCache
+from .state import StateFile, state_path
+from .timeouts import LatencyLog
+from .tracing import tracer
+from .vcs import CheckCache, NonLiveEbuild, OtherEclass, RemoteVCSSupport, reaper
 from .vcsload import VCSLoader
 
 
@@ -14,195 +28,1033 @@ class SLRFailure(Exception):
     pass
 
 
+# the package directories in vdb (other entries, e.g. -MERGING-*,
+# are skipped)
+pf_re = re.compile(r"^([A-Za-z0-9_][A-Za-z0-9+_-]*?)-\d[^-]*(?:-r\d+)?$")
+
+
+def installed_packages(pm, filt):
+    """Iterate over installed packages matching PackageFilter `filt'.
+
+    If the installed package database is available as a directory
+    tree, the filter is applied to the category and package names
+    found there first. This way whole categories are skipped without
+    loading any of their packages, and the package manager is queried
+    only for package names which have passed the filter. The entries
+    which are not package directories (e.g. the ones being merged)
+    are skipped.
+
+    >>> [pf_re.match(pf).group(1) for pf in ("foo-9999", "foo-bar-1.2-r3")]
+    ['foo', 'foo-bar']
+    >>> [pf_re.match(pf) for pf in ("-MERGING-foo-9999", ".keep")]
+    [None, None]
+    """
+
+    vdb = os.path.join(pm.root, "var/db/pkg")
+    try:
+        cats = sorted(os.listdir(vdb))
+    except OSError:
+        for pkg in pm.installed.filter(filt):
+            yield pkg
+        return
+
+    for cat in cats:
+        if cat.startswith((".", "-")) or not filt.category_pass(cat):
+            continue
+        try:
+            pfs = os.listdir(os.path.join(vdb, cat))
+        except OSError:
+            continue
+
+        keys = set()
+        for pf in pfs:
+            m = pf_re.match(pf)
+            if m is not None:
+                keys.add("%s/%s" % (cat, m.group(1)))
+        for key in sorted(keys):
+            if filt.match_key(key):
+                try:
+                    pkgs = list(pm.installed.filter(pm.Atom(key)))
+                except Exception as e:
+                    out.err("Unable to load installed %s: %s" % (key, e))
+                    continue
+                for pkg in pkgs:
+                    yield pkg
+
+
+def enumerate_roots(pms, filt):
+    """Iterate over installed packages in all the package managers
+    `pms' (one per ROOT), alternating between them. Yields (pm, pkg)
+    tuples."""
+
+    iters = [(pm, installed_packages(pm, filt)) for pm in pms]
+    while iters:
+        for pm, it in list(iters):
+            try:
+                yield (pm, next(it))
+            except StopIteration:
+                iters.remove((pm, it))
+
+
+class CheckQueue(object):
+    """The queue of checks to perform. It is split into pools having
+    their own concurrency limits: with `jobs_remote' or `jobs_checkout'
+    set, the remote and checkout-based checks are run independently
+    (the unset one defaulting to `jobs'). Otherwise, all the checks
+    share `jobs'."""
+
+    def __init__(self, jobs, jobs_remote=0, jobs_checkout=0):
+        if jobs_remote or jobs_checkout:
+            self._pools = {
+                True: (jobs_remote or jobs, []),
+                False: (jobs_checkout or jobs, []),
+            }
+        else:
+            self._pools = {None: (jobs, [])}
+
+    def _pool(self, vcs):
+        if None in self._pools:
+            return self._pools[None][1]
+        return self._pools[isinstance(vcs, RemoteVCSSupport)][1]
+
+    def append(self, vcs):
+        self._pool(vcs).append(vcs)
+
+    def insert_first(self, vcs):
+        """Queue `vcs' before the checks that were not started yet."""
+        pool = self._pool(vcs)
+        i = 0
+        while i < len(pool) and pool[i].running:
+            i += 1
+        pool.insert(i, vcs)
+
+    def remove(self, vcs):
+        self._pool(vcs).remove(vcs)
+
+    def clear(self):
+        for limit, pool in self._pools.values():
+            del pool[:]
+
+    def active(self):
+        """The checks which can be running now: the first ones
+        of every pool, up to its limit. The checks waiting for other
+        checks do not count towards the limit."""
+        ret = []
+        for limit, pool in self._pools.values():
+            count = 0
+            for vcs in pool:
+                if count >= limit:
+                    break
+                ret.append(vcs)
+                if not vcs.waiting:
+                    count += 1
+        return ret
+
+    def __iter__(self):
+        return iter([vcs for limit, pool in self._pools.values() for vcs in pool])
+
+    def __len__(self):
+        return sum(len(pool) for limit, pool in self._pools.values())
+
+
+def root_package_manager(pm, root):
+    """Get a package manager instance of the same kind as `pm'
+    for the system installed in `root' (using the configuration
+    found in it)."""
+
+    saved = os.environ.get("ROOT")
+    os.environ["ROOT"] = root
+    try:
+        return pm.__class__(config_root=root)
+    finally:
+        if saved is None:
+            del os.environ["ROOT"]
+        else:
+            os.environ["ROOT"] = saved
+
+
+class CheckResult(object):
+    """The result of checking a single live package.
+
+    `root' is the ROOT the package is installed in, `atom' its slotted
+    atom, `vcs' the VCS eclass name and `repo' the repository checked.
+    `oldrev' and `newrev' are the revision the package was built from
+    and the current one, `changed' tells whether the package needs
+    to be rebuilt. If the check failed, `error' holds the error message
+    and the revisions are None. `duration' is the time spent checking
+    (0 if the result was cached). `skipped' is True if the check was
+    skipped because the repository kept failing (with --failure-backoff),
+    `error' holding the last error message then.
+    """
+
+    __slots__ = (
+        "root",
+        "atom",
+        "vcs",
+        "repo",
+        "oldrev",
+        "newrev",
+        "changed",
+        "error",
+        "duration",
+        "cached",
+        "skipped",
+    )
+
+    def __init__(self, **kwargs):
+        for k in self.__slots__:
+            setattr(self, k, kwargs.get(k))
+
+    def __repr__(self):
+        return "CheckResult(%s)" % ", ".join(
+            "%s=%r" % (k, getattr(self, k)) for k in self.__slots__
+        )
+
+
+def vcs_eclass(vcs):
+    """Get the eclass name for the VCS instance `vcs'."""
+    return vcs.__class__.__module__.rsplit(".", 1)[-1].replace("_", "-")
+
+
+class ResultSink(object):
+    """An output sink collecting CheckResult records from the finish,
+    error and skip events."""
+
+    def __init__(self):
+        self.results = []
+
+    def __call__(self, ev, vcs):
+        if vcs is None or ev["event"] not in ("finish", "error", "skip"):
+            return
+        res = CheckResult(
+            root=vcs.root,
+            atom=vcs.cpv,
+            vcs=vcs_eclass(vcs),
+            repo=str(vcs),
+            duration=ev.get("duration", 0),
+            skipped=False,
+        )
+        if ev["event"] == "finish":
+            res.oldrev = ev["oldrev"]
+            res.newrev = ev["newrev"]
+            res.changed = ev["changed"]
+            res.cached = ev["cached"]
+        elif ev["event"] == "skip":
+            res.changed = False
+            res.skipped = True
+            res.error = ev["error"]
+        else:
+            res.changed = False
+            res.error = ev["message"]
+        self.results.append(res)
+
+    def pop(self):
+        """Return the records collected so far and forget them."""
+        ret = self.results
+        self.results = []
+        return ret
+
+
 def SmartLiveRebuild(opts, pm, cliargs=None):
-    if not opts.color:
-        out.monochromize()
-    if opts.quiet:
-        out.silence()
-
-    if opts.jobs <= 0:
-        out.err("The argument to --jobs option must be a positive integer.")
-        raise SLRFailure("")
-
-    childpid = None
-    commpipe = None
-    superuser = os.geteuid() == 0
-    if opts.setuid:
-        pm_conf = pm.config
-        portage_uid = pm_conf.userpriv_uid
-        portage_gid = pm_conf.userpriv_gid
-        if portage_uid and portage_gid:
-            if superuser:
-                global dead_children
-                dead_children = ()
-
-                def chld_handler(sig, frame):
-                    global dead_children
-                    dead_children += (os.wait()[0],)
+    return SmartLiveRebuildRoots(opts, [pm], cliargs)[pm.root]
+
+
+def SmartLiveRebuildRoots(opts, pms, cliargs=None):
+    """Find the packages to rebuild in multiple ROOTs (`pms' being
+    the list of package managers for them). Every repository is checked
+    only once. Returns a dict of ROOT -> list of packages."""
+
+    run = LiveRebuildRun(opts, pms, cliargs)
+    for res in run:
+        pass
+    return run.packages
+
+
+class LiveRebuildRun(object):
+    """A single run checking the live packages in one or more ROOTs
+    (`pms' being the list of package managers for them), limited
+    to the packages matching `filters' (in addition to --filter-packages).
+
+    Iterating over the instance performs the checks, yielding
+    a CheckResult for every package as soon as its check finishes.
+    Afterwards, the following attributes are set:
+
+    - `packages' -- a dict of ROOT -> list of packages to rebuild,
+    - `erraneous' -- a list of (ROOT, package) tuples that failed,
+    - `all_count' -- a dict of ROOT -> number of live packages checked,
+    - `unmatched' -- the elements of `filters' that did not match any
+      package (e.g. emerge options).
+
+    If `output' is False, nothing is printed. The global output settings
+    (--no-color, --quiet, the event sinks) apply to the run only, and are
+    restored afterwards.
 
-                out.s1("Forking to drop superuser privileges ...")
-                old_chld = signal.signal(signal.SIGCHLD, chld_handler)
-                commpipe = os.pipe()
-                childpid = os.fork()
+    The run consists of the following steps, which can be used
+    separately as well: setup_output(), open_state(), start_checks(),
+    the checks themselves (enumerate_checks(), wait_checks()), save_state()
+    and finish(). With the setuid option, the checks are performed
+    in a child process running as the portage user, and their results
+    are passed back to the parent process.
+    """
 
+    def __init__(self, opts, pms, filters=None, output=True):
+        self.opts = opts
+        self.pms = pms
+        self.filters = list(filters or [])
+        self.output = output
+        self.packages = None
+        self.erraneous = None
+        self.all_count = None
+        self.unmatched = None
+
+    def __iter__(self):
+        return self._run()
+
+    def _run(self):
+        # the output settings are per-run, restore them afterwards
+        saved = out.save()
+        try:
+            yield from self._check()
+        finally:
+            out.close()
+            out.restore(saved)
+
+    def _check(self):
+        self.setup_output()
+        self.open_state()
+
+        childpid = self.fork()
+        try:
+            if childpid == 0:
+                self.enter_child()
+            if not childpid:
+                self.start_checks()
+                yield from self.check_all()
                 if childpid == 0:
-                    signal.signal(signal.SIGCHLD, old_chld)
-        else:
-            out.err("setuid requested but there's no 'portage' user in the system")
-            return 1
+                    self.send_state()
+            else:
+                yield from self.receive()
+        finally:
+            if childpid:  # make sure that we leave no orphans
+                if childpid not in dead_children:
+                    os.kill(childpid, signal.SIGTERM)
+                signal.signal(signal.SIGCHLD, self._old_chld)
+
+        self.save_state()
+        self.finish()
+
+    def setup_output(self):
+        """Verify the options and set up the output."""
+        opts = self.opts
+        if not opts.color:
+            out.monochromize()
+        if opts.quiet:
+            out.silence()
+        if not self.output:
+            out.mute()
+        if opts.trace_file:
+            tracer.start()
 
-    if not superuser and not opts.unprivileged_user:
-        out.err("Superuser privileges are required!")
-        out.out(
-            """
+        if opts.jobs <= 0:
+            out.err("The argument to --jobs option must be a positive integer.")
+            raise SLRFailure("")
+        if opts.jobs_remote < 0 or opts.jobs_checkout < 0:
+            out.err("The arguments to --jobs-* options must be non-negative integers.")
+            raise SLRFailure("")
+        self.pooled = bool(opts.jobs_remote or opts.jobs_checkout)
+        self.jobs = max(opts.jobs, opts.jobs_remote, opts.jobs_checkout)
+
+        self.results = ResultSink()
+        sinks = [self.results]
+        if self.output:
+            if opts.dashboard and sys.stderr.isatty():
+                sinks.append(DashboardSink(out, rate=opts.dashboard_rate))
+            else:
+                sinks.append(TextSink(out, jobs=self.jobs))
+        if opts.event_log:
+            try:
+                sinks.append(JSONLinesSink(open(opts.event_log, "a", buffering=1)))
+            except IOError as e:
+                out.err("Unable to open event log: %s" % e)
+                raise SLRFailure("")
+        out.sinks = sinks
+
+    def open_state(self):
+        """Load the state files. They are opened before dropping
+        the privileges, and saved by the parent process."""
+        opts = self.opts
+        self.failures = FailureLog(
+            state_path(opts, "failures.json"),
+            opts.failure_backoff,
+            opts.failure_backoff_max,
+        )
+        self.latency = LatencyLog(state_path(opts, "latency.json"))
+        # the revision history is used (and updated) by --adaptive-checks
+        self.changes = (
+            ChangeLog(state_path(opts, "changes.json"))
+            if opts.adaptive_checks
+            else None
+        )
+        # the repositories not checked in the previous run (repo key -> cpv)
+        self.unchecked_prev = StateFile(state_path(opts, "unchecked.json"))
+        self.journal = Journal(
+            state_path(opts, "journal.jsonl"),
+            resume=opts.resume,
+            max_age=opts.resume_max_age,
+        )
+        # the cached forge API responses (URL -> [ETag, revision])
+        self.forge_cache = (
+            StateFile(state_path(opts, "forge.json")) if opts.forge_api else None
+        )
+        # the revisions found in the original repositories of the mirrors
+        self.mirror_log = (
+            MirrorLog(state_path(opts, "mirrors.json")) if opts.mirrors else None
+        )
+
+    def fork(self):
+        """Fork the child process performing the checks as the portage
+        user, if requested. Returns the child PID in the parent process,
+        0 in the child process and None if no fork was done."""
+        opts = self.opts
+        childpid = None
+        superuser = os.geteuid() == 0
+        if opts.setuid:
+            pm_conf = self.pms[0].config
+            self._portage_uid = pm_conf.userpriv_uid
+            self._portage_gid = pm_conf.userpriv_gid
+            if self._portage_uid and self._portage_gid:
+                if superuser:
+                    global dead_children
+                    dead_children = ()
+
+                    def chld_handler(sig, frame):
+                        global dead_children
+                        dead_children += (os.wait()[0],)
+
+                    out.s1("Forking to drop superuser privileges ...")
+                    self._old_chld = signal.signal(signal.SIGCHLD, chld_handler)
+                    self._commpipe = os.pipe()
+                    childpid = os.fork()
+
+                    if childpid == 0:
+                        signal.signal(signal.SIGCHLD, self._old_chld)
+            else:
+                out.err("setuid requested but there's no 'portage' user in the system")
+                raise SLRFailure("")
+
+        if not superuser and not opts.unprivileged_user:
+            out.err("Superuser privileges are required!")
+            out.out(
+                """
 This tool requires superuser privileges. If you would like to force running
 the update using your current user account, please pass the --unprivileged-user
 option.
 """
+            )
+            raise SLRFailure("")
+        self._childpid = childpid
+        return childpid
+
+    def enter_child(self):
+        """Drop the privileges in the child process."""
+        os.close(self._commpipe[0])
+        self._pipe = os.fdopen(self._commpipe[1], "wb")
+        # Make sure CWD will be readable to portage user
+        os.chdir("/")
+        if self.opts.path_filter:
+            self.chown_state("git-paths")
+        os.setuid(self._portage_uid)
+
+    def chown_state(self, name):
+        """Create the directory `name' in the state directory (if
+        necessary) and pass it to the portage user, so that it can be
+        written by the child process."""
+        uid, gid = self._portage_uid, self._portage_gid
+        top = state_path(self.opts, name)
+        try:
+            os.makedirs(top, exist_ok=True)
+            for path, dirs, files in os.walk(top):
+                for p in [path] + [os.path.join(path, f) for f in dirs + files]:
+                    if os.lstat(p).st_uid != uid:
+                        os.lchown(p, uid, gid)
+        except OSError as e:
+            out.err("Unable to pass %s to the portage user: %s" % (top, e))
+
+    def start_checks(self):
+        """Prepare for performing the checks."""
+        opts = self.opts
+        if opts.type:
+            self.allowed = frozenset(opts.type)
+        else:
+            self.allowed = None
+
+        if self.pooled:
+            out.s1(
+                "Updating the repositories using %s%d%s remote and %s%d%s "
+                "checkout jobs..."
+                % (
+                    out.white,
+                    opts.jobs_remote or opts.jobs,
+                    out.s1reset,
+                    out.white,
+                    opts.jobs_checkout or opts.jobs,
+                    out.s1reset,
+                )
+            )
+        elif opts.jobs == 1:
+            out.s1("Updating the repositories...")
+        else:
+            out.s1(
+                "Updating the repositories using %s%d%s parallel jobs..."
+                % (out.white, opts.jobs, out.s1reset)
+            )
+
+        self.processes = CheckQueue(opts.jobs, opts.jobs_remote, opts.jobs_checkout)
+
+        self.all_count = dict((p.root, 0) for p in self.pms)
+        # (ROOT, package) tuples to rebuild
+        self.rebuild = []
+        self.erraneous = []
+        self.skipped = []
+        self.unchecked = []
+        self.deferred = []
+        # repo key -> whether it is checked with --adaptive-checks
+        self._due = {}
+        self._always_check = None
+        if opts.always_check:
+            self._always_check = PackageFilter(opts.always_check)
+        self.cache = (
+            SharedCache(opts.revcache, secret=opts.revcache_secret)
+            if opts.revcache
+            else CheckCache()
         )
-        raise SLRFailure("")
+        if self.journal.results:
+            out.s1(
+                "Resuming the interrupted run, %s%d%s repositories checked already."
+                % (out.white, len(self.journal.results), out.s1reset)
+            )
+            for k, v in self.journal.results.items():
+                self.cache[k] = v
 
-    try:
-        if not childpid:
-            if childpid == 0:
-                os.close(commpipe[0])
-                # Make sure CWD will be readable to portage user
-                os.chdir("/")
-                os.setuid(portage_uid)
-            if opts.type:
-                allowed = frozenset(opts.type)
-            else:
-                allowed = None
+        self.filt = PackageFilter((opts.filter_packages or []) + self.filters)
+        self.getvcs = VCSLoader(
+            remote_only=opts.remote_only, remote_checks=opts.remote_checks
+        )
+        self.coordinator = None
+        if opts.workers:
+            self.coordinator = Coordinator(opts.workers, fallback=self.processes.append)
+        self.forge = None
+        if opts.forge_api:
+            apis = get_apis(opts.forges, self.forge_cache)
+            if apis:
+                self.forge = ForgeResolver(apis)
 
-            if opts.jobs == 1:
-                out.s1("Updating the repositories...")
+        self.starttime = time.time()
+        self.deadline = None
+        if opts.deadline > 0:
+            self.deadline = self.starttime + opts.deadline
+
+    def flush_results(self):
+        """Yield the results collected so far (or pass them to the parent
+        process)."""
+        for res in self.results.pop():
+            if self._childpid == 0:
+                pickle.dump(("result", res), self._pipe, pickle.HIGHEST_PROTOCOL)
+                self._pipe.flush()
             else:
-                out.s1(
-                    "Updating the repositories using %s%d%s parallel jobs..."
-                    % (out.white, opts.jobs, out.s1reset)
+                yield res
+
+    def record_error(self, vcs, e):
+        """Record a failed check."""
+        if self.opts.debug:
+            out.flush()
+            raise e
+        out.event(
+            "error",
+            vcs,
+            phase="update",
+            exception=e.__class__.__name__,
+            message=str(e),
+            duration=vcs.duration,
+        )
+        self.erraneous.append((vcs.root, vcs.cpv))
+        self.cache[str(vcs)] = e
+        tracer.release(vcs)
+        self.failures.failed(str(vcs), str(e))
+
+    def record_nonlive(self, atom, e):
+        """Report the package `atom' which can not (or does not need
+        to) be checked."""
+        out.s2("[%s]" % atom)
+        out.s3("%s%s%s" % (out.brown, e, out.reset))
+
+    def record_success(self, vcs, changed):
+        """Record a finished check, `changed' telling whether the package
+        needs to be rebuilt."""
+        tracer.release(vcs)
+        self.failures.succeeded(str(vcs))
+        if vcs.starttime is not None:
+            self.journal.record(str(vcs), vcs.cpv, self.cache[str(vcs)])
+            if self.opts.adaptive_timeout and vcs.updatetime is not None:
+                # the update commands only (e.g. no git-r3 steps)
+                self.latency.record(str(vcs), vcs.updatetime)
+            if self.changes is not None:
+                self.changes.observed(str(vcs), self.cache[str(vcs)])
+        if changed:
+            self.rebuild.append((vcs.root, vcs.cpv))
+        self.all_count[vcs.root] += 1
+
+    def check_due(self, vcs, pkgkey):
+        """Decide whether the repository should be checked
+        with --adaptive-checks."""
+        opts = self.opts
+        repo = str(vcs)
+        if repo in self.cache:
+            return True
+        if self._always_check is not None and self._always_check.match_key(pkgkey):
+            return True
+        lastrev = self.changes.rev(repo)
+        if lastrev is None:
+            # no history yet
+            return True
+        if not vcs.revcmp(vcs.savedrev, lastrev):
+            # the last revision found was not built yet
+            return True
+        if repo not in self._due:
+            self._due[repo] = self.changes.should_check(
+                repo, opts.check_threshold / 100, opts.check_sample / 100
+            )
+        return self._due[repo]
+
+    def enqueue(self, vcs, first=False):
+        if first:
+            self.processes.insert_first(vcs)
+        else:
+            self.processes.append(vcs)
+
+    def past_deadline(self):
+        return self.deadline is not None and time.time() > self.deadline
+
+    def loop_iter(self, blocking=False):
+        """Perform a single iteration of the main loop: poll the running
+        checks and start the new ones. Returns True if nothing happened
+        (and the caller may sleep)."""
+        with timers("loop_iter"):
+            processes = self.processes
+            needsleep = True
+            reaper.poll()
+            if self.jobs > 1:
+                out.buffer()
+            if self.past_deadline():
+                # do not start any new checks
+                for vcs in reversed(list(processes)):
+                    if not vcs.running and str(vcs) not in self.cache:
+                        processes.remove(vcs)
+                        self.unchecked.append((vcs.cpv, str(vcs)))
+            for vcs in reversed(processes.active()):
+                try:
+                    ret = vcs(blocking)
+                    if ret is not None:
+                        needsleep = False
+                        self.record_success(vcs, ret)
+                        processes.remove(vcs)
+                except KeyboardInterrupt:
+                    out.flush()
+                    raise
+                except NonLiveEbuild as e:
+                    # e.g. the checkout needed for the check is gone
+                    processes.remove(vcs)
+                    tracer.release(vcs)
+                    self.record_nonlive(vcs.cpv, e)
+                except Exception as e:
+                    processes.remove(vcs)
+                    self.record_error(vcs, e)
+            if self.coordinator is not None:
+                for vcs, rev in self.coordinator.poll():
+                    needsleep = False
+                    if isinstance(rev, Exception):
+                        self.record_error(vcs, rev)
+                        continue
+                    self.cache[str(vcs)] = rev
+                    # the check completes using the cached revision,
+                    # including the additional steps (e.g. the path filter)
+                    self.enqueue(vcs, first=True)
+            if self.forge is not None:
+                for vcs, rev in self.forge.poll():
+                    needsleep = False
+                    if rev is not None:
+                        self.cache[str(vcs)] = rev
+                    # the check completes using the cached revision
+                    self.enqueue(vcs, first=True)
+            if tracer.enabled:
+                running = sum(1 for v in processes if v.running)
+                tracer.counter(
+                    "queue",
+                    queued=len(processes) - running,
+                    running=running,
                 )
+            out.flush()
+            return needsleep
 
-            processes = []
-
-            all_count = [0]
-            packages = []
-            erraneous = []
-            cache = {}
-
-            def loop_iter(blocking=False):
-                needsleep = True
-                for i, vcs in reversed(list(enumerate(processes[: opts.jobs]))):
-                    try:
-                        ret = vcs(blocking)
-                        if ret is not None:
-                            needsleep = False
-                            if ret:
-                                packages.append(vcs.cpv)
-                            all_count[0] += 1
-                            del processes[i]
-                    except KeyboardInterrupt:
-                        raise
-                    except Exception as e:
-                        if opts.debug:
-                            raise
-                        out.err(
-                            "Error updating %s: [%s] %s"
-                            % (vcs.cpv, e.__class__.__name__, e)
-                        )
-                        erraneous.append(vcs.cpv)
-                        del processes[i]
-                        cache[str(vcs)] = e
-                return needsleep
-
-            filters = (opts.filter_packages or []) + (cliargs or [])
-            filt = PackageFilter(filters)
-            getvcs = VCSLoader(remote_only=opts.remote_only)
+    def package_checks(self, pm, pkg):
+        """Create the VCS instances for the installed package `pkg'.
+        Returns a list of (eclass, VCS instance) tuples."""
+        opts = self.opts
+        ret = []
+        # read the variables for all matching VCS-es in a single pass
+        # over the environment file
+        keys = set()
+        for eclass in pkg.inherits:
+            vcscl = self.getvcs(eclass, self.allowed)
+            if vcscl is not None:
+                keys.update(env_keys(vcscl))
+        with timers("environ"):
+            environ = PackageEnviron(pkg, keys)
+        for eclass in pkg.inherits:
+            vcscl = self.getvcs(eclass, self.allowed)
+            if vcscl is None:
+                continue
+            try:
+                with timers("vcs_init"), tracer.span("enumerate", package=str(pkg)):
+                    vcs = vcscl(
+                        str(pkg.slotted_atom),
+                        environ=environ,
+                        opts=opts,
+                        cache=self.cache,
+                        mirrors=self.mirror_log,
+                    )
+            except OtherEclass:
+                continue
+            vcs.root = pm.root
+            if opts.adaptive_timeout:
+                vcs.timeout = self.latency.timeout(
+                    str(vcs),
+                    opts.vcs_timeouts.get(eclass, vcs.default_timeout),
+                    opts.timeout_factor,
+                    opts.timeout_min,
+                    opts.timeout_max,
+                )
+            ret.append((eclass, vcs))
+        return ret
 
+    def schedule(self, eclass, vcs, pkgkey):
+        """Queue the check `vcs', unless it is skipped, deferred or past
+        the deadline."""
+        opts = self.opts
+        if self.failures.skip(str(vcs)):
+            f = self.failures[str(vcs)]
+            out.event("skip", vcs, failures=f["count"], error=f["error"])
+            self.skipped.append((vcs.cpv, str(vcs)))
+            if opts.skipped_erraneous:
+                self.erraneous.append((vcs.root, vcs.cpv))
+            return
+        if opts.adaptive_checks and not self.check_due(vcs, pkgkey):
+            out.event("defer", vcs, probability=self.changes.probability(str(vcs)))
+            self.deferred.append((vcs.cpv, str(vcs)))
+            return
+        if self.past_deadline():
+            self.unchecked.append((vcs.cpv, str(vcs)))
+            return
+        out.event("queue", vcs)
+        if self.forge is not None and self.forge.accepts(vcs):
+            self.forge.submit(vcs)
+        elif self.coordinator is not None and self.coordinator.accepts(vcs):
+            self.coordinator.submit(eclass, vcs)
+        else:
+            self.enqueue(vcs, first=str(vcs) in self.unchecked_prev)
+
+    def enumerate_checks(self):
+        """Enumerate the installed live packages and queue their checks,
+        running the main loop in the meantime. Yields the results."""
+        for pm, pkg in timers.iter("enumerate", enumerate_roots(self.pms, self.filt)):
             try:
-                for pkg in pm.installed.filter(filt):
-                    try:
-                        for vcs in pkg.inherits:
-                            vcscl = getvcs(vcs, allowed)
-                            if vcscl is not None:
-                                try:
-                                    vcs = vcscl(
-                                        str(pkg.slotted_atom),
-                                        environ=pkg.environ,
-                                        opts=opts,
-                                        cache=cache,
-                                    )
-                                except OtherEclass:
-                                    pass
-                                else:
-                                    processes.append(vcs)
-                                    loop_iter()
-                    except KeyboardInterrupt:
-                        raise
-                    except NonLiveEbuild as e:
-                        out.s2("[%s]" % pkg.slotted_atom)
-                        out.s3("%s%s%s" % (out.brown, e, out.reset))
-                    except Exception as e:
-                        if opts.debug:
-                            raise
-                        out.err(
-                            "Error enumerating %s: [%s] %s"
-                            % (pkg, e.__class__.__name__, e)
-                        )
-                        erraneous.append(str(pkg.slotted_atom))
-
-                while processes:
-                    if loop_iter((opts.jobs == 1)):
-                        time.sleep(0.3)
+                for eclass, vcs in self.package_checks(pm, pkg):
+                    self.schedule(eclass, vcs, pkg.key)
+                    self.loop_iter()
+                    yield from self.flush_results()
             except KeyboardInterrupt:
-                out.err("Updates interrupted, proceeding with already updated repos.")
-                for vcs in processes:
-                    del vcs
+                raise
+            except NonLiveEbuild as e:
+                # the package can not (or does not need to) be checked
+                self.record_nonlive(pkg.slotted_atom, e)
+            except Exception as e:
+                if self.opts.debug:
+                    raise
+                out.event(
+                    "error",
+                    package=str(pkg),
+                    phase="enumerate",
+                    exception=e.__class__.__name__,
+                    message=str(e),
+                )
+                self.erraneous.append((pm.root, str(pkg.slotted_atom)))
+                self.results.results.append(
+                    CheckResult(
+                        root=pm.root,
+                        atom=str(pkg.slotted_atom),
+                        changed=False,
+                        error=str(e),
+                        duration=0,
+                        skipped=False,
+                    )
+                )
+                yield from self.flush_results()
 
-            if cliargs:
-                nm = set(filt.nonmatched)
-                for i, el in enumerate(cliargs):
-                    if el not in nm:
-                        del cliargs[i]
+    def pending(self):
+        """Check whether any checks are still queued or running."""
+        return bool(
+            self.processes
+            or (self.coordinator is not None and self.coordinator.pending)
+            or (self.forge is not None and self.forge.pending)
+        )
 
-            if childpid == 0:
-                pdata = {
-                    "packages": packages,
-                    "erraneous": erraneous,
-                    "all_count": all_count,
-                }
-                pipe = os.fdopen(commpipe[1], "wb")
-                pickle.dump(pdata, pipe, pickle.HIGHEST_PROTOCOL)
-                pipe.flush()
-                pipe.close()
-                os._exit(0)
-        else:
-            os.close(commpipe[1])
-            pipe = os.fdopen(commpipe[0], "rb")
-            sigint = signal.getsignal(signal.SIGINT)
-            signal.signal(signal.SIGINT, signal.SIG_IGN)
-            try:
-                pdata = pickle.load(pipe)
-            except EOFError:  # child terminated early
-                raise SLRFailure("")
+    def cancel_checks(self):
+        """Terminate all the remaining checks, marking them unchecked."""
+        for vcs in self.processes:
+            vcs.release()
+            tracer.release(vcs)
+            self.unchecked.append((vcs.cpv, str(vcs)))
+        self.processes.clear()
+        if self.coordinator is not None:
+            for vcs in self.coordinator.cancel():
+                self.unchecked.append((vcs.cpv, str(vcs)))
+        if self.forge is not None:
+            for vcs in self.forge.cancel():
+                self.unchecked.append((vcs.cpv, str(vcs)))
+
+    def wait_checks(self):
+        """Run the main loop until all the checks finish (or the deadline
+        passes). Yields the results."""
+        opts = self.opts
+        while self.pending():
+            if (
+                self.deadline is not None
+                and time.time() > self.deadline + opts.deadline_grace
+            ):
+                out.clear_status()
+                out.err("Deadline reached, terminating the remaining checks.")
+                self.cancel_checks()
+                break
+            if self.loop_iter(
+                self.jobs == 1 and bool(self.processes) and self.deadline is None
+            ):
+                time.sleep(0.3)
+            yield from self.flush_results()
+
+    def check_all(self):
+        """Perform all the checks. Yields the results."""
+        interrupted = False
+        try:
+            yield from self.enumerate_checks()
+            yield from self.wait_checks()
+        except KeyboardInterrupt:
+            out.clear_status()
+            out.err("Updates interrupted, proceeding with already updated repos.")
+            for vcs in self.processes:
+                vcs.release()
+            self.processes.clear()
+            interrupted = True
+        finally:
+            if self.coordinator is not None:
+                self.coordinator.close()
+            if self.forge is not None:
+                self.forge.close()
+            if isinstance(self.cache, SharedCache):
+                self.cache.close()
+            # wait for the terminated processes, sharing the grace period
+            reaper.finish()
+        if not interrupted and not self.unchecked:
+            self.journal.complete()
+        self.journal.close()
+        out.close_status()
+        out.event(
+            "timing",
+            phase="update",
+            duration=time.time() - self.starttime,
+            checked=sum(self.all_count.values()),
+            changed=len(self.rebuild),
+            errors=len(self.erraneous),
+        )
+
+        nm = set(self.filt.nonmatched)
+        self.unmatched = [el for el in self.filters if el in nm]
+
+    def send_state(self):
+        """Pass the results and the updated state to the parent process,
+        and terminate the child process."""
+        pdata = {
+            "rebuild": self.rebuild,
+            "erraneous": self.erraneous,
+            "all_count": self.all_count,
+            "skipped": self.skipped,
+            "unchecked": self.unchecked,
+            "failures": dict(self.failures) if self.failures.modified else None,
+            "latency": dict(self.latency) if self.latency.modified else None,
+            "changes": (
+                dict(self.changes)
+                if self.changes is not None and self.changes.modified
+                else None
+            ),
+            "deferred": self.deferred,
+            "forge": dict(self.forge_cache) if self.forge_cache is not None else None,
+            "mirrors": (
+                dict(self.mirror_log)
+                if self.mirror_log is not None and self.mirror_log.modified
+                else None
+            ),
+            "unmatched": self.unmatched,
+            "profile": profiling.collect(),
+            "trace": tracer.events,
+        }
+        out.close()
+        pickle.dump(("done", pdata), self._pipe, pickle.HIGHEST_PROTOCOL)
+        self._pipe.flush()
+        self._pipe.close()
+        os._exit(0)
+
+    def receive(self):
+        """Yield the results passed by the child process, and merge
+        its state."""
+        os.close(self._commpipe[1])
+        pipe = os.fdopen(self._commpipe[0], "rb")
+        sigint = signal.getsignal(signal.SIGINT)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        try:
+            while True:
+                try:
+                    kind, pdata = pickle.load(pipe)
+                except EOFError:  # child terminated early
+                    raise SLRFailure("")
+                if kind == "done":
+                    break
+                yield pdata
+        finally:
             signal.signal(signal.SIGINT, sigint)
-            packages = pdata["packages"]
-            erraneous = pdata["erraneous"]
-            all_count = pdata["all_count"]
+        self.rebuild = pdata["rebuild"]
+        self.erraneous = pdata["erraneous"]
+        self.all_count = pdata["all_count"]
+        self.skipped = pdata["skipped"]
+        self.unchecked = pdata["unchecked"]
+        self.unmatched = pdata["unmatched"]
+        if pdata["failures"] is not None:
+            self.failures.clear()
+            self.failures.update(pdata["failures"])
+        if pdata["latency"] is not None:
+            self.latency.update(pdata["latency"])
+        if pdata["changes"] is not None:
+            self.changes.update(pdata["changes"])
+        self.deferred = pdata["deferred"]
+        if pdata["forge"] is not None:
+            self.forge_cache.clear()
+            self.forge_cache.update(pdata["forge"])
+        if pdata["mirrors"] is not None:
+            self.mirror_log.update(pdata["mirrors"])
+        profiling.merge(pdata["profile"])
+        tracer.merge(pdata["trace"])
 
-    finally:
-        if childpid:  # make sure that we leave no orphans
-            if childpid not in dead_children:
-                os.kill(childpid, signal.SIGTERM)
-            signal.signal(signal.SIGCHLD, old_chld)
+    def save_state(self):
+        """Save the state files."""
+        self.failures.save()
+        self.latency.save()
+        if self.changes is not None:
+            self.changes.save()
+        if self.forge_cache is not None:
+            self.forge_cache.save()
+        if self.mirror_log is not None:
+            self.mirror_log.save()
+        if self.unchecked or self.unchecked_prev:
+            self.unchecked_prev.clear()
+            self.unchecked_prev.update((key, cpv) for cpv, key in self.unchecked)
+            self.unchecked_prev.save()
 
-    if opts.erraneous_merge and len(erraneous) > 0:
-        packages.extend(erraneous)
+    def finish(self):
+        """Verify the packages to rebuild, report the results and set
+        the result attributes."""
+        opts = self.opts
+        pms = self.pms
+        rebuild = list(self.rebuild)
+        if opts.erraneous_merge and len(self.erraneous) > 0:
+            rebuild.extend(self.erraneous)
+
+        ret = {}
+        for pm in pms:
+            ret[pm.root] = finish_root(
+                opts,
+                pm,
+                [p for r, p in rebuild if r == pm.root],
+                multiroot=len(pms) > 1,
+            )
+
+        if self.skipped:
+            out.err("Skipped %d repositories failing repeatedly:" % len(self.skipped))
+            now = time.time()
+            for cpv, key in self.skipped:
+                f = self.failures[key]
+                out.s2("[%s] %s" % (cpv, key))
+                out.s3(
+                    "%s%d failures in a row%s, last: %s (next check in %s)"
+                    % (
+                        out.brown,
+                        f["count"],
+                        out.reset,
+                        f["error"],
+                        format_duration(
+                            self.failures.retry_time(key) - (now - f["time"])
+                        ),
+                    )
+                )
+
+        if self.deferred:
+            out.s1(
+                "Did not check %s%d%s packages unlikely to have changed."
+                % (out.white, len(self.deferred), out.s1reset)
+            )
+
+        if self.unchecked:
+            out.err(
+                "Deadline reached, %d repositories were not checked "
+                "(they will be checked first in the next run):" % len(self.unchecked)
+            )
+            for cpv, key in self.unchecked:
+                out.s2("[%s] %s" % (cpv, key))
+
+        for pm in pms:
+            packages = ret[pm.root]
+            where = " in %s" % pm.root if len(pms) > 1 else ""
+            if len(packages) < 1:
+                out.result(
+                    "No updates found%s (in %s%d%s live packages)"
+                    % (where, out.white, self.all_count[pm.root], out.s1reset)
+                )
+            else:
+                out.result(
+                    "Found %s%d%s packages to rebuild%s (out of %s%d%s live packages)."
+                    % (
+                        out.white,
+                        len(packages),
+                        out.s1reset,
+                        where,
+                        out.white,
+                        self.all_count[pm.root],
+                        out.s1reset,
+                    )
+                )
+
+        if opts.trace_file:
+            tracer.save(opts.trace_file)
+        self.packages = ret
+
+
+def finish_root(opts, pm, packages, multiroot=False):
+    """Verify the packages to rebuild in the ROOT of `pm' and call
+    quickpkg if requested."""
 
     # Check portdb for matches. Drop unmatched packages.
-    for p in list(packages):
-        if pm.Atom(p) not in pm.stack:
-            out.err("No packages matching %s in portdb, skipping." % p)
-            packages.remove(p)
+    with timers("portdb"), tracer.span("portdb", root=pm.root):
+        for p in list(packages):
+            if pm.Atom(p) not in pm.stack:
+                out.err("No packages matching %s in portdb, skipping." % p)
+                packages.remove(p)
 
     if not opts.pretend and opts.quickpkg and len(packages) >= 1:
         out.s1(
@@ -218,24 +1070,10 @@ option.
         cmd.append("--include-config=y")
         cmd.extend(packages)
         out.s2(" ".join(cmd))
-        subprocess.Popen(cmd, stdout=sys.stderr).wait()
-
-    if len(packages) < 1:
-        out.result(
-            "No updates found (in %s%d%s live packages)"
-            % (out.white, all_count[0], out.s1reset)
-        )
-    else:
-        out.result(
-            "Found %s%d%s packages to rebuild (out of %s%d%s live packages)."
-            % (
-                out.white,
-                len(packages),
-                out.s1reset,
-                out.white,
-                all_count[0],
-                out.s1reset,
-            )
-        )
+        env = None
+        if multiroot:
+            env = dict(os.environ, ROOT=pm.root, PORTAGE_CONFIGROOT=pm.root)
+        with timers("quickpkg"), tracer.span("quickpkg", root=pm.root):
+            subprocess.Popen(cmd, stdout=sys.stderr, env=env).wait()
 
     return packages
@@ -0,0 +1,450 @@
+# 	vim:fileencoding=utf-8:noet
+# (c) 2026 Michał Górny <mgorny@gentoo.org>
+# Released under the terms of the 2-clause BSD license.
+
+"""Distributing repository checks across multiple worker processes.
+
+The coordinator (the regular smart-live-rebuild run) sends check
+descriptors to the workers, one JSON object per line:
+
+	{"id": 1, "eclass": "git-r3", "cpv": "dev-libs/foo:0", "env": {...}}
+
+The worker (smart-live-rebuild --worker) performs the checks
+and replies with the new revision or the error, as soon as each check
+finishes:
+
+	{"id": 1, "rev": "0123abcd..."}
+	{"id": 2, "error": "update command returned non-zero result",
+		"exception": "Exception"}
+
+Workers are either commands (usually 'ssh host smart-live-rebuild
+--worker') communicating through stdin/stdout, or local sockets
+(unix:/path) served by 'smart-live-rebuild --worker --worker-socket
+/path'.
+
+The checks of two local git repositories, distributed between two
+local workers:
+
+>>> import multiprocessing, tempfile
+>>> from smartliverebuild.config import Config
+>>> from smartliverebuild.vcs.git_r3 import GitR3Support
+>>> class PMConfig(object):
+...     userpriv_enabled = False
+>>> config = Config(PMConfig())
+>>> config.apply_dict({'config_file': ''})
+>>> config.parse_configfiles()
+>>> opts = config.get_options()
+>>> tmp = tempfile.TemporaryDirectory()
+>>> def git_repo(name):
+...     path = os.path.join(tmp.name, name)
+...     git = ['git', '-C', path, '-c', 'user.name=t', '-c', 'user.email=t@t']
+...     subprocess.check_call(['git', 'init', '--quiet', path])
+...     subprocess.check_call(git + ['commit', '--quiet', '--allow-empty', '-m', 'x'])
+...     return (path, subprocess.check_output(git + ['rev-parse', 'HEAD'], text=True))
+>>> def git_r3(cpv, uri):
+...     env = SavedEnviron(EGIT_REPO_URI=uri, EGIT_VERSION='0' * 40)
+...     return GitR3Support(cpv, environ=env, opts=opts, cache=CheckCache())
+
+>>> specs = []
+>>> workers = []
+>>> for i in range(2):
+...     opts.worker_socket = os.path.join(tmp.name, 'worker%d.sock' % i)
+...     specs.append('unix:' + opts.worker_socket)
+...     workers.append(multiprocessing.get_context('fork').Process(
+...         target=worker_main, args=(opts,)))
+...     workers[-1].start()
+>>> while not all(os.path.exists(s[5:]) for s in specs):
+...     time.sleep(0.1)
+
+>>> foo, foo_rev = git_repo('foo')
+>>> bar, bar_rev = git_repo('bar')
+>>> fallback = []
+>>> coordinator = Coordinator(specs, fallback.append)
+>>> for cpv, uri in (('dev-libs/foo:0', foo), ('dev-libs/foo-data:0', foo),
+...         ('dev-libs/bar:0', bar), ('dev-libs/gone:0', foo + '-gone')):
+...     coordinator.submit('git-r3', git_r3(cpv, uri))
+>>> [len(w.pending) for w in coordinator._workers]
+[2, 1]
+>>> results = {}
+>>> while coordinator.pending:
+...     results.update((v.cpv, r) for v, r in coordinator.poll(0.1))
+>>> results['dev-libs/foo:0'] == results['dev-libs/foo-data:0'] == foo_rev.strip()
+True
+>>> results['dev-libs/bar:0'] == bar_rev.strip()
+True
+>>> results['dev-libs/gone:0']
+WorkerError('[Exception] update command returned non-zero result')
+>>> fallback
+[]
+
+>>> coordinator.close()
+>>> for w in workers:
+...     w.terminate()
+...     w.join()
+
+A worker that does not answer within the timeout of the check is
+stopped, and the check is reassigned (here, performed locally):
+
+>>> coordinator = Coordinator(['exec sleep 60'], fallback.append)
+>>> coordinator.reply_margin = 0
+>>> vcs = git_r3('dev-libs/foo:0', foo)
+>>> vcs.timeout = 0.5
+>>> coordinator.submit('git-r3', vcs)
+>>> while coordinator.pending:
+...     _ = coordinator.poll(0.1)
+>>> fallback == [vcs]
+True
+>>> coordinator.close()
+>>> reaper.finish()
+>>> tmp.cleanup()
+"""
+
+import json, os, select, socket, subprocess, time
+
+from .output import out
+from .revcache import SharedCache
+from .vcs import CheckCache, RemoteVCSSupport, reaper
+from .vcsload import VCSLoader
+
+
+class WorkerError(Exception):
+    """An error reported by the worker for a particular check."""
+
+    pass
+
+
+class SavedEnviron(dict):
+    """A dict providing the environment accessor interface used
+    by the VCS classes."""
+
+    def copy(self, *keys):
+        return dict((k, self.get(k, "")) for k in keys)
+
+
+class LineReader(object):
+    """Split the data read from a file descriptor into lines."""
+
+    def __init__(self, fd):
+        self.fd = fd
+        self.eof = False
+        self._buf = b""
+
+    def read(self):
+        """Read the available data and return the list of complete
+        lines. Sets .eof when the other end has been closed."""
+        try:
+            data = os.read(self.fd, 65536)
+        except OSError:
+            data = b""
+        if not data:
+            self.eof = True
+            return []
+        self._buf += data
+        lines = self._buf.split(b"\n")
+        self._buf = lines.pop()
+        return [json.loads(l.decode("UTF-8")) for l in lines if l.strip()]
+
+
+def serve(opts, infd, outf):
+    """Perform the checks requested on `infd', writing the results
+    to `outf' as they are finished. Returns when the input is closed
+    and all the checks are done."""
+
+    getvcs = VCSLoader(remote_only=True)
+    reader = LineReader(infd)
+    cache = (
+        SharedCache(opts.revcache, secret=opts.revcache_secret)
+        if opts.revcache
+        else CheckCache()
+    )
+    processes = []
+
+    def reply(**kwargs):
+        outf.write(json.dumps(kwargs) + "\n")
+        outf.flush()
+
+    while not reader.eof or processes:
+        idle = not processes
+        if not reader.eof:
+            r = select.select([infd], [], [], None if idle else 0.1)[0]
+            if r:
+                for d in reader.read():
+                    try:
+                        vcscl = getvcs(d["eclass"])
+                        if vcscl is None:
+                            raise NotImplementedError(
+                                "VCS eclass %s not supported" % d["eclass"]
+                            )
+                        vcs = vcscl(
+                            d["cpv"],
+                            environ=SavedEnviron(d["env"]),
+                            opts=opts,
+                            cache=cache,
+                        )
+                    except Exception as e:
+                        reply(id=d["id"], error=str(e), exception=e.__class__.__name__)
+                    else:
+                        vcs.timeout = d.get("timeout", opts.timeout)
+                        processes.append((d["id"], vcs))
+        elif processes:
+            time.sleep(0.1)
+
+        reaper.poll()
+        for i, (jobid, vcs) in reversed(list(enumerate(processes[: opts.jobs]))):
+            try:
+                if vcs() is None:
+                    continue
+            except Exception as e:
+                cache[str(vcs)] = e
+                reply(id=jobid, error=str(e), exception=e.__class__.__name__)
+            else:
+                reply(id=jobid, rev=cache[str(vcs)])
+            del processes[i]
+
+    reaper.finish()
+    if isinstance(cache, SharedCache):
+        cache.close()
+
+
+def worker_main(opts):
+    """The entry point for smart-live-rebuild --worker."""
+
+    out.silence()
+    out.sinks = []
+
+    if not opts.worker_socket:
+        outf = os.fdopen(os.dup(1), "w")
+        # keep any stray output away from the result stream
+        os.dup2(2, 1)
+        serve(opts, 0, outf)
+        return 0
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    if os.path.exists(opts.worker_socket):
+        os.unlink(opts.worker_socket)
+    sock.bind(opts.worker_socket)
+    sock.listen(16)
+    try:
+        while True:
+            conn = sock.accept()[0]
+            if os.fork() == 0:
+                sock.close()
+                serve(opts, conn.fileno(), conn.makefile("w"))
+                os._exit(0)
+            conn.close()
+            try:
+                while os.waitpid(-1, os.WNOHANG)[0] != 0:
+                    pass
+            except ChildProcessError:
+                pass
+    except KeyboardInterrupt:
+        pass
+    finally:
+        os.unlink(opts.worker_socket)
+    return 0
+
+
+class Worker(object):
+    """A connection to a single worker."""
+
+    def __init__(self, spec):
+        self.spec = spec
+        # job id -> (eclass, VCS instance, the time it was sent)
+        self.pending = {}
+        self.lastreply = time.time()
+        self._proc = None
+        self._sock = None
+
+        if spec.startswith("unix:"):
+            self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self._sock.connect(spec[5:])
+            fd = self._sock.fileno()
+            self._outf = self._sock.makefile("w")
+        else:
+            self._proc = subprocess.Popen(
+                spec,
+                shell=True,
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                text=True,
+            )
+            fd = self._proc.stdout.fileno()
+            self._outf = self._proc.stdin
+        self.reader = LineReader(fd)
+
+    @property
+    def alive(self):
+        return not self.reader.eof
+
+    def send(self, jobid, eclass, vcs):
+        self.pending[jobid] = (eclass, vcs, time.time())
+        try:
+            self._outf.write(
+                json.dumps(
+                    {
+                        "id": jobid,
+                        "eclass": eclass,
+                        "cpv": vcs.cpv,
+                        "env": vcs.env,
+                        "timeout": vcs.timeout,
+                    }
+                )
+                + "\n"
+            )
+            self._outf.flush()
+        except (OSError, ValueError):
+            self.reader.eof = True
+
+    def read(self):
+        """Read the replies available."""
+        ret = self.reader.read()
+        if ret:
+            self.lastreply = time.time()
+        return ret
+
+    def stalled(self, margin):
+        """Check whether any of the pending checks has not been answered
+        within its timeout plus `margin' seconds. The time is counted
+        since the check was sent, or since the last reply of the worker
+        (as the checks may be queued behind the ones in progress)."""
+        now = time.time()
+        for eclass, vcs, sent in self.pending.values():
+            if (
+                vcs.timeout
+                and now - max(sent, self.lastreply) > float(vcs.timeout) + margin
+            ):
+                return True
+        return False
+
+    def close(self, terminate=False):
+        self.reader.eof = True
+        try:
+            self._outf.close()
+        except OSError:
+            pass
+        if self._proc is not None:
+            if terminate:
+                reaper.stop(self._proc)
+            else:
+                self._proc.wait()
+            self._proc = None
+        if self._sock is not None:
+            self._sock.close()
+
+
+class Coordinator(object):
+    """Distribute the remote-capable checks among the workers
+    and collect the results.
+
+    `fallback' is called with the VCS instance of every check that can
+    not be performed by any worker (because all of them are gone).
+
+    A worker which does not answer a check within its timeout plus
+    `reply_margin' seconds is considered hung. It is stopped, and its
+    checks are reassigned.
+    """
+
+    reply_margin = 30
+
+    def __init__(self, specs, fallback):
+        self._fallback = fallback
+        self._workers = []
+        self._jobid = 0
+        # repo key -> list of VCS instances waiting for the result
+        self._waiting = {}
+        self._results = {}
+        self._cancelled = False
+
+        for spec in specs:
+            try:
+                self._workers.append(Worker(spec))
+            except (OSError, socket.error) as e:
+                out.err("Unable to start worker %s: %s" % (spec, e))
+
+    def accepts(self, vcs):
+        """Check whether the VCS check can be performed remotely."""
+        return (
+            isinstance(vcs, RemoteVCSSupport)
+            and vcs.portable
+            and any(w.alive for w in self._workers)
+        )
+
+    @property
+    def pending(self):
+        return bool(self._waiting)
+
+    def submit(self, eclass, vcs):
+        """Queue a check for the given VCS instance."""
+        key = str(vcs)
+        vcs.starttime = time.time()
+        if key in self._results:
+            self._waiting[key] = [vcs]
+            return
+        if key in self._waiting:
+            self._waiting[key].append(vcs)
+            return
+        self._waiting[key] = [vcs]
+        self._dispatch(eclass, vcs)
+
+    def _dispatch(self, eclass, vcs):
+        alive = [w for w in self._workers if w.alive]
+        if not alive:
+            for v in self._waiting.pop(str(vcs)):
+                self._fallback(v)
+            return
+        w = min(alive, key=lambda w: len(w.pending))
+        self._jobid += 1
+        out.event("start", vcs, command="(on worker %s)" % w.spec)
+        w.send(self._jobid, eclass, vcs)
+
+    def poll(self, timeout=0):
+        """Collect the finished checks. Returns a list of (vcs, result)
+        tuples, where result is either the new revision or an exception.
+        """
+
+        ret = []
+        for key in [k for k in self._waiting if k in self._results]:
+            for v in self._waiting.pop(key):
+                ret.append((v, self._results[key]))
+
+        fds = dict((w.reader.fd, w) for w in self._workers if w.alive)
+        if fds:
+            for fd in select.select(list(fds), [], [], timeout)[0]:
+                w = fds[fd]
+                for r in w.read():
+                    eclass, vcs, sent = w.pending.pop(r["id"])
+                    key = str(vcs)
+                    if "error" in r:
+                        res = WorkerError("[%s] %s" % (r["exception"], r["error"]))
+                    else:
+                        res = r["rev"]
+                    self._results[key] = res
+                    for v in self._waiting.pop(key, ()):
+                        ret.append((v, res))
+
+        for w in self._workers:
+            if w.alive and w.stalled(self.reply_margin):
+                out.err("Worker %s does not reply, reassigning its checks." % w.spec)
+                w.close(terminate=True)
+            elif not w.alive and w.pending:
+                out.err("Worker %s terminated, reassigning its checks." % w.spec)
+            if not w.alive and w.pending:
+                pending = list(w.pending.values())
+                w.pending.clear()
+                for eclass, vcs, sent in pending:
+                    self._dispatch(eclass, vcs)
+        return ret
+
+    def cancel(self):
+        """Drop all the pending checks. Returns the list of VCS
+        instances which were waiting for the results."""
+        ret = [v for vl in self._waiting.values() for v in vl]
+        self._waiting.clear()
+        for w in self._workers:
+            w.pending.clear()
+        self._cancelled = True
+        return ret
+
+    def close(self):
+        for w in self._workers:
+            w.close(terminate=self._cancelled)
@@ -0,0 +1,257 @@
+# 	vim:fileencoding=utf-8:noet
+# (c) 2026 Michał Górny <mgorny@gentoo.org>
+# Released under the terms of the 2-clause BSD license.
+
+"""Reading the variables from the saved ebuild environment.
+
+Instead of querying the package manager for every variable (which may
+decompress and parse the environment file, or even spawn bash, every
+time), the environment file is read once per package and only
+the variable declarations are parsed. The variables used by all
+the VCS classes matching the package are read in a single pass, which
+stops as soon as all of them are found. The function bodies are skipped
+without parsing.
+
+>>> import io
+>>> f = io.StringIO('''declare -x A="foo bar"
+... declare -- B="multi
+... line \\\\"quoted\\\\" \\\\$x"
+... declare -a C=([0]="one" [1]="two")
+... declare -- D=$'tab\\\\there'
+... E=plain
+... declare -- F
+... foo ()
+... {
+...     H=unreachable;
+...     cat <<EOF
+... I=unreachable
+... EOF
+...
+... }
+... declare -x G="after"
+... ''')
+>>> d = parse_environ(f, ['A', 'B', 'C', 'D', 'E', 'F', 'G', 'H', 'I'])
+>>> d['A'], d['C'], d['D'], d['E'], d['F'], d['G']
+('foo bar', 'one two', 'tab\\there', 'plain', '', 'after')
+>>> print(d['B'])
+multi
+line "quoted" $x
+>>> sorted(d)
+['A', 'B', 'C', 'D', 'E', 'F', 'G']
+>>> parse_environ(io.StringIO('declare -- A="x"\\ndeclare -- B="y"\\n'), ['A'])
+{'A': 'x'}
+>>> parse_environ(io.StringIO('declare -- B="y\\ndeclare -- A=no"\\nA=yes\\n'), ['A'])
+{'A': 'yes'}
+"""
+
+import bz2, os, os.path, re
+
+decl_re = re.compile(r"^(?:declare\s+-\S*\s+)?([A-Za-z_][A-Za-z0-9_]*)(?:=|\s*$)")
+func_re = re.compile(r"^[^\s=]+\s*\(\)\s*\{?\s*$")
+# the values which are complete within a single line
+simple_value_re = re.compile(
+    r"""^(?:"(?:[^"\\]|\\.)*"|'[^']*'|\$'(?:[^'\\]|\\.)*'|[^"'$\\]*)$"""
+)
+
+ansi_c_escapes = {
+    "a": "\a",
+    "b": "\b",
+    "e": "\033",
+    "E": "\033",
+    "f": "\f",
+    "n": "\n",
+    "r": "\r",
+    "t": "\t",
+    "v": "\v",
+}
+
+
+class ValueReader(object):
+    """Read a bash value, pulling the continuation lines from `lines'
+    when a quoted string spans multiple lines."""
+
+    def __init__(self, buf, lines):
+        self.buf = buf
+        self.pos = 0
+        self.lines = lines
+
+    def peek(self):
+        if self.pos >= len(self.buf):
+            return ""
+        return self.buf[self.pos]
+
+    def getc(self, quoted=False):
+        """Get the next character. Inside a quoted string, the next
+        line is read when the current one is exhausted."""
+        if self.pos >= len(self.buf):
+            if not quoted:
+                return ""
+            line = next(self.lines, None)
+            if line is None:
+                return ""
+            self.buf = line
+            self.pos = 0
+            return "\n"
+        c = self.buf[self.pos]
+        self.pos += 1
+        return c
+
+    def word(self):
+        """Read a single (possibly quoted) word."""
+        ret = []
+        while True:
+            c = self.peek()
+            if c in ("", " ", "\t", "\n", ")"):
+                return "".join(ret)
+            self.pos += 1
+            if c == '"':
+                while True:
+                    c = self.getc(True)
+                    if c in ("", '"'):
+                        break
+                    if c == "\\":
+                        n = self.getc(True)
+                        if n == "\n":
+                            continue
+                        if n not in ("$", "`", '"', "\\"):
+                            ret.append(c)
+                        c = n
+                    ret.append(c)
+            elif c == "'":
+                while True:
+                    c = self.getc(True)
+                    if c in ("", "'"):
+                        break
+                    ret.append(c)
+            elif c == "$" and self.peek() == "'":
+                self.pos += 1
+                while True:
+                    c = self.getc(True)
+                    if c in ("", "'"):
+                        break
+                    if c == "\\":
+                        n = self.getc(True)
+                        c = ansi_c_escapes.get(n, n)
+                    ret.append(c)
+            elif c == "\\":
+                ret.append(self.getc())
+            else:
+                ret.append(c)
+
+    def value(self):
+        """Read the value of a declaration. The elements of arrays
+        are joined using spaces."""
+        if self.peek() != "(":
+            return self.word()
+        self.pos += 1
+        ret = []
+        while True:
+            c = self.peek()
+            if c == "":
+                line = next(self.lines, None)
+                if line is None:
+                    break
+                self.buf = line
+                self.pos = 0
+            elif c in (" ", "\t"):
+                self.pos += 1
+            elif c == ")":
+                break
+            else:
+                if c == "[":
+                    self.pos = self.buf.index("]=", self.pos) + 2
+                ret.append(self.word())
+        return " ".join(ret)
+
+
+def parse_environ(f, keys):
+    """Parse the variable declarations for `keys' from the environment
+    file `f' (an iterable of lines). Returns a dict of the variables
+    found."""
+
+    keys = frozenset(keys)
+    ret = {}
+    lines = (l.rstrip("\n") for l in f)
+    for l in lines:
+        m = decl_re.match(l)
+        if m is None:
+            if func_re.match(l):
+                # skip the function body, up to the closing brace
+                for l in lines:
+                    if l.rstrip() == "}":
+                        break
+            continue
+        name = m.group(1)
+        rest = l[m.end() :]
+        if name in keys:
+            ret[name] = ValueReader(rest, lines).value()
+            if len(ret) == len(keys):
+                break
+        elif not simple_value_re.match(rest):
+            # skip the value, it may span multiple lines
+            ValueReader(rest, lines).value()
+    return ret
+
+
+def environment_path(pkg):
+    """Get the path to the saved environment of installed package `pkg',
+    or None if not available."""
+
+    p = pkg.path
+    if p is None or not os.path.isdir(p):
+        return None
+    paths = []
+    for fn in ("environment.bz2", "environment"):
+        try:
+            paths.append((os.path.getmtime(os.path.join(p, fn)), fn))
+        except OSError:
+            pass
+    if not paths:
+        return None
+    return os.path.join(p, max(paths)[1])
+
+
+def env_keys(vcscl):
+    """Get the environment variables used by VCS class `vcscl'."""
+    keys = []
+    for attr in ("reqenv", "optenv"):
+        v = getattr(vcscl, attr)
+        # properties are computed per instance, PackageEnviron falls
+        # back to the package manager for them
+        if isinstance(v, (list, tuple)):
+            keys.extend(v)
+    return keys
+
+
+class PackageEnviron(object):
+    """The environment accessor for an installed package, reading
+    the variables `keys' from the saved environment in a single pass.
+    The variables outside `keys', and all of them if the environment
+    file can not be read directly, are obtained from the package
+    manager."""
+
+    def __init__(self, pkg, keys):
+        self._pkg = pkg
+        self._data = {}
+        self._keys = set()
+
+        if not keys:
+            return
+        path = environment_path(pkg)
+        if path is None:
+            return
+        opener = bz2.open if path.endswith(".bz2") else open
+        try:
+            with opener(path, "rt", encoding="UTF-8", errors="replace") as f:
+                self._data = parse_environ(f, keys)
+        except (IOError, OSError, EOFError, ValueError):
+            # fall back to the package manager
+            return
+        self._keys.update(keys)
+
+    def copy(self, *keys):
+        missing = [k for k in keys if k not in self._keys]
+        if missing:
+            self._data.update(self._pkg.environ.copy(*missing))
+            self._keys.update(missing)
+        return dict((k, self._data.get(k) or "") for k in keys)
@@ -0,0 +1,75 @@
+# 	vim:fileencoding=utf-8:noet
+# (c) 2026 Michał Górny <mgorny@gentoo.org>
+# Released under the terms of the 2-clause BSD license.
+
+"""Backing off repositories which keep failing.
+
+The consecutive update failures are recorded per repository. After
+a failure, the repository is not checked again until `backoff' seconds
+pass, and the interval is doubled with every further failure (up to
+`max_backoff'). A successful update resets the count.
+
+>>> log = FailureLog('/nonexistent/failures.json', 3600, 4 * 3600)
+>>> log.failed('git://example.com/foo [HEAD]', 'timeout occured', now=0)
+>>> log.failed('git://example.com/foo [HEAD]', 'timeout occured', now=0)
+>>> log['git://example.com/foo [HEAD]']['count']
+1
+>>> log.retry_time('git://example.com/foo [HEAD]')
+3600
+>>> log['git://example.com/foo [HEAD]']['count'] = 5
+>>> log.retry_time('git://example.com/foo [HEAD]')
+14400
+>>> log.skip('git://example.com/foo [HEAD]', now=7200)
+True
+>>> log.skip('git://example.com/foo [HEAD]', now=14400)
+False
+>>> log.succeeded('git://example.com/foo [HEAD]')
+>>> 'git://example.com/foo [HEAD]' in log
+False
+"""
+
+import time
+
+from .state import StateFile
+
+
+class FailureLog(StateFile):
+    """The consecutive update failures (repo key -> dict of 'count',
+    'time' of the last failure and 'error' message)."""
+
+    def __init__(self, path, backoff, max_backoff):
+        StateFile.__init__(self, path)
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        # the keys updated during the current run
+        self.updated = set()
+
+    def retry_time(self, key):
+        """The time (in seconds since the last failure) after which
+        the repository will be checked again."""
+        return min(self.backoff * 2 ** (self[key]["count"] - 1), self.max_backoff)
+
+    def skip(self, key, now=None):
+        """Check whether the check of the repository should be skipped."""
+        if self.backoff <= 0 or key not in self:
+            return False
+        if now is None:
+            now = time.time()
+        return now - self[key]["time"] < self.retry_time(key)
+
+    def failed(self, key, message, now=None):
+        """Record a failure. Only the first failure of the repository
+        during a run is counted."""
+        if key in self.updated:
+            return
+        self.updated.add(key)
+        count = self[key]["count"] if key in self else 0
+        self[key] = {
+            "count": count + 1,
+            "time": now if now is not None else time.time(),
+            "error": message,
+        }
+
+    def succeeded(self, key):
+        self.updated.add(key)
+        self.pop(key, None)
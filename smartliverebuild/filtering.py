@@ -44,6 +44,38 @@ class PackageFilter(object):
     True
     >>> [f for f in pf.nonmatched]
     ['--pretend', '-avD']
+
+    The same filter used on plain package keys:
+
+    >>> pf = PackageFilter(['f*', '!app-foo/*', 'app-foo/flaggie'])
+    >>> pf.match_key('dev-libs/foo')
+    True
+    >>> pf.match_key('app-foo/foo')
+    False
+    >>> pf.match_key('app-foo/flaggie')
+    True
+    >>> pf.match_key('dev-libs/bar')
+    False
+    >>> [f for f in pf.nonmatched]
+    []
+
+    Categories in which no package could pass the filter can be skipped
+    as a whole:
+
+    >>> pf = PackageFilter(['app-portage/*', '!app-portage/smart-live-rebuild'])
+    >>> pf.category_pass('app-portage')
+    True
+    >>> pf.category_pass('dev-libs')
+    False
+    >>> pf = PackageFilter(['!dev-libs/*', '!x11-*/*', 'x11-libs/libX11'])
+    >>> pf.category_pass('app-portage')
+    True
+    >>> pf.category_pass('dev-libs')
+    False
+    >>> pf.category_pass('x11-base')
+    False
+    >>> pf.category_pass('x11-libs')
+    True
     """
 
     class PackageMatcher(object):
@@ -54,15 +86,17 @@ class PackageFilter(object):
             m = wildcard_re.match(wildcard)
             self.broken = not m
 
-            def makere(s):
-                return re.compile(r"^%s$" % fnmatch.translate(s))
-
             if not self.broken:
                 self.exclusive = bool(m.group(1))
-                self.regexp = re.compile(
-                    r"^%s$"
-                    % fnmatch.translate("%s/%s" % (m.group(2) or "*", m.group(3)))
+                self.pattern = fnmatch.translate(
+                    "%s/%s" % (m.group(2) or "*", m.group(3))
                 )
+                self.regexp = re.compile(r"^%s$" % self.pattern)
+                self.category_regexp = re.compile(
+                    r"^%s$" % fnmatch.translate(m.group(2) or "*")
+                )
+                # matches all packages in the matching categories
+                self.category_wide = m.group(3) == "*"
                 # .matched is used only on inclusive args
                 self.matched = self.exclusive
 
@@ -81,26 +115,72 @@ class PackageFilter(object):
         """Init filters from pattern list."""
         if wlist:
             self._pmatchers = [self.PackageMatcher(w) for w in wlist]
-            for f in self._pmatchers:
-                if not f.broken:
-                    self._default_pass = f.exclusive
-                    return
         else:
             self._pmatchers = ()
-        self._default_pass = True
+        self._valid = [f for f in self._pmatchers if not f.broken]
+        self._default_pass = self._valid[0].exclusive if self._valid else True
+
+        # The result is determined by the last matching filter. Combine
+        # all the filters into a single regexp, in reverse order,
+        # so that the first alternative matching is the one we need.
+        self._combined = self._compile(list(enumerate(self._valid))[::-1])
+        self._pending = [f for f in self._valid if not f.matched]
+        self._pending_re = self._compile(list(enumerate(self._pending)))
+        self._category_cache = {}
+
+    @staticmethod
+    def _compile(matchers):
+        """Compile a list of (index, matcher) pairs into a single regexp
+        whose .lastgroup names the index of the matcher that matched."""
+        if not matchers:
+            return None
+        return re.compile(
+            r"^(?:%s)$" % "|".join("(?P<m%d>%s)" % (i, f.pattern) for i, f in matchers)
+        )
+
+    def _track(self, cp):
+        """Update the .matched flag on inclusive filters."""
+        while self._pending_re is not None:
+            m = self._pending_re.match(cp)
+            if m is None:
+                break
+            self._pending.pop(int(m.lastgroup[1:])).matched = True
+            self._pending_re = self._compile(list(enumerate(self._pending)))
+
+    def match_key(self, cp):
+        """Execute filtering on a package key (category/package name)."""
+        if self._combined is None:
+            return self._default_pass
+        self._track(cp)
+        m = self._combined.match(cp)
+        if m is None:
+            return self._default_pass
+        return not self._valid[int(m.lastgroup[1:])].exclusive
 
     def __call__(self, pkg):
         """Execute filtering on a package."""
-        cp = pkg.key
-        r = self._default_pass
-        for m in self._pmatchers:
-            if m.broken:
-                pass
-            elif m.exclusive:
-                r &= m(cp)
-            else:
-                r |= m(cp)
-        return r
+        return self.match_key(pkg.key)
+
+    def category_pass(self, cat):
+        """Check whether any package in category `cat' could pass
+        the filter. If it returns False, the category can be skipped
+        without enumerating the packages."""
+
+        if cat not in self._category_cache:
+            r = self._default_pass
+            for f in self._valid:
+                if f.category_regexp.match(cat):
+                    if not f.exclusive:
+                        r = True
+                    elif f.category_wide:
+                        r = False
+            self._category_cache[cat] = r
+
+        if self._category_cache[cat]:
+            return True
+        # we still need to see the packages if they could mark
+        # an inclusive filter as matched
+        return any(f.category_regexp.match(cat) for f in self._pending)
 
     @property
     def nonmatched(self):
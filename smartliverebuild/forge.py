@@ -0,0 +1,394 @@
+# 	vim:fileencoding=utf-8:noet
+# (c) 2026 Michał Górny <mgorny@gentoo.org>
+# Released under the terms of the 2-clause BSD license.
+
+"""Resolving the branch heads of forge-hosted git repositories
+through the forge APIs.
+
+Instead of running 'git ls-remote' for every repository, the git-r3
+repositories hosted on GitHub or GitLab instances are collected
+in batches and resolved using the forge APIs. GitHub repositories are
+resolved using a single GraphQL query per batch (which requires
+a token), GitLab repositories using conditional REST API requests
+(the responses are cached using their ETags).
+
+If a repository can not be resolved through the API, it is checked
+using the regular git-r3 support.
+
+>>> parse_repo_uri('https://github.com/projg2/smart-live-rebuild.git')
+('github.com', 'projg2/smart-live-rebuild')
+>>> parse_repo_uri('git@gitlab.com:group/subgroup/project')
+('gitlab.com', 'group/subgroup/project')
+>>> parse_repo_uri('https://git.example.com/foo.git')
+('git.example.com', 'foo')
+
+The API clients, against a local stub server:
+
+>>> import http.server
+>>> requests = []
+>>> class StubHandler(http.server.BaseHTTPRequestHandler):
+...     def log_message(self, *args):
+...         pass
+...     def reply(self, status, body=None, etag=None):
+...         requests.append((self.command, self.path, status))
+...         self.send_response(status)
+...         if etag is not None:
+...             self.send_header('ETag', etag)
+...         self.end_headers()
+...         if body is not None:
+...             self.wfile.write(json.dumps(body).encode('UTF-8'))
+...     def do_POST(self):
+...         body = self.rfile.read(int(self.headers['Content-Length']))
+...         query = json.loads(body)['query']
+...         if self.headers['Authorization'] != 'bearer secret':
+...             return self.reply(401)
+...         data = {'r1': None}
+...         if 'r0: repository(owner: "foo", name: "bar")' in query:
+...             data['r0'] = {'defaultBranchRef': {'target': {'oid': 'aaa'}}}
+...         if 'qualifiedName: "refs/heads/dev"' in query:
+...             data['r2'] = {'ref': {'target': {'oid': 'bbb'}}}
+...         self.reply(200, {'data': data})
+...     def do_GET(self):
+...         if 'missing' in self.path:
+...             self.reply(404)
+...         elif self.headers.get('If-None-Match') == '"v1"':
+...             self.reply(304, etag='"v1"')
+...         else:
+...             self.reply(200, {'id': 'ccc'}, etag='"v1"')
+>>> server = http.server.HTTPServer(('127.0.0.1', 0), StubHandler)
+>>> threading.Thread(target=server.serve_forever, daemon=True).start()
+>>> url = 'http://127.0.0.1:%d' % server.server_port
+
+GitHub resolves the whole batch in a single GraphQL query:
+
+>>> GitHubAPI(url).usable
+False
+>>> revs = GitHubAPI(url, 'secret').resolve(
+...     [('foo/bar', None), ('foo/gone', None), ('foo/baz', 'dev')])
+>>> [revs[r] for r in (('foo/bar', None), ('foo/gone', None), ('foo/baz', 'dev'))]
+['aaa', None, 'bbb']
+>>> requests
+[('POST', '/graphql', 200)]
+>>> GitHubAPI(url, 'wrong').resolve([('foo/bar', None)]) # doctest: +ELLIPSIS
+Traceback (most recent call last):
+...
+smartliverebuild.forge.ForgeError: HTTP 401 from http://127.0.0.1:.../graphql
+
+GitLab requests are repeated using the ETag, and the cached commit id
+is used when the server replies with 304 Not Modified:
+
+>>> del requests[:]
+>>> gitlab = GitLabAPI(url)
+>>> gitlab.resolve([('group/project', None), ('group/missing', 'main')])
+{('group/project', None): 'ccc', ('group/missing', 'main'): None}
+>>> list(gitlab.etags.values())
+[('"v1"', 'ccc')]
+>>> gitlab.resolve([('group/project', None)])
+{('group/project', None): 'ccc'}
+>>> for r in requests:
+...     print(*r)
+GET /projects/group%2Fproject/repository/commits/HEAD 200
+GET /projects/group%2Fmissing/repository/commits/main 404
+GET /projects/group%2Fproject/repository/commits/HEAD 304
+>>> server.shutdown()
+>>> server.server_close()
+"""
+
+import json, os, queue, re, threading, time
+import urllib.error, urllib.request
+from urllib.parse import quote
+
+from .output import out
+from .vcs.git_r3 import GitR3Support
+
+repo_uri_re = re.compile(
+    r"^(?:(?:https?|git|ssh)://(?:[^@/]+@)?([^/:]+)(?::\d+)?/|[^@/]+@([^/:]+):)"
+    r"(.+?)(?:\.git)?/?$"
+)
+
+
+def parse_repo_uri(uri):
+    """Split the repository URI into the host and the repository path.
+    Returns None if the URI is not supported."""
+    m = repo_uri_re.match(uri)
+    if m is None:
+        return None
+    return (m.group(1) or m.group(2), m.group(3))
+
+
+default_forges = {
+    "github.com": ("github", "https://api.github.com", "GITHUB_TOKEN"),
+    "gitlab.com": ("gitlab", "https://gitlab.com/api/v4", "GITLAB_TOKEN"),
+}
+
+
+class ForgeError(Exception):
+    pass
+
+
+class ForgeAPI(object):
+    """The base class for forge API clients."""
+
+    batch_size = 1
+
+    def __init__(self, api, token=None, timeout=30):
+        self.api = api.rstrip("/")
+        self.token = token
+        self.timeout = timeout
+
+    @property
+    def usable(self):
+        """Whether the API can be used with the current settings."""
+        return True
+
+    def request(self, url, data=None, headers={}):
+        """Perform a HTTP request. Returns a tuple of the status,
+        the response headers and the decoded JSON body (or None)."""
+        req = urllib.request.Request(url, data=data, headers=headers)
+        try:
+            resp = urllib.request.urlopen(req, timeout=self.timeout)
+        except urllib.error.HTTPError as e:
+            if e.code in (304, 404):
+                return (e.code, e.headers, None)
+            raise ForgeError("HTTP %d from %s" % (e.code, url))
+        except (OSError, ValueError) as e:
+            raise ForgeError("%s: %s" % (url, e))
+        with resp:
+            try:
+                return (resp.status, resp.headers, json.loads(resp.read()))
+            except ValueError as e:
+                raise ForgeError("Invalid response from %s: %s" % (url, e))
+
+    def resolve(self, repos):
+        """Resolve the heads of `repos' (a list of (path, branch)
+        tuples, branch being None for the default branch). Returns
+        a dict mapping the repos to the commit ids, or to None if
+        the repository or branch was not found."""
+        raise NotImplementedError()
+
+
+class GitHubAPI(ForgeAPI):
+    """GitHub GraphQL API client. Resolves a whole batch in a single
+    request."""
+
+    batch_size = 50
+
+    @property
+    def usable(self):
+        return bool(self.token)
+
+    def resolve(self, repos):
+        fields = []
+        for i, (path, branch) in enumerate(repos):
+            owner, name = path.split("/", 1)
+            if branch is None:
+                ref = "defaultBranchRef { target { oid } }"
+            else:
+                if not branch.startswith("refs/"):
+                    branch = "refs/heads/%s" % branch
+                ref = "ref(qualifiedName: %s) { target { oid } }" % json.dumps(branch)
+            fields.append(
+                "r%d: repository(owner: %s, name: %s) { %s }"
+                % (i, json.dumps(owner), json.dumps(name), ref)
+            )
+        query = "query { %s }" % " ".join(fields)
+
+        status, headers, data = self.request(
+            self.api + "/graphql",
+            data=json.dumps({"query": query}).encode("UTF-8"),
+            headers={
+                "Authorization": "bearer %s" % self.token,
+                "Content-Type": "application/json",
+            },
+        )
+        if status != 200 or not data or not isinstance(data.get("data"), dict):
+            raise ForgeError("GraphQL query failed: %s" % (data or {}).get("errors"))
+
+        ret = {}
+        for i, r in enumerate(repos):
+            repo = data["data"].get("r%d" % i)
+            ref = None
+            if repo is not None:
+                ref = repo.get("defaultBranchRef" if r[1] is None else "ref")
+            ret[r] = ref["target"]["oid"] if ref is not None else None
+        return ret
+
+
+class GitLabAPI(ForgeAPI):
+    """GitLab REST API client. The requests are conditional, using
+    the ETags of the previous responses stored in `etags'."""
+
+    batch_size = 20
+
+    def __init__(self, api, token=None, timeout=30, etags=None):
+        ForgeAPI.__init__(self, api, token, timeout)
+        self.etags = etags if etags is not None else {}
+
+    def resolve(self, repos):
+        ret = {}
+        for path, branch in repos:
+            url = "%s/projects/%s/repository/commits/%s" % (
+                self.api,
+                quote(path, safe=""),
+                quote(branch or "HEAD", safe=""),
+            )
+            headers = {}
+            if self.token:
+                headers["PRIVATE-TOKEN"] = self.token
+            cached = self.etags.get(url)
+            if cached is not None:
+                headers["If-None-Match"] = cached[0]
+
+            status, respheaders, data = self.request(url, headers=headers)
+            if status == 304 and cached is not None:
+                ret[(path, branch)] = cached[1]
+            elif status == 200 and data and "id" in data:
+                ret[(path, branch)] = data["id"]
+                if respheaders.get("ETag"):
+                    self.etags[url] = (respheaders["ETag"], data["id"])
+            else:
+                ret[(path, branch)] = None
+        return ret
+
+
+api_classes = {
+    "github": GitHubAPI,
+    "gitlab": GitLabAPI,
+}
+
+
+def get_apis(forges, etags=None):
+    """Create the API clients for `forges' (host -> (type, API URL,
+    token)). If `forges' is empty, github.com and gitlab.com are used,
+    with the tokens taken from GITHUB_TOKEN and GITLAB_TOKEN environment
+    variables."""
+
+    if not forges:
+        forges = dict(
+            (h, (t, api, os.environ.get(var)))
+            for h, (t, api, var) in default_forges.items()
+        )
+    apis = {}
+    for host, (t, api, token) in forges.items():
+        if t == "gitlab":
+            a = GitLabAPI(api, token, etags=etags)
+        elif t in api_classes:
+            a = api_classes[t](api, token)
+        else:
+            out.err("Unsupported forge type for %s: %s" % (host, t))
+            continue
+        if a.usable:
+            apis[host] = a
+    return apis
+
+
+class ForgeResolver(object):
+    """Resolve the git-r3 repositories through the forge APIs.
+
+    The repositories are collected in batches, which are sent when they
+    reach the batch size of the API, or after `delay' seconds. The
+    requests are performed in a background thread.
+    """
+
+    def __init__(self, apis, delay=0.5):
+        self._apis = apis
+        self._delay = delay
+        self._batches = dict((h, []) for h in apis)
+        self._batch_time = {}
+        # repo key -> list of VCS instances waiting for the result
+        self._waiting = {}
+        self._requests = queue.Queue()
+        self._results = queue.Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _match(self, vcs):
+        if not isinstance(vcs, GitR3Support):
+            return None
+        m = parse_repo_uri(vcs.repo_uris[0])
+        if m is None or m[0] not in self._apis:
+            return None
+        return (m[0], m[1], vcs.env.get("EGIT_BRANCH") or None)
+
+    def accepts(self, vcs):
+        """Check whether the repository can be resolved through
+        a forge API."""
+        return self._match(vcs) is not None
+
+    @property
+    def pending(self):
+        return bool(self._waiting)
+
+    def submit(self, vcs):
+        key = str(vcs)
+        vcs.starttime = time.time()
+        if key in self._waiting:
+            self._waiting[key].append(vcs)
+            return
+        self._waiting[key] = [vcs]
+
+        host, path, branch = self._match(vcs)
+        out.event("start", vcs, command="(%s API)" % host)
+        if not self._batches[host]:
+            self._batch_time[host] = time.time()
+        self._batches[host].append((key, path, branch))
+        if len(self._batches[host]) >= self._apis[host].batch_size:
+            self._flush(host)
+
+    def _flush(self, host):
+        self._requests.put((host, self._batches[host]))
+        self._batches[host] = []
+
+    def _run(self):
+        while True:
+            req = self._requests.get()
+            if req is None:
+                break
+            host, batch = req
+            try:
+                revs = self._apis[host].resolve([(p, b) for k, p, b in batch])
+            except Exception as e:
+                self._results.put((host, e, [k for k, p, b in batch]))
+            else:
+                self._results.put(
+                    (host, None, [(k, revs.get((p, b))) for k, p, b in batch])
+                )
+
+    def poll(self):
+        """Send the batches which are due and collect the results.
+        Returns a list of (vcs, rev) tuples, rev being None if
+        the repository needs to be checked the regular way."""
+
+        now = time.time()
+        for host, batch in self._batches.items():
+            if batch and now - self._batch_time[host] >= self._delay:
+                self._flush(host)
+
+        ret = []
+        while True:
+            try:
+                host, err, results = self._results.get_nowait()
+            except queue.Empty:
+                break
+            if err is not None:
+                out.err(
+                    "%s API request failed (%s), falling back to git ls-remote."
+                    % (host, err)
+                )
+                results = [(k, None) for k in results]
+            for key, rev in results:
+                for vcs in self._waiting.pop(key, ()):
+                    ret.append((vcs, rev))
+        return ret
+
+    def cancel(self):
+        """Drop all the pending requests. Returns the list of VCS
+        instances which were waiting for the results."""
+        ret = [v for vl in self._waiting.values() for v in vl]
+        self._waiting.clear()
+        for host in self._batches:
+            self._batches[host] = []
+        return ret
+
+    def close(self):
+        self._requests.put(None)
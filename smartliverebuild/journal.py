@@ -0,0 +1,103 @@
+# 	vim:fileencoding=utf-8:noet
+# (c) 2026 Michał Górny <mgorny@gentoo.org>
+# Released under the terms of the 2-clause BSD license.
+
+"""The journal of check results, used to resume interrupted runs.
+
+With --resume, every finished check is appended to the journal as soon
+as its result is known, one JSON object per line. When the run finishes,
+a completion marker is written. The results of an incomplete run
+(not older than --resume-max-age) are loaded and used instead
+of checking the repositories again.
+
+>>> import tempfile
+>>> tmp = tempfile.TemporaryDirectory()
+>>> path = os.path.join(tmp.name, 'state', 'journal.jsonl')
+>>> j = Journal(path, resume=True)
+>>> j.record('git://example.com/foo [HEAD]', 'dev-libs/foo-9999', 'aaa')
+>>> j.record('git://example.com/bar [HEAD]', 'dev-libs/bar-9999', 'bbb')
+>>> j.close()
+
+The interrupted run is resumed. The results older than `max_age' are
+not used:
+
+>>> with open(path, 'a') as f:
+...     _ = f.write(json.dumps({'key': 'git://example.com/old [HEAD]',
+...         'cpv': 'dev-libs/old-9999', 'rev': 'ccc', 'time': 0}) + '\\n')
+>>> j = Journal(path, resume=True)
+>>> sorted(j.results.items())
+[('git://example.com/bar [HEAD]', 'bbb'), ('git://example.com/foo [HEAD]', 'aaa')]
+>>> j.complete()
+>>> j.close()
+
+Once the run completes, there is nothing left to resume:
+
+>>> Journal(path, resume=True).results
+{}
+>>> tmp.cleanup()
+"""
+
+import json, os, os.path, time
+
+from .output import out
+
+
+class Journal(object):
+    """The journal file. It is opened when the instance is created,
+    so that the file can be written after dropping privileges.
+    Without `resume', the journal is not used at all."""
+
+    def __init__(self, path, resume=False, max_age=3600):
+        # repo key -> revision loaded from the interrupted run
+        self.results = {}
+        self._f = None
+
+        if not resume:
+            return
+        self._load(path, max_age)
+        try:
+            d = os.path.dirname(path)
+            if d and not os.path.isdir(d):
+                os.makedirs(d)
+            self._f = open(path, "a" if self.results else "w", buffering=1)
+        except (IOError, OSError) as e:
+            out.err("Unable to open the journal: %s" % e)
+
+    def _load(self, path, max_age):
+        now = time.time()
+        try:
+            with open(path) as f:
+                for l in f:
+                    try:
+                        ent = json.loads(l)
+                    except ValueError:  # incomplete write
+                        continue
+                    if ent.get("complete"):
+                        self.results.clear()
+                    elif "key" in ent and now - ent["time"] <= max_age:
+                        self.results[ent["key"]] = ent["rev"]
+        except IOError:
+            pass
+
+    def _write(self, ent):
+        if self._f is not None:
+            try:
+                self._f.write(json.dumps(ent) + "\n")
+            except (IOError, OSError, ValueError) as e:
+                out.err("Unable to write the journal: %s" % e)
+                self._f = None
+
+    def record(self, key, cpv, rev):
+        """Record the result of a check."""
+        if key not in self.results:
+            self.results[key] = rev
+            self._write({"key": key, "cpv": cpv, "rev": rev, "time": time.time()})
+
+    def complete(self):
+        """Mark the run complete."""
+        self._write({"complete": True, "time": time.time()})
+
+    def close(self):
+        if self._f is not None:
+            self._f.close()
+            self._f = None
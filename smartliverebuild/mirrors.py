@@ -0,0 +1,71 @@
+# 	vim:fileencoding=utf-8:noet
+# (c) 2026 Michał Górny <mgorny@gentoo.org>
+# Released under the terms of the 2-clause BSD license.
+
+"""Checking the remote repositories through local mirrors.
+
+The repository URIs are rewritten using the prefix rules from
+the 'mirrors' option (like git's insteadOf), the longest matching
+prefix winning. The original URIs are still tried if the mirror
+fails.
+
+A mirror may lag behind the upstream repository. Therefore, when
+the mirror reports no changes, the answer is accepted only if
+the upstream repository was found at the same revision within
+mirror_max_age seconds. Otherwise, the check falls back to
+the original URIs, and the result is recorded in the `MirrorLog'.
+
+>>> rules = [('https://github.com/', 'git://mirror.lan/github/'),
+...     ('https://github.com/gentoo/', 'git://mirror.lan/gentoo/')]
+>>> rewrite_uri(rules, 'https://github.com/projg2/foo.git')
+'git://mirror.lan/github/projg2/foo.git'
+>>> rewrite_uri(rules, 'https://github.com/gentoo/gentoo.git')
+'git://mirror.lan/gentoo/gentoo.git'
+>>> rewrite_uri(rules, 'https://gitlab.com/foo/bar.git') is None
+True
+
+>>> log = MirrorLog('/nonexistent/mirrors.json')
+>>> log.confirmed('git://example.com/foo [HEAD]', 'aaa', now=0)
+>>> log.confirmed_rev('git://example.com/foo [HEAD]', 3600, now=1800)
+'aaa'
+>>> log.confirmed_rev('git://example.com/foo [HEAD]', 3600, now=7200) is None
+True
+"""
+
+import time
+
+from .state import StateFile
+
+
+def rewrite_uri(rules, uri):
+    """Rewrite `uri' using the longest matching prefix from `rules'
+    (a list of (prefix, mirror prefix) tuples). Returns None if no rule
+    matches."""
+    best = None
+    for prefix, mirror in rules:
+        if uri.startswith(prefix) and (best is None or len(prefix) > len(best[0])):
+            best = (prefix, mirror)
+    if best is None:
+        return None
+    return best[1] + uri[len(best[0]) :]
+
+
+class MirrorLog(StateFile):
+    """The revisions found by checking the original repository URIs
+    (repo key -> dict of the 'rev' and the 'time' of the check)."""
+
+    def confirmed(self, key, rev, now=None):
+        """Record the revision `rev' found in the upstream repository."""
+        if now is None:
+            now = time.time()
+        self[key] = {"rev": rev, "time": now}
+
+    def confirmed_rev(self, key, max_age, now=None):
+        """The upstream revision found within the last `max_age'
+        seconds, or None."""
+        ent = self.get(key)
+        if now is None:
+            now = time.time()
+        if ent is None or now - ent["time"] > max_age:
+            return None
+        return ent["rev"]
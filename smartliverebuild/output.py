@@ -2,7 +2,7 @@
 # (c) 2010 Michał Górny <mgorny@gentoo.org>
 # Released under the terms of the 2-clause BSD license.
 
-import sys
+import json, shutil, sys, time
 
 
 class SLROutput(object):
@@ -24,6 +24,9 @@ class SLROutput(object):
 
     def __init__(self):
         self._cur_header = None
+        self._pending = None
+        self._status = None
+        self.sinks = [TextSink(self)]
 
     def monochromize(self):
         for k in dir(self):
@@ -37,6 +40,28 @@ class SLROutput(object):
         self.s2 = lambda x: None
         self.s3 = lambda x: None
 
+    def mute(self):
+        """Discard all the output, including errors and results."""
+        self.out = lambda msg: None
+
+    def save(self):
+        """Return the current output settings (colors, silencing, muting
+        and sinks), to be restored using .restore().
+
+        >>> o = SLROutput()
+        >>> state = o.save()
+        >>> o.monochromize(); o.mute(); o.sinks = []
+        >>> o.restore(state)
+        >>> o.white == SLROutput.white, len(o.sinks)
+        (True, 1)
+        """
+        return dict(self.__dict__)
+
+    def restore(self, state):
+        """Restore the output settings saved by .save()."""
+        self.__dict__.clear()
+        self.__dict__.update(state)
+
     def result(self, msg):
         """Basically a s1 which doesn't respect --quiet."""
         self.out("%s*** %s%s\n" % (self.s1reset, msg, self.reset))
@@ -65,7 +90,237 @@ class SLROutput(object):
         self._cur_header = None
 
     def out(self, msg):
-        sys.stderr.write(msg)
+        if self._pending is not None:
+            self._pending.append(msg)
+        else:
+            if self._status is not None:
+                self._status.clear()
+            sys.stderr.write(msg)
+
+    def buffer(self):
+        """Start collecting output instead of writing it immediately.
+        The collected messages are written in a single call
+        by .flush()."""
+        if self._pending is None:
+            self._pending = []
+
+    def flush(self):
+        """Write out the messages collected since .buffer() call
+        and stop buffering."""
+        pending = self._pending
+        self._pending = None
+        if pending:
+            self.out("".join(pending))
+
+    def clear_status(self):
+        """Remove the live status line (if any) and stop drawing it."""
+        if self._status is not None:
+            self._status.clear()
+            self._status = None
+
+    def close_status(self):
+        """Draw the final live status line (if any), leave it
+        on the screen and stop drawing it."""
+        if self._status is not None:
+            self._status.close()
+
+    def close(self):
+        """Close the sinks at the end of the run."""
+        self.close_status()
+        for s in self.sinks:
+            if hasattr(s, "close"):
+                s.close()
+
+    def event(self, kind, vcs=None, **data):
+        """Pass an event to all the sinks. `kind' names the event
+        ('start', 'finish', 'error', 'timing'), `vcs' is the VCS
+        instance the event refers to (if any) and the remaining keyword
+        arguments are event-specific data.
+        """
+        record = {"event": kind, "time": time.time()}
+        if vcs is not None:
+            record["package"] = vcs.cpv
+            record["repo"] = str(vcs)
+            record["vcs"] = vcs.__class__.__name__
+        record.update(data)
+        for s in self.sinks:
+            s(record, vcs)
+
+
+class TextSink(object):
+    """The classic human-readable output, written using the SLROutput
+    methods."""
+
+    def __init__(self, output, jobs=1):
+        self._out = output
+        self.jobs = jobs
+
+    def __call__(self, ev, vcs):
+        out = self._out
+        kind = ev["event"]
+        if kind == "start":
+            out.pkgs(
+                ev["repo"] if self.jobs > 1 else vcs._header,
+                "%s%s%s" % (out.violet, ev["command"], out.reset),
+            )
+        elif kind == "finish":
+            if ev.get("filtered"):
+                # reported by the pathfilter event already
+                pass
+            elif ev["changed"]:
+                out.pkgs(
+                    vcs._header,
+                    "update from %s%s%s to %s%s%s"
+                    % (
+                        out.green,
+                        ev["oldrev"],
+                        out.reset,
+                        out.lime,
+                        ev["newrev"],
+                        out.reset,
+                    ),
+                )
+            else:
+                out.pkgs(
+                    vcs._header,
+                    "at rev %s%s%s (no changes)" % (out.green, ev["oldrev"], out.reset),
+                )
+        elif kind == "pathfilter":
+            out.pkgs(
+                vcs._header,
+                "%sno changes in %s%s (skipping)"
+                % (out.green, " ".join(ev["paths"]), out.reset),
+            )
+        elif kind == "mirror":
+            out.pkgs(
+                vcs._header,
+                "mirror at rev %s%s%s not confirmed, checking the original"
+                % (out.green, ev["rev"], out.reset),
+            )
+        elif kind == "prefetch":
+            if ev["success"]:
+                out.pkgs(vcs._header, "prefetched into %s" % ev["gitdir"])
+            else:
+                out.err("Prefetching %s into %s failed" % (ev["repo"], ev["gitdir"]))
+        elif kind == "error":
+            out.err(
+                "Error %s %s: [%s] %s"
+                % (
+                    "enumerating" if ev["phase"] == "enumerate" else "updating",
+                    ev["package"],
+                    ev["exception"],
+                    ev["message"],
+                )
+            )
+
+
+class JSONLinesSink(object):
+    """A machine-readable sink writing every event as a single JSON
+    object per line."""
+
+    def __init__(self, f):
+        self._f = f
+
+    def __call__(self, ev, vcs):
+        if self._f.closed:
+            return
+        self._f.write(json.dumps(ev, default=str) + "\n")
+        self._f.flush()
+
+    def close(self):
+        self._f.close()
+
+
+class DashboardSink(object):
+    """A live progress display for terminals. It keeps a single status
+    line at the bottom of the output and redraws it at most `rate`
+    times per second. When closed, the final status is drawn and left
+    on the screen.
+
+    >>> import io
+    >>> stream = io.StringIO()
+    >>> d = DashboardSink(SLROutput(), rate=0.01, stream=stream)
+    >>> d({'event': 'start', 'time': 0, 'package': 'dev-libs/foo:0'}, None)
+    >>> d({'event': 'finish', 'package': 'dev-libs/foo:0', 'changed': True}, None)
+    >>> d.close()
+    >>> stream.getvalue().rsplit('\\033[K', 1)[1]  # doctest: +ELLIPSIS
+    '[0 active, 0 queued, 1 done (.../s), 1 changed, 0 errors]\\n'
+    """
+
+    def __init__(self, output, rate=4, stream=None):
+        self._out = output
+        self._stream = stream or sys.stderr
+        self._interval = 1.0 / rate if rate > 0 else 0
+        self._last_draw = 0
+        self._shown = False
+        self._active = {}
+        self._starttime = time.time()
+        self.queued = 0
+        self.done = 0
+        self.changed = 0
+        self.errors = 0
+        output._status = self
+
+    def __call__(self, ev, vcs):
+        kind = ev["event"]
+        key = (ev.get("package"), ev.get("repo"))
+        if kind == "queue":
+            self.queued += 1
+        elif kind == "start":
+            self._active[key] = ev["time"]
+        elif kind in ("finish", "error"):
+            if key in self._active:
+                del self._active[key]
+            if ev.get("phase") != "enumerate":
+                self.queued = max(self.queued - 1, 0)
+            self.done += 1
+            if kind == "error":
+                self.errors += 1
+            elif ev["changed"]:
+                self.changed += 1
+        if self._out._status is self:
+            self.draw()
+
+    def draw(self, force=False):
+        now = time.time()
+        if not force and now - self._last_draw < self._interval:
+            return
+        self._last_draw = now
+
+        elapsed = max(now - self._starttime, 1e-3)
+        line = "[%d active, %d queued, %d done (%.1f/s), %d changed, %d errors]" % (
+            len(self._active),
+            max(self.queued - len(self._active), 0),
+            self.done,
+            self.done / elapsed,
+            self.changed,
+            self.errors,
+        )
+        oldest = sorted(self._active.items(), key=lambda kv: kv[1])
+        if oldest:
+            line += " " + ", ".join(k[0] for k, t in oldest)
+        width = shutil.get_terminal_size().columns
+        self._stream.write("\r\033[K%s" % line[: width - 1])
+        self._stream.flush()
+        self._shown = True
+
+    def clear(self):
+        if self._shown:
+            self._stream.write("\r\033[K")
+            self._shown = False
+            self._last_draw = 0
+
+    def close(self):
+        if self._out._status is not self:
+            return
+        # nothing to show if the checks were performed elsewhere
+        # (e.g. by the child process)
+        if self.done or self._active:
+            self.draw(force=True)
+            self._stream.write("\n")
+            self._stream.flush()
+            self._shown = False
+        self._out._status = None
 
 
 out = SLROutput()
@@ -0,0 +1,159 @@
+# 	vim:fileencoding=utf-8:noet
+# (c) 2026 Michał Górny <mgorny@gentoo.org>
+# Released under the terms of the 2-clause BSD license.
+
+"""Profiling support.
+
+The hot sections of the run are measured using named timers,
+accessible through the global `timers' instance:
+
+>>> t = Timers()
+>>> with t("enumerate"):
+...     pass
+>>> list(t.iter("vdb", [1, 2]))
+[1, 2]
+>>> sorted(t.totals), t.counts["enumerate"], t.counts["vdb"]
+(['enumerate', 'vdb'], 1, 3)
+
+Additionally, the whole run can be profiled using cProfile (--profile-out)
+and tracemalloc (--trace-malloc). Since the checks may be performed
+in a forked child process, the child sends its data to the parent using
+collect() and the parent combines them using merge().
+"""
+
+import cProfile, pstats, time, tracemalloc
+from contextlib import contextmanager
+
+from .output import out
+
+
+class Timers(object):
+    """A set of named timers accumulating the time spent in a section
+    and the number of times it was entered."""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.totals = {}
+        self.counts = {}
+
+    def add(self, name, duration, count=1):
+        self.totals[name] = self.totals.get(name, 0) + duration
+        self.counts[name] = self.counts.get(name, 0) + count
+
+    @contextmanager
+    def __call__(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def iter(self, name, iterable):
+        """Iterate over `iterable', measuring the time spent getting
+        the items."""
+        it = iter(iterable)
+        while True:
+            with self(name):
+                try:
+                    item = next(it)
+                except StopIteration:
+                    return
+            yield item
+
+    def report(self):
+        """Return a list of (name, total time, count) tuples, longest
+        first."""
+        return sorted(
+            ((k, v, self.counts[k]) for k, v in self.totals.items()),
+            key=lambda x: -x[1],
+        )
+
+
+timers = Timers()
+
+_profile = None
+_profile_stats = []
+_trace_malloc = 0
+_malloc_report = None
+
+
+def start(opts):
+    """Start the profilers requested in `opts'."""
+    global _profile, _trace_malloc
+
+    if opts.profile_out:
+        _profile = cProfile.Profile()
+        _profile.enable()
+    if opts.trace_malloc > 0:
+        _trace_malloc = opts.trace_malloc
+        tracemalloc.start(10)
+
+
+def collect():
+    """Stop the profilers and return their data (along with the timers)
+    in a picklable form."""
+    global _malloc_report
+
+    ret = {"timers": (timers.totals, timers.counts)}
+    if _profile is not None:
+        _profile.disable()
+        _profile.create_stats()
+        ret["profile"] = _profile.stats
+    if _trace_malloc and tracemalloc.is_tracing():
+        snapshot = tracemalloc.take_snapshot().filter_traces(
+            [
+                tracemalloc.Filter(False, cProfile.__file__),
+                tracemalloc.Filter(False, tracemalloc.__file__),
+            ]
+        )
+        tracemalloc.stop()
+        ret["malloc"] = [str(s) for s in snapshot.statistics("lineno")[:_trace_malloc]]
+        # the child's report takes precedence, it did the actual work
+        if _malloc_report is None:
+            _malloc_report = ret["malloc"]
+    return ret
+
+
+def merge(data):
+    """Merge the data collected by the child process."""
+    global _malloc_report
+
+    for k, v in data["timers"][0].items():
+        timers.add(k, v, data["timers"][1][k])
+    if "profile" in data:
+        _profile_stats.append(data["profile"])
+    if "malloc" in data:
+        _malloc_report = data["malloc"]
+
+
+class _StatsHolder(object):
+    def __init__(self, stats):
+        self.stats = stats
+
+    def create_stats(self):
+        pass
+
+
+def finish(opts):
+    """Stop the profilers, write the profile and report the results."""
+
+    if _profile is not None or _trace_malloc:
+        collect()
+    if _profile is not None:
+        stats = pstats.Stats(_profile)
+        for s in _profile_stats:
+            stats.add(_StatsHolder(s))
+        stats.dump_stats(opts.profile_out)
+        out.s1("Profile written to %s" % opts.profile_out)
+
+    if _malloc_report:
+        out.s1("Top %d allocation sites:" % len(_malloc_report))
+        for l in _malloc_report:
+            out.s2(l)
+
+    if opts.profile_out or _trace_malloc:
+        out.s1("Timers:")
+        for name, total, count in timers.report():
+            out.s2("%-12s %8.3fs in %d calls" % (name, total, count))
@@ -0,0 +1,360 @@
+# 	vim:fileencoding=utf-8:noet
+# (c) 2026 Michał Górny <mgorny@gentoo.org>
+# Released under the terms of the 2-clause BSD license.
+
+"""A revision cache shared by multiple machines.
+
+The cache server (smart-live-rebuild --revcache-server ADDRESS) stores
+the latest revision known for every repository, and forgets it after
+--revcache-ttl seconds. The clients (smart-live-rebuild --revcache
+ADDRESS) ask the server before checking a repository, and publish
+the result afterwards.
+
+When a client asks for a revision that is not known, the server grants
+it a lease on the repository. Until the result is published (or
+the lease expires), other clients asking for the same repository are
+told to wait, so that only one of them contacts the upstream.
+
+The addresses are either HOST:PORT (HTTP over TCP) or unix:PATH (HTTP
+over a local socket). Anyone who can reach the server can store
+revisions in it, making the clients skip the rebuilds. Therefore,
+the server should be reachable from the trusted network only, and
+--revcache-secret can be used to require a shared secret (passed
+in the X-SLR-Secret header) from the clients.
+
+>>> server = make_server('127.0.0.1:0', 600)
+>>> threading.Thread(target=server.serve_forever, daemon=True).start()
+>>> address = '127.0.0.1:%d' % server.server_address[1]
+>>> def ask(cache, key):
+...     cache.get(key)
+...     cache._requests.join()
+...     return cache.get(key)
+
+The lookups return Pending until the server answers. The first client
+asking for an unknown repository gets the lease, and the others are
+told to wait until it publishes the result:
+
+>>> a = SharedCache(address)
+>>> b = SharedCache(address, retry=0)
+>>> isinstance(a.get('git://example.com/foo'), Pending)
+True
+>>> print(ask(a, 'git://example.com/foo'))
+None
+>>> isinstance(ask(b, 'git://example.com/foo'), Pending)
+True
+>>> a['git://example.com/foo'] = 'abc'
+>>> a._requests.join()
+>>> ask(b, 'git://example.com/foo')
+'abc'
+>>> a.close()
+>>> b.close()
+>>> server.shutdown()
+>>> server.server_close()
+
+If the server can not be reached, the cache works locally, without
+asking the server anymore:
+
+>>> c = SharedCache('unix:/nonexistent/revcache.sock')
+>>> print(ask(c, 'git://example.com/foo'))
+None
+>>> print(c.get('git://example.com/bar'))
+None
+>>> c.close()
+
+The same happens when the server requires a secret, and the client
+does not know it:
+
+>>> server = make_server('127.0.0.1:0', 600, secret='s3cret')
+>>> threading.Thread(target=server.serve_forever, daemon=True).start()
+>>> address = '127.0.0.1:%d' % server.server_address[1]
+>>> print(ask(SharedCache(address, secret='wrong'), 'git://example.com/foo'))
+None
+>>> print(ask(SharedCache(address, secret='s3cret'), 'git://example.com/foo'))
+None
+>>> list(server.store._leases)
+['git://example.com/foo']
+>>> server.shutdown()
+>>> server.server_close()
+"""
+
+import hmac, http.client, http.server, json, queue, socket, socketserver
+import threading, time
+from urllib.parse import quote, unquote
+
+from .output import out
+from .vcs import BaseVCSSupport, CheckCache, Pending
+
+
+class RevisionStore(object):
+    """The in-memory revision storage of the cache server."""
+
+    def __init__(self, ttl, lease_time=60):
+        self._ttl = ttl
+        self._lease_time = lease_time
+        self._revs = {}
+        self._leases = {}
+        self._lock = threading.Lock()
+
+    def lookup(self, key):
+        """Look up the revision for `key'. Returns a tuple of status
+        ('hit', 'wait' or 'miss') and the revision (for 'hit').
+        A 'miss' grants the lease on the key to the caller."""
+        now = time.time()
+        with self._lock:
+            if key in self._revs:
+                rev, t = self._revs[key]
+                if now - t < self._ttl:
+                    return ("hit", rev)
+                del self._revs[key]
+            if now - self._leases.get(key, 0) < self._lease_time:
+                return ("wait", None)
+            self._leases[key] = now
+            return ("miss", None)
+
+    def store(self, key, rev):
+        with self._lock:
+            self._revs[key] = (rev, time.time())
+            self._leases.pop(key, None)
+
+    def release(self, key):
+        with self._lock:
+            self._leases.pop(key, None)
+
+
+class RevisionCacheHandler(http.server.BaseHTTPRequestHandler):
+    """GET /rev/KEY -> 200 {"rev": ...} (hit), 202 (wait), 404 (miss)
+    PUT /rev/KEY {"rev": ...} -> 204
+    DELETE /rev/KEY -> 204 (release the lease)
+    """
+
+    def _key(self):
+        secret = self.server.secret
+        if secret and not hmac.compare_digest(
+            self.headers.get("X-SLR-Secret", "").encode("UTF-8"),
+            secret.encode("UTF-8"),
+        ):
+            self.send_error(403)
+            return None
+        if not self.path.startswith("/rev/"):
+            self.send_error(400)
+            return None
+        return unquote(self.path[5:])
+
+    def _reply(self, code, data=None):
+        body = json.dumps(data).encode("UTF-8") if data is not None else b""
+        self.send_response(code)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if body:
+            self.wfile.write(body)
+
+    def do_GET(self):
+        key = self._key()
+        if key is not None:
+            status, rev = self.server.store.lookup(key)
+            if status == "hit":
+                self._reply(200, {"rev": rev})
+            elif status == "wait":
+                self._reply(202)
+            else:
+                self._reply(404)
+
+    def do_PUT(self):
+        key = self._key()
+        if key is not None:
+            length = int(self.headers.get("Content-Length", 0))
+            data = json.loads(self.rfile.read(length).decode("UTF-8"))
+            self.server.store.store(key, data["rev"])
+            self._reply(204)
+
+    def do_DELETE(self):
+        key = self._key()
+        if key is not None:
+            self.server.store.release(key)
+            self._reply(204)
+
+    def address_string(self):
+        # client_address is empty for unix sockets
+        return str(self.client_address)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TCPRevisionCacheServer(http.server.ThreadingHTTPServer):
+    pass
+
+
+class UnixRevisionCacheServer(
+    socketserver.ThreadingMixIn, socketserver.UnixStreamServer
+):
+    daemon_threads = True
+
+
+def make_server(address, ttl, secret=""):
+    """Create the cache server listening on `address'. If `secret'
+    is not empty, the clients need to pass it."""
+    if address.startswith("unix:"):
+        server = UnixRevisionCacheServer(address[5:], RevisionCacheHandler)
+    else:
+        host, port = address.rsplit(":", 1)
+        server = TCPRevisionCacheServer((host, int(port)), RevisionCacheHandler)
+    server.store = RevisionStore(ttl)
+    server.secret = secret
+    return server
+
+
+def server_main(opts):
+    """The entry point for smart-live-rebuild --revcache-server."""
+    server = make_server(opts.revcache_server, opts.revcache_ttl, opts.revcache_secret)
+    out.s1("Serving the revision cache on %s ..." % opts.revcache_server)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path, timeout):
+        http.client.HTTPConnection.__init__(self, "localhost", timeout=timeout)
+        self._path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self._path)
+
+
+class SharedCache(CheckCache):
+    """The repository check cache (repo key -> revision) backed
+    by the shared cache server.
+
+    Lookups not satisfied locally are passed to the server. The requests
+    are performed in a background thread, and a Pending instance is
+    returned until the answer arrives. If another machine is checking
+    the repository at the moment, the server is asked again after
+    `retry' seconds. The revisions stored in the cache are published.
+
+    If the server can not be reached (or it refuses the `secret'),
+    the cache falls back to working locally, without waiting
+    for the server anymore.
+    """
+
+    def __init__(self, address, timeout=2, retry=1, secret=""):
+        CheckCache.__init__(self)
+        self._address = address
+        self._timeout = timeout
+        self._retry = retry
+        self._secret = secret
+        self._asked = {}
+        self._leased = set()
+        # the GET requests in progress, and their answers
+        self._waiting = set()
+        self._answers = {}
+        self._error = None
+        self._reported = False
+        # the number of requests performed
+        self._done = 0
+        self._requests = queue.Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _request(self, method, key, data=None):
+        if self._address.startswith("unix:"):
+            conn = UnixHTTPConnection(self._address[5:], self._timeout)
+        else:
+            conn = http.client.HTTPConnection(self._address, timeout=self._timeout)
+        try:
+            body = json.dumps(data) if data is not None else None
+            headers = {}
+            if self._secret:
+                headers["X-SLR-Secret"] = self._secret
+            conn.request(method, "/rev/%s" % quote(key, safe=""), body, headers)
+            resp = conn.getresponse()
+            ret = resp.read()
+            if resp.status != 200:
+                return (resp.status, None)
+            return (resp.status, json.loads(ret.decode("UTF-8")))
+        finally:
+            conn.close()
+
+    def _run(self):
+        while True:
+            req = self._requests.get()
+            if req is None:
+                self._requests.task_done()
+                break
+            method, key, data = req
+            ret = (None, None)
+            if self._error is None:
+                try:
+                    ret = self._request(method, key, data)
+                except (OSError, http.client.HTTPException, ValueError) as e:
+                    self._error = e
+                if ret[0] == 403:
+                    self._error = "access denied, wrong secret"
+            if method == "GET":
+                self._answers[key] = ret
+                self._waiting.discard(key)
+            self._done += 1
+            self._requests.task_done()
+
+    def _broken(self):
+        """Check whether the server could not be reached. The failure
+        is reported once."""
+        if self._error is not None and not self._reported:
+            out.err(
+                "Revision cache %s unavailable (%s), continuing without it."
+                % (self._address, self._error)
+            )
+            self._reported = True
+        return self._error is not None
+
+    def get(self, key, default=None):
+        if key in self:
+            return dict.__getitem__(self, key)
+        if self._broken():
+            return default
+
+        if key in self._answers:
+            status, data = self._answers.pop(key)
+            if status == 200:
+                dict.__setitem__(self, key, data["rev"])
+                return data["rev"]
+            elif status == 404:
+                self._leased.add(key)
+                return default
+            elif status != 202:
+                return default
+        elif key in self._waiting:
+            return Pending()
+
+        if time.time() - self._asked.get(key, 0) >= self._retry:
+            self._asked[key] = time.time()
+            self._waiting.add(key)
+            self._requests.put(("GET", key, None))
+        return Pending()
+
+    def __setitem__(self, key, value):
+        dict.__setitem__(self, key, value)
+        if key in self._leased:
+            if isinstance(value, Exception):
+                self._leased.discard(key)
+                self._requests.put(("DELETE", key, None))
+            elif not isinstance(value, BaseVCSSupport):
+                self._leased.discard(key)
+                self._requests.put(("PUT", key, {"rev": value}))
+
+    def close(self):
+        """Finish sending the results to the server. Waits as long as
+        the requests progress (each one taking up to `timeout'
+        seconds)."""
+        self._requests.put(None)
+        done = None
+        while self._thread.is_alive() and self._done != done:
+            done = self._done
+            self._thread.join(self._timeout * 2)
+        self._broken()
@@ -9,7 +9,7 @@ from gentoopm import get_package_manager
 from portage._sets.base import PackageSet
 
 from smartliverebuild.config import Config
-from smartliverebuild.core import SmartLiveRebuild, SLRFailure
+from smartliverebuild.core import LiveRebuildRun, SLRFailure
 
 
 class SmartLiveRebuildSet(PackageSet):
@@ -44,7 +44,10 @@ class SmartLiveRebuildSet(PackageSet):
 
         try:
             if packages is None:
-                packages = SmartLiveRebuild(c.get_options(), pm)
+                run = LiveRebuildRun(c.get_options(), [pm])
+                for res in run:
+                    pass
+                packages = run.packages[pm.root]
         except SLRFailure:
             pass
         else:
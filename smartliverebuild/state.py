@@ -0,0 +1,104 @@
+# 	vim:fileencoding=utf-8:noet
+# (c) 2026 Michał Górny <mgorny@gentoo.org>
+# Released under the terms of the 2-clause BSD license.
+
+import json, os, os.path, tempfile
+
+from .output import out
+
+
+class StateFile(dict):
+    """A dict persisted in a JSON file. The file is loaded when
+    the instance is created (a missing or broken file results in an empty
+    dict), and written atomically by .save() if it was modified.
+
+    The changes to the dict itself are tracked. If the values are modified
+    in place, .modified needs to be set explicitly.
+
+    >>> tmp = tempfile.TemporaryDirectory()
+    >>> path = os.path.join(tmp.name, 'state', 'foo.json')
+    >>> f = StateFile(path)
+    >>> f.save()
+    >>> os.path.exists(path)
+    False
+    >>> f['foo'] = {'count': 1}
+    >>> f.save()
+    >>> f.modified
+    False
+    >>> f = StateFile(path)
+    >>> f
+    {'foo': {'count': 1}}
+    >>> f['foo']['count'] += 1
+    >>> f.modified
+    False
+    >>> f.modified = True
+    >>> f.save()
+    >>> StateFile(path)
+    {'foo': {'count': 2}}
+    >>> f.pop('bar', None)
+    >>> f.modified
+    False
+    >>> tmp.cleanup()
+    """
+
+    def __init__(self, path):
+        dict.__init__(self)
+        self.path = path
+        self.modified = False
+        try:
+            with open(path) as f:
+                dict.update(self, json.load(f))
+        except (IOError, ValueError):
+            pass
+
+    def __setitem__(self, key, value):
+        dict.__setitem__(self, key, value)
+        self.modified = True
+
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        self.modified = True
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def pop(self, key, *args):
+        if key in self:
+            self.modified = True
+        return dict.pop(self, key, *args)
+
+    def popitem(self):
+        self.modified = True
+        return dict.popitem(self)
+
+    def clear(self):
+        if self:
+            self.modified = True
+        dict.clear(self)
+
+    def update(self, *args, **kwargs):
+        dict.update(self, *args, **kwargs)
+        self.modified = True
+
+    def save(self):
+        if not self.modified:
+            return
+        d = os.path.dirname(self.path)
+        try:
+            if d and not os.path.isdir(d):
+                os.makedirs(d)
+            fd, tmp = tempfile.mkstemp(dir=d or ".", prefix=".", suffix=".tmp")
+            with os.fdopen(fd, "w") as f:
+                json.dump(self, f)
+            os.rename(tmp, self.path)
+        except (IOError, OSError) as e:
+            out.err("Unable to save %s: %s" % (self.path, e))
+        else:
+            self.modified = False
+
+
+def state_path(opts, name):
+    """Get the path to the state file `name' in opts.state_dir."""
+    return os.path.join(opts.state_dir, name)
@@ -0,0 +1,61 @@
+# 	vim:fileencoding=utf-8:noet
+# (c) 2026 Michał Górny <mgorny@gentoo.org>
+# Released under the terms of the 2-clause BSD license.
+
+"""Adaptive per-repository timeouts.
+
+The durations of the update commands run by the successful checks are
+recorded per repository (the checks performed by the workers or through
+the forge APIs are not).
+Once enough of them are known, the timeout is the 99th percentile
+of the recent durations multiplied by --timeout-factor, within
+the --timeout-min and --timeout-max bounds. For the repositories
+with no history, the VCS-specific default timeout is used.
+
+>>> log = LatencyLog('/nonexistent/latency.json')
+>>> for d in (1.0, 2.0, 1.5, 1.2, 8.0):
+...     log.record('svn://example.com/foo', d)
+>>> log.percentile('svn://example.com/foo', 0.99)
+8.0
+>>> log.percentile('svn://example.com/foo', 0.5)
+1.5
+>>> log.timeout('svn://example.com/foo', 120, factor=3, minimum=10, maximum=600)
+24.0
+>>> log.timeout('svn://example.com/bar', 120, factor=3, minimum=10, maximum=600)
+120
+"""
+
+import math
+
+from .state import StateFile
+
+# the number of most recent durations kept
+history_length = 20
+# the number of durations needed to derive the timeout
+min_samples = 5
+
+
+class LatencyLog(StateFile):
+    """The recent check durations (repo key -> list of seconds)."""
+
+    def record(self, key, duration):
+        d = self.setdefault(key, [])
+        d.append(round(duration, 3))
+        del d[:-history_length]
+        self.modified = True
+
+    def percentile(self, key, p):
+        """The `p' percentile (nearest-rank) of the durations
+        for `key', or None if there are not enough samples."""
+        d = sorted(self.get(key, ()))
+        if len(d) < min_samples:
+            return None
+        return d[max(int(math.ceil(p * len(d))) - 1, 0)]
+
+    def timeout(self, key, default, factor, minimum, maximum):
+        """Get the timeout for repository `key'. If there is not
+        enough history, `default' is returned."""
+        p99 = self.percentile(key, 0.99)
+        if p99 is None:
+            return default
+        return min(max(p99 * factor, minimum), maximum)
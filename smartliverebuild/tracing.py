@@ -0,0 +1,143 @@
+# 	vim:fileencoding=utf-8:noet
+# (c) 2026 Michał Górny <mgorny@gentoo.org>
+# Released under the terms of the 2-clause BSD license.
+
+"""The timeline of a run, in the Chrome trace event format.
+
+With --trace-file, the scheduler and the VCS classes record spans
+through the global `tracer' instance. Every check occupies a job slot
+(a track in the trace viewer) from its start to its end, with nested
+spans for the update command and the following steps. Enumeration,
+portdb verification and quickpkg are recorded on the main track,
+along with the queue depth counters. The resulting file can be loaded
+into chrome://tracing or Perfetto.
+
+>>> t = Tracer()
+>>> t.start()
+>>> t.begin('a', 'update')
+>>> t.begin('b', 'update')
+>>> t.end('a')
+>>> t.begin('c', 'update')
+>>> [(e['ph'], e['tid']) for e in t.events]
+[('B', 1), ('B', 2), ('E', 1), ('B', 1)]
+
+When disabled, all the methods do nothing:
+
+>>> t = Tracer()
+>>> t.begin('a', 'update')
+>>> t.events
+[]
+"""
+
+import json, time
+from contextlib import contextmanager
+
+from .output import out
+
+
+class Tracer(object):
+    """Collect the trace events. The checks are identified by arbitrary
+    hashable objects (the VCS instances); each of them is assigned
+    the lowest free job slot when its first span begins, and the slot
+    is freed when its last span ends."""
+
+    def __init__(self):
+        self.enabled = False
+        self.events = []
+        self._starttime = 0
+        self._slots = {}  # obj -> (slot, number of open spans)
+
+    def start(self):
+        self.enabled = True
+        self._starttime = time.time()
+
+    def _ts(self):
+        return int((time.time() - self._starttime) * 1000000)
+
+    def _event(self, ph, name, tid, args=None):
+        ev = {"ph": ph, "name": name, "pid": 1, "tid": tid, "ts": self._ts()}
+        if args:
+            ev["args"] = args
+        self.events.append(ev)
+
+    def begin(self, obj, name, **args):
+        """Begin a span `name' in the job slot of `obj'."""
+        if not self.enabled:
+            return
+        if obj in self._slots:
+            slot, depth = self._slots[obj]
+        else:
+            used = set(s for s, d in self._slots.values())
+            slot = 1
+            while slot in used:
+                slot += 1
+            depth = 0
+        self._slots[obj] = (slot, depth + 1)
+        self._event("B", name, slot, args)
+
+    def end(self, obj):
+        """End the innermost span of `obj'."""
+        if not self.enabled or obj not in self._slots:
+            return
+        slot, depth = self._slots[obj]
+        self._event("E", "", slot)
+        if depth > 1:
+            self._slots[obj] = (slot, depth - 1)
+        else:
+            del self._slots[obj]
+
+    def release(self, obj):
+        """End all the spans of `obj' and free its slot."""
+        while self.enabled and obj in self._slots:
+            self.end(obj)
+
+    @contextmanager
+    def span(self, name, **args):
+        """Record a span on the main track."""
+        if not self.enabled:
+            yield
+            return
+        self._event("B", name, 0, args)
+        try:
+            yield
+        finally:
+            self._event("E", "", 0)
+
+    def counter(self, name, **values):
+        """Record the values of counter `name'."""
+        if self.enabled:
+            self._event("C", name, 0, values)
+
+    def merge(self, events):
+        """Add the events collected in the child process."""
+        self.events.extend(events)
+
+    def save(self, path):
+        """Write the trace to `path'."""
+        slots = set(e["tid"] for e in self.events)
+        meta = [
+            {
+                "ph": "M",
+                "name": "thread_name",
+                "pid": 1,
+                "tid": s,
+                "args": {"name": "job %d" % s if s else "main"},
+            }
+            for s in sorted(slots)
+        ]
+        meta.append(
+            {
+                "ph": "M",
+                "name": "process_name",
+                "pid": 1,
+                "args": {"name": "smart-live-rebuild"},
+            }
+        )
+        try:
+            with open(path, "w") as f:
+                json.dump({"traceEvents": meta + self.events}, f)
+        except (IOError, OSError) as e:
+            out.err("Unable to write the trace file: %s" % e)
+
+
+tracer = Tracer()
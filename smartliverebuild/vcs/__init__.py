@@ -2,11 +2,12 @@
 # (c) 2011-2017 Michał Górny <mgorny@gentoo.org>
 # Released under the terms of the 2-clause BSD license.
 
-import locale, os, subprocess, time
-from gentoopm.util import ABCObject
-from abc import abstractmethod, abstractproperty
+import locale, os, shlex, subprocess, time
+from abc import ABCMeta, abstractmethod, abstractproperty
 
+from ..mirrors import rewrite_uri
 from ..output import out
+from ..tracing import tracer
 
 
 class NonLiveEbuild(Exception):
@@ -17,6 +18,14 @@ class NonLiveEbuild(Exception):
     pass
 
 
+class CheckoutMissing(NonLiveEbuild):
+    """Exception to be raised when the check needs the checkout
+    of the package, and it was removed. There is no way to tell whether
+    the package needs to be rebuilt, so it is skipped."""
+
+    pass
+
+
 class OtherEclass(Exception):
     """Exception to be raised whenever the package will use another
     eclass and the current needs to be silently terminated."""
@@ -24,10 +33,252 @@ class OtherEclass(Exception):
     pass
 
 
-class BaseVCSSupport(ABCObject):
-    """Common VCS support class details."""
+class Pending(object):
+    """A cache placeholder for a repository that is being checked
+    elsewhere (e.g. by another machine sharing the revision cache).
+    The check will be retried later."""
+
+    __slots__ = ()
+
+
+class CheckCache(dict):
+    """The results of the checks performed during a run (repo key ->
+    the new revision, the exception raised or the VCS instance performing
+    the check). `state' holds the additional per-run state of the VCS
+    classes (e.g. the locks on the repositories they share)."""
+
+    def __init__(self):
+        dict.__init__(self)
+        self.state = {}
+
+
+class CommandChain(object):
+    """A list of commands (argv lists) run one after another, without
+    involving the shell. If `op' is '||', the next command is run only
+    if the previous one failed (e.g. to try mirror URIs); if `op' is '&&',
+    only if the previous one succeeded; if `op' is ';', all the commands
+    are run. The exit status is the one of the last command run.
+
+    `env' specifies additional environment variables for the commands,
+    and `tempfiles' lists the files to remove when the commands finish.
+    """
+
+    __slots__ = ("op", "cmds", "env", "tempfiles")
+
+    def __init__(self, op, cmds, env=None, tempfiles=()):
+        if op not in ("||", "&&", ";"):
+            raise ValueError("Unsupported command chain operator: %s" % op)
+        self.op = op
+        self.cmds = cmds
+        self.env = env or {}
+        self.tempfiles = tempfiles
+
+    def __str__(self):
+        sep = {"||": " || ", "&&": " && ", ";": "; "}[self.op]
+        return sep.join(shlex.join(c) for c in self.cmds)
+
+
+class ChainProcess(object):
+    """A subprocess.Popen-like object running a CommandChain. `index'
+    is the index of the last command started."""
+
+    __slots__ = (
+        "_chain",
+        "_popenargs",
+        "_cmds",
+        "_proc",
+        "_output",
+        "index",
+        "returncode",
+    )
+
+    def __init__(self, chain, **popenargs):
+        self._chain = chain
+        self._popenargs = popenargs
+        if chain.env:
+            self._popenargs["env"] = dict(popenargs.get("env") or {}, **chain.env)
+        self._cmds = list(chain.cmds)
+        self._output = []
+        self.index = -1
+        self.returncode = None
+        self._proc = None
+        self._next()
+
+    def _next(self):
+        self.index += 1
+        try:
+            self._proc = subprocess.Popen(
+                self._cmds.pop(0), close_fds=True, **self._popenargs
+            )
+        except Exception:
+            self._cmds = []
+            self._finish(None)
+            raise
+
+    def _advance(self):
+        """Collect the output of the terminated command, and start
+        the next one if appropriate."""
+        sod = self._proc.communicate()[0]
+        if sod is not None:
+            self._output.append(sod)
+        ret = self._proc.returncode
+        if (
+            not self._cmds
+            or (self._chain.op == "||" and ret == 0)
+            or (self._chain.op == "&&" and ret != 0)
+        ):
+            self._finish(ret)
+        else:
+            self._next()
+
+    def _finish(self, ret):
+        self.returncode = ret
+        for f in self._chain.tempfiles:
+            try:
+                os.unlink(f)
+            except OSError:
+                pass
 
-    _running = False
+    def poll(self):
+        while self.returncode is None:
+            if self._proc.poll() is None:
+                return None
+            self._advance()
+        return self.returncode
+
+    def communicate(self):
+        while self.returncode is None:
+            self._advance()
+        if self._popenargs.get("stdout") == subprocess.PIPE:
+            return (b"".join(self._output), None)
+        return (None, None)
+
+    def wait(self, timeout=None):
+        if self.returncode is None and timeout is not None:
+            self._proc.wait(timeout)
+        self.communicate()
+        return self.returncode
+
+    def terminate(self):
+        self._cmds = []
+        self._proc.terminate()
+
+    def kill(self):
+        self._cmds = []
+        self._proc.kill()
+
+
+def spawn_command(cmd, **popenargs):
+    """Spawn the command `cmd' in background. It can be either a shell
+    command string, an argv list or a CommandChain. Returns
+    a subprocess.Popen-like object."""
+
+    if isinstance(cmd, str):
+        return subprocess.Popen(cmd, shell=True, **popenargs)
+    elif isinstance(cmd, CommandChain):
+        return ChainProcess(cmd, **popenargs)
+    else:
+        return subprocess.Popen(list(cmd), close_fds=True, **popenargs)
+
+
+class ProcessReaper(object):
+    """Stop the processes (started by spawn_command()) without waiting
+    for them. The processes are terminated immediately, and killed if
+    they are still running `grace' seconds later. poll() needs to be
+    called periodically to reap them.
+
+    >>> r = ProcessReaper(grace=0.2)
+    >>> p = subprocess.Popen(['sh', '-c', 'trap "" TERM; sleep 5'])
+    >>> q = subprocess.Popen(['sleep', '5'])
+    >>> time.sleep(0.1)
+    >>> r.stop(p); r.stop(q)
+    >>> r.poll()
+    True
+    >>> r.finish()
+    >>> p.returncode, q.returncode
+    (-9, -15)
+    """
+
+    def __init__(self, grace=5):
+        self.grace = grace
+        self._procs = []
+
+    def stop(self, proc):
+        """Terminate the process `proc'."""
+        try:
+            proc.terminate()
+        except OSError:
+            return
+        self._procs.append((proc, time.time() + self.grace))
+
+    def poll(self):
+        """Reap the processes which have terminated, and kill the ones
+        whose grace period has passed. Returns True if any of them
+        are still running."""
+        now = time.time()
+        left = []
+        for proc, killtime in self._procs:
+            if proc.poll() is not None:
+                continue
+            if now >= killtime:
+                try:
+                    proc.kill()
+                except OSError:
+                    pass
+            left.append((proc, killtime))
+        self._procs = left
+        return bool(left)
+
+    def finish(self):
+        """Wait for all the processes to stop. They share a single
+        grace period, after which the remaining ones are killed."""
+        while self.poll():
+            time.sleep(0.05)
+
+
+reaper = ProcessReaper()
+
+
+def format_command(cmd):
+    """Format the command `cmd' (as accepted by spawn_command())
+    for display."""
+
+    if isinstance(cmd, (str, CommandChain)):
+        return str(cmd)
+    return shlex.join(cmd)
+
+
+class BaseVCSSupport(object, metaclass=ABCMeta):
+    """Common VCS support class details.
+
+    The instances are kept for every live package in the system, so
+    they use __slots__. Subclasses should declare __slots__ as well,
+    listing any additional attributes they set.
+    """
+
+    __slots__ = (
+        "_cpv",
+        "_opts",
+        "_cache",
+        "_running",
+        "_headerstr",
+        "_mirrors",
+        "_nmirrors",
+        "_direct",
+        "env",
+        "mirrored",
+        "root",
+        "starttime",
+        "subprocess",
+        "timeout",
+        "updatetime",
+    )
+
+    # the timeout used by --adaptive-timeout when there is no history
+    default_timeout = 300
+    # the RemoteVCSSupport subclass used instead with --remote-checks
+    # (for checkout-based VCS-es supporting remote checks)
+    remote_support = None
 
     @abstractproperty
     def reqenv(self):
@@ -52,6 +303,7 @@ class BaseVCSSupport(ABCObject):
         command. By default, preserves proxy settings.
         """
         preserve_vars = (
+            "PATH",
             # curl proxy vars
             "http_proxy",
             "https_proxy",
@@ -77,11 +329,21 @@ class BaseVCSSupport(ABCObject):
         """A package ID for update requestor."""
         return self._cpv
 
-    def __init__(self, cpv, environ, opts, cache=None):
+    @property
+    def _header(self):
+        """The package header used in output. It is formatted only when
+        actually output."""
+        if self._headerstr is None:
+            self._headerstr = "[%s] %s" % (self.cpv, str(self))
+        return self._headerstr
+
+    def __init__(self, cpv, environ, opts, cache=None, mirrors=None):
         """Initialize the VCS class for package `cpv', storing it as
         self.cpv. Get envvars from `environ' (self.reqenv + self.optenv).
 
-        `opts' should point to an ConfigValues instance.
+        `opts' should point to an ConfigValues instance. `mirrors'
+        can point to a MirrorLog, used to decide whether the answers
+        from the repository mirrors are recent enough.
 
         When subclassing, the __init__() function is a good place
         to perform misc checks, like checking whether the package
@@ -96,26 +358,28 @@ class BaseVCSSupport(ABCObject):
                         raise NonLiveEbuild('SOME_REVISION specifies revision, package is not really a live one')
         """
 
+        self._running = False
+        self.subprocess = None
+        self.starttime = None
+        # the time spent running the update commands, set when they finish
+        self.updatetime = None
+        self.timeout = opts.timeout
+        # the ROOT the package is installed in, set by the caller
+        self.root = None
         self._cpv = cpv
         self._opts = opts
         self._cache = cache
+        self._mirrors = mirrors
+        self._nmirrors = 0
+        self._direct = False
+        self.mirrored = False
         self.env = environ.copy(*(self.reqenv + self.optenv))
 
         missingvars = [v for v in self.reqenv if not self.env[v]]
         if len(missingvars) > 0:
             raise KeyError("Environment does not declare: %s" % missingvars)
 
-        class LazyHeader(object):
-            def __init__(self, vcs):
-                self._s = None
-                self._vcs = vcs
-
-            def __str__(self):
-                if self._s is None:
-                    self._s = "[%s] %s" % (self._vcs.cpv, str(self._vcs))
-                return self._s
-
-        self._header = LazyHeader(self)
+        self._headerstr = None
 
     @abstractmethod
     def __str__(self):
@@ -123,8 +387,9 @@ class BaseVCSSupport(ABCObject):
 
     @abstractproperty
     def updatecmd(self):
-        """The update command for a particular VCS as a shell
-        command string.
+        """The update command for a particular VCS. It can be either
+        an argv list, a CommandChain or a shell command string. The first
+        two are executed directly, without spawning a shell.
         """
         pass
 
@@ -165,7 +430,7 @@ class BaseVCSSupport(ABCObject):
                 return None
             elif isinstance(rev, Exception):
                 raise rev
-            elif isinstance(rev, BaseVCSSupport):
+            elif isinstance(rev, (BaseVCSSupport, Pending)):
                 # wait for it to complete, and cache its result
                 return None
             else:
@@ -176,7 +441,7 @@ class BaseVCSSupport(ABCObject):
     def _startupdate(self, popenargs={}):
         """Start the update process. Grabs the current revision
         via .savedrev, grabs the update command (.updatecmd)
-        and executes it in the background using subprocess.Popen().
+        and executes it in the background using spawn_command().
 
         The spawned command is supposed to return the new revision
         on STDOUT, and any diagnostic messages on STDERR.
@@ -190,15 +455,12 @@ class BaseVCSSupport(ABCObject):
             self._cache[str(self)] = self
 
         cmd = self.updatecmd
-        if self._opts.jobs > 1:
-            out.pkgs(str(self), "%s%s%s" % (out.violet, cmd, out.reset))
-        else:
-            out.pkgs(self._header, "%s%s%s" % (out.violet, cmd, out.reset))
+        out.event("start", self, command=format_command(cmd))
 
-        popenargs["env"] = self.callenv
-        popenargs["shell"] = True
-        self.subprocess = subprocess.Popen(cmd, **popenargs)
+        self.subprocess = spawn_command(cmd, env=self.callenv, **popenargs)
         self.starttime = time.time()
+        tracer.begin(self, "check", package=self.cpv, repo=str(self))
+        tracer.begin(self, "update", command=format_command(cmd))
 
         return self.subprocess
 
@@ -217,54 +479,161 @@ class BaseVCSSupport(ABCObject):
         it returns False.
         """
 
-        if not blocking or self._opts.timeout:
+        if not self._poll(self.subprocess, blocking):
+            return None
+        tracer.end(self)
+        self._running = False
+        proc = self.subprocess
+        newrev = self.parseoutput(self._reapupdate())
+        direct = self._direct
+        if (
+            self.mirrored
+            and isinstance(proc, ChainProcess)
+            and proc.index >= self._nmirrors
+        ):
+            # the mirrors failed, the answer comes from the original URIs
+            self.mirrored = False
+            direct = True
+        if newrev is not None and self.mirrored and self._mirror_stale(newrev):
+            # check the original repository instead
+            out.event("mirror", self, rev=newrev)
+            tracer.end(self)
+            self._direct = True
+            self.mirrored = False
+            self._startupdate()
+            self._running = True
+            if blocking:
+                return self._endupdate(True)
+            return None
+        if newrev is not None and direct and self._mirrors is not None:
+            self._mirrors.confirmed(str(self), newrev)
+        return self._setrev(newrev)
+
+    def mirror_uris(self, uris):
+        """Get the list of URIs to check the repository at: the mirror
+        URIs (using the 'mirrors' option rules) followed by the original
+        `uris'. Sets self.mirrored if any mirror was found."""
+
+        if self._direct or not self._opts.mirrors:
+            return list(uris)
+        ret = []
+        for u in uris:
+            m = rewrite_uri(self._opts.mirrors, u)
+            if m is not None and m not in ret:
+                ret.append(m)
+        self._nmirrors = len(ret)
+        self.mirrored = bool(ret)
+        return ret + [u for u in uris if u not in ret]
+
+    def _mirror_stale(self, newrev):
+        """Check whether the mirror answer `newrev' may be outdated:
+        the mirror reports no changes, and the upstream repository was
+        not found at the same (or an older) revision recently."""
+
+        if self._mirrors is None or not self._opts.mirror_max_age:
+            return False
+        if not self.revcmp(self.savedrev, newrev):
+            # changed anyway
+            return False
+        rev = self._mirrors.confirmed_rev(str(self), self._opts.mirror_max_age)
+        return rev is None or not self.revcmp(newrev, rev)
+
+    def _poll(self, proc, blocking, starttime=None):
+        """Check whether the process `proc' (started as a part
+        of the update) has terminated, or wait for it if `blocking'
+        is True. Raises an exception if the update timed out. `starttime'
+        is the time the process was started at, if it is not the update
+        start time."""
+
+        if starttime is None:
+            starttime = self.starttime
+        if not blocking or self.timeout:
             # let's hope we don't get much output
-            ret = self.subprocess.poll()
-            if ret is None:
-                if self._opts.timeout and time.time() - self.starttime > float(
-                    self._opts.timeout
-                ):
+            if proc.poll() is None:
+                if self.timeout and time.time() - starttime > float(self.timeout):
+                    self.release()
                     raise Exception("timeout occured")
-                return None
+                return False
+        return True
+
+    def _reapupdate(self):
+        """Collect the output of the terminated update process."""
 
         (sod, sed) = self.subprocess.communicate()
         ret = self.subprocess.returncode
-        self._running = False
+        self.subprocess = None
 
-        if ret == 0:
-            newrev = self.parseoutput(sod.decode("ASCII") if sod else "")
-            if newrev is None:
-                raise Exception("update command failed to return a rev")
-
-            if self._cache is not None:
-                self._cache[str(self)] = newrev
-            return self._finishupdate(newrev)
-        else:
+        if ret != 0:
             raise Exception("update command returned non-zero result")
+        return sod.decode("ASCII") if sod else ""
+
+    def _setrev(self, newrev):
+        """Store the new revision in the cache and compare it
+        to the saved one."""
+
+        if newrev is None:
+            raise Exception("update command failed to return a rev")
+
+        if self.starttime is not None:
+            self.updatetime = time.time() - self.starttime
+        if self._cache is not None:
+            self._cache[str(self)] = newrev
+        return self._finishupdate(newrev)
 
     def _finishupdate(self, newrev):
-        oldrev = self.savedrev
-        if self.revcmp(oldrev, newrev):
-            out.pkgs(
-                self._header,
-                "at rev %s%s%s (no changes)" % (out.green, oldrev, out.reset),
-            )
-            return False
-        else:
-            out.pkgs(
-                self._header,
-                "update from %s%s%s to %s%s%s"
-                % (out.green, oldrev, out.reset, out.lime, newrev, out.reset),
-            )
-            return True
+        """Compare the new revision to the saved one and report
+        the result. Returns True if the package needs to be rebuilt."""
+        return self._reportupdate(newrev, not self.revcmp(self.savedrev, newrev))
+
+    def _reportupdate(self, newrev, changed, **data):
+        """Emit the 'finish' event for the check, and return `changed'.
+        The additional keyword arguments are passed with the event."""
+        out.event(
+            "finish",
+            self,
+            oldrev=self.savedrev,
+            newrev=newrev,
+            changed=changed,
+            cached=self.starttime is None,
+            duration=self.duration,
+            **data
+        )
+        return changed
+
+    @property
+    def running(self):
+        """True if the update has been started and is not finished
+        yet."""
+        return self._running
+
+    @property
+    def waiting(self):
+        """True if the check is waiting for another check (e.g. for
+        a lock), not running anything itself."""
+        return False
+
+    @property
+    def duration(self):
+        """The time spent running the update command, in seconds
+        (or 0 if the command was not run)."""
+        if self.starttime is None:
+            return 0
+        return time.time() - self.starttime
+
+    def release(self):
+        """Terminate the running update subprocess if appropriate,
+        and drop the reference to it."""
+        if self._running and self.subprocess is not None:
+            reaper.stop(self.subprocess)
+        self._running = False
+        self.subprocess = None
 
     def __del__(self):
         """Terminate the running update subprocess if appropriate."""
-        if self._running and self.subprocess is not None:
-            try:
-                self.subprocess.terminate()
-            except OSError:
-                pass
+        try:
+            self.release()
+        except AttributeError:  # __init__() failed early
+            pass
 
 
 class RemoteVCSSupport(BaseVCSSupport):
@@ -273,6 +642,12 @@ class RemoteVCSSupport(BaseVCSSupport):
     network and ebuild environment variables only, without the need
     for a checkout."""
 
+    __slots__ = ()
+
+    default_timeout = 60
+    # whether the check can be performed on another host (a worker)
+    portable = True
+
     def parseoutput(self, out):
         """Parse output from updatecmd and return a revision.
         By default, simply passes the output on."""
@@ -283,33 +658,97 @@ class RemoteVCSSupport(BaseVCSSupport):
 
 
 class CheckoutVCSSupport(BaseVCSSupport):
-    """A base class for VCS implementations requiring a checkout."""
+    """A base class for VCS implementations requiring a checkout.
+
+    The update command is run in the checkout directory. Afterwards,
+    the work tree revision is obtained by running .currentrevcmd
+    as a separate background process, and parsing its output using
+    .parsecurrentrev(). Subclasses not providing .currentrevcmd have
+    to override .currentrev, and it is called synchronously instead.
+    """
+
+    __slots__ = ("_revproc",)
+
+    def __init__(self, *args, **kwargs):
+        self._revproc = None
+        BaseVCSSupport.__init__(self, *args, **kwargs)
 
     @abstractproperty
     def workdir(self):
-        """The absolute path to the checkout directory. The program
-        will enter that particular directory before executing
-        the update command or getting the checked out revision.
+        """The absolute path to the checkout directory. The update
+        command and the commands getting the checked out revision
+        are executed in that directory.
         """
         pass
 
-    @abstractproperty
+    @property
+    def currentrevcmd(self):
+        """The command printing the work tree revision (as a list),
+        or None if not supported."""
+        return None
+
+    def parsecurrentrev(self, output):
+        """Parse the output of .currentrevcmd and return the revision.
+        By default, simply passes the output on."""
+        return output
+
+    @property
     def currentrev(self):
         """The current revision work tree revision."""
-        pass
+        return self.parsecurrentrev(self.call(self.currentrevcmd))
 
     def _startupdate(self):
-        """Start the update command in the checkout directory."""
-        os.chdir(self.workdir)
-        BaseVCSSupport._startupdate(self)
+        """Start the update command in the checkout directory, with its
+        output redirected to STDERR."""
+        BaseVCSSupport._startupdate(self, popenargs={"cwd": self.workdir, "stdout": 2})
+
+    def _endupdate(self, blocking=False):
+        """Wait for the update command, then start the command getting
+        the work tree revision and wait for it."""
+
+        if self._revproc is None:
+            if not self._poll(self.subprocess, blocking):
+                return None
+            tracer.end(self)
+            cmd = self.currentrevcmd
+            if cmd is None:
+                self._running = False
+                return self._setrev(self.parseoutput(self._reapupdate()))
+
+            self._reapupdate()
+            tracer.begin(self, "currentrev")
+            self._revproc = subprocess.Popen(
+                cmd, cwd=self.workdir, stdout=subprocess.PIPE, env=self.callenv
+            )
+            if not blocking:
+                return None
+
+        if not self._poll(self._revproc, blocking):
+            return None
+        tracer.end(self)
+        sod = self._revproc.communicate()[0]
+        ret = self._revproc.returncode
+        self._revproc = None
+        self._running = False
+
+        if ret != 0:
+            raise Exception("unable to get the work tree revision")
+        return self._setrev(
+            self.parsecurrentrev(sod.decode(locale.getpreferredencoding(), "replace"))
+        )
 
     def parseoutput(self, output):
         """Fake parsing the output by grabbing revision from the work
         tree.
         """
-        os.chdir(self.workdir)
         return self.currentrev
 
+    def release(self):
+        BaseVCSSupport.release(self)
+        if self._revproc is not None:
+            reaper.stop(self._revproc)
+            self._revproc = None
+
     def call(self, cmd, **kwargs):
         """A helper method for VCS classes. It executes the process
         passed as `cmd' (in the form of a list), grabs it output
@@ -317,14 +756,15 @@ class CheckoutVCSSupport(BaseVCSSupport):
 
         By default, STDERR is not captured (and thus is output to
         screen), and the process is called with environment updated
-        from self.callenv. Additional keyword arguments will be
-        passed to subprocess.Popen().
+        from self.callenv, in the checkout directory. Additional keyword
+        arguments will be passed to subprocess.Popen().
         """
         env = self.callenv.copy()
         if "env" in kwargs:
             env.update(kwargs["env"])
         newkwargs = kwargs.copy()
         newkwargs["env"] = env
+        newkwargs.setdefault("cwd", self.workdir)
 
         p = subprocess.Popen(cmd, stdout=subprocess.PIPE, **newkwargs)
         ret = p.communicate()[0].decode(locale.getpreferredencoding(), "replace")
@@ -2,10 +2,16 @@
 # (c) 2011 Michał Górny <mgorny@gentoo.org>
 # Released under the terms of the 2-clause BSD license.
 
+import shlex
+
 from . import RemoteVCSSupport, NonLiveEbuild
 
 
 class BzrSupport(RemoteVCSSupport):
+    __slots__ = ()
+
+    default_timeout = 120
+
     reqenv = ["EBZR_REPO_URI", "EBZR_REVNO", "EBZR_REVNO_CMD"]
     optenv = ["EBZR_REVISION"]
 
@@ -37,4 +43,4 @@ class BzrSupport(RemoteVCSSupport):
 
     @property
     def updatecmd(self):
-        return "%s %s" % (self.env["EBZR_REVNO_CMD"], self.env["EBZR_REPO_URI"])
+        return shlex.split(self.env["EBZR_REVNO_CMD"]) + [self.env["EBZR_REPO_URI"]]
@@ -2,12 +2,89 @@
 # (c) 2011 Michał Górny <mgorny@gentoo.org>
 # Released under the terms of the 2-clause BSD license.
 
-import hashlib, locale, tempfile
+"""CVS support.
 
-from . import CheckoutVCSSupport
+The remote checks, against a local checkout and a stub cvs command
+(reporting `changes' for the rdiff command):
 
+>>> import os, tempfile
+>>> from smartliverebuild.config import Config
+>>> from smartliverebuild.distributed import SavedEnviron
+>>> class PMConfig(object):
+...     userpriv_enabled = False
+>>> config = Config(PMConfig())
+>>> config.apply_dict({'config_file': ''})
+>>> config.parse_configfiles()
+>>> opts = config.get_options()
+>>> tmp = tempfile.TemporaryDirectory()
+>>> os.makedirs(os.path.join(tmp.name, 'foo', 'CVS'))
+>>> entries = os.path.join(tmp.name, 'foo', 'CVS', 'Entries')
+>>> with open(entries, 'w') as f:
+...     _ = f.write('/foo.c/1.1/Mon Jan  1 00:00:00 2024//\\n')
+>>> os.utime(entries, (1700000000, 1700000000))
+>>> def cvs(changes='', version=None, topdir=tmp.name):
+...     cmd = 'sh -c \\'case "$*" in *rdiff*) printf "%s";; esac\\' cvs' % changes
+...     env = SavedEnviron(ECVS_AUTH='pserver', ECVS_CVS_COMMAND=cmd,
+...         ECVS_MODULE='foo', ECVS_SERVER='cvs.example.com:/cvsroot',
+...         ECVS_TOP_DIR=topdir, ECVS_USER='anonymous',
+...         ECVS_VERSION=version or entries_rev(open(entries).read()))
+...     return CVSRemoteSupport('dev-libs/foo:0', environ=env, opts=opts)
+
+The checkout is read when the check starts, and the files changed since
+its last update are listed:
+
+>>> vcs = cvs()
+>>> vcs(blocking=True)
+False
+>>> vcs.env['SLR_CVS_SINCE']
+'2023-11-14 22:13:20 UTC'
+>>> vcs.updatecmd.cmds[1][7:]
+['rdiff', '-s', '-D', '2023-11-14 22:13:20 UTC', '-r', 'HEAD', 'foo']
+>>> cvs('File foo.c changed from revision 1.1 to 1.2\\\\n')(blocking=True)
+True
+
+The package is considered changed when the checkout was updated after
+the build, and skipped if the checkout is gone:
+
+>>> cvs(version='0' * 40)(blocking=True)
+True
+>>> cvs(topdir=tmp.name + '/gone')(blocking=True) # doctest: +ELLIPSIS
+Traceback (most recent call last):
+...
+smartliverebuild.vcs.CheckoutMissing: No CVS checkout found in .../gone/foo, unable to check remotely
+>>> tmp.cleanup()
+"""
+
+import hashlib, locale, re, shlex, subprocess, tempfile, time
+
+from . import (
+    CheckoutMissing,
+    CheckoutVCSSupport,
+    CommandChain,
+    RemoteVCSSupport,
+    reaper,
+    spawn_command,
+)
+
+
+def entries_rev(output):
+    """Compute the revision of a checkout from the concatenated
+    contents of its CVS/Entries files."""
+    inp = output.split("\n")
+    del inp[-1]  # drop the trailing newline for sorting
+    inp.sort()
+    inp.append("")  # and readd it
+    hasher = hashlib.sha1()
+    hasher.update("\n".join(inp).encode(locale.getpreferredencoding(), "replace"))
+
+    return hasher.hexdigest()
+
+
+class CVSCommon(object):
+    """The code shared by the checkout and remote CVS support."""
+
+    __slots__ = ()
 
-class CVSSupport(CheckoutVCSSupport):
     reqenv = [
         "ECVS_AUTH",
         "ECVS_CVS_COMMAND",
@@ -28,7 +105,7 @@ class CVSSupport(CheckoutVCSSupport):
     ]
 
     def __init__(self, *args, **kwargs):
-        CheckoutVCSSupport.__init__(self, *args, **kwargs)
+        super().__init__(*args, **kwargs)
         if self.env["ECVS_RUNAS"]:
             raise NotImplementedError("ECVS_RUNAS is not implemented (yet).")
         elif self.env["ECVS_AUTH"] != "pserver":
@@ -54,30 +131,9 @@ class CVSSupport(CheckoutVCSSupport):
     def savedrev(self):
         return self.env["ECVS_VERSION"]
 
-    @property
-    def currentrev(self):
-        inp = self.call(
-            ["find", self.workdir] + "-ipath */CVS/Entries -exec cat {} +".split()
-        ).split("\n")
-        del inp[-1]  # drop the trailing newline for sorting
-        inp.sort()
-        inp.append("")  # and readd it
-        hasher = hashlib.sha1()
-        hasher.update("\n".join(inp).encode(locale.getpreferredencoding(), "replace"))
-
-        return hasher.hexdigest()
-
-    @property
-    def updatecmd(self):
-        opts = []
-        if self.env["ECVS_LOCAL"]:
-            opts.append("-l")
-        if self.env["ECVS_BRANCH"]:
-            opts.append("-r%s" % self.env["ECVS_BRANCH"])
-        if self.env["ECVS_CLEAN"]:
-            opts.append("-C")
-
-        # XXX: server switching?
+    def cvscmd(self, cmd):
+        """Get the command logging in to the server and running `cmd'
+        (the cvs command with its arguments, as a list)."""
 
         login_root = ":%s:%s:%s@%s" % (
             self.env["ECVS_AUTH"],
@@ -85,25 +141,148 @@ class CVSSupport(CheckoutVCSSupport):
             self.env["ECVS_PASS"],
             self.env["ECVS_SERVER"],
         )
-        login_cmd = '%s -f -d "%s" login' % (self.env["ECVS_CVS_COMMAND"], login_root)
-        up_root = ":%s:%s@%s" % (
+        cvs_cmd = shlex.split(self.env["ECVS_CVS_COMMAND"])
+        login_cmd = cvs_cmd + ["-f", "-d", login_root, "login"]
+        root = ":%s:%s@%s" % (
             self.env["ECVS_AUTH"],
             self.env["ECVS_USER"],
             self.env["ECVS_SERVER"],
         )
-        up_cmd = '%s -f -d "%s" update %s %s' % (
-            self.env["ECVS_CVS_COMMAND"],
-            up_root,
-            self.env["ECVS_UP_OPTS"],
-            " ".join(opts),
+
+        cvs_passfile = tempfile.NamedTemporaryFile(delete=False)
+        cvs_passfile.close()
+
+        return CommandChain(
+            ";",
+            [login_cmd, cvs_cmd + ["-f", "-d", root] + cmd],
+            env={"CVS_PASSFILE": cvs_passfile.name, "HOME": ""},
+            tempfiles=[cvs_passfile.name],
         )
 
-        stdout_cmd = "exec >&2"
 
-        cvs_passfile = tempfile.NamedTemporaryFile(delete=False)
-        env_cmd = 'export CVS_PASSFILE="%s" HOME=' % cvs_passfile.name
-        trap_cmd = "trap 'rm -f \"%s\"' EXIT" % cvs_passfile.name
+class CVSRemoteSupport(CVSCommon, RemoteVCSSupport):
+    """Check CVS repositories without updating the checkout.
+
+    The time of the last checkout update (the newest CVS/Entries file)
+    is taken as the time the package was built, and 'cvs rdiff' lists
+    the files changed on the server since then. If the checkout does
+    not match ECVS_VERSION anymore, it was updated after the build
+    and the package is considered changed.
+
+    The checkout is read in background when the check starts, and
+    the data obtained from it is stored in the environment
+    (SLR_CVS_SINCE, SLR_CVS_CHECKOUTREV).
+    """
+
+    __slots__ = ("_entriesproc",)
+
+    optenv = CVSCommon.optenv + ["SLR_CVS_CHECKOUTREV", "SLR_CVS_SINCE"]
+
+    def __init__(self, *args, **kwargs):
+        CVSCommon.__init__(self, *args, **kwargs)
+        self._entriesproc = None
 
-        cmd = "; ".join([trap_cmd, env_cmd, stdout_cmd, login_cmd, up_cmd])
+    @property
+    def entriescmd(self):
+        """The command listing the modification times of the CVS/Entries
+        files in the checkout, followed by their contents."""
+        find = ["find", self.workdir, "-ipath", "*/CVS/Entries"]
+        return CommandChain(
+            ";", [find + ["-printf", "%T@\\n"], find + ["-exec", "cat", "{}", "+"]]
+        )
+
+    def setentries(self, output):
+        """Store the checkout data from the `entriescmd' output."""
+
+        lines = output.splitlines(True)
+        mtimes = []
+        while lines and re.match(r"^\d+(?:\.\d+)?$", lines[0].strip()):
+            mtimes.append(float(lines.pop(0)))
+        if not mtimes:
+            # there is no other way to tell when the package was built
+            raise CheckoutMissing(
+                "No CVS checkout found in %s, unable to check remotely" % self.workdir
+            )
+        self.env["SLR_CVS_CHECKOUTREV"] = entries_rev("".join(lines))
+        self.env["SLR_CVS_SINCE"] = time.strftime(
+            "%Y-%m-%d %H:%M:%S UTC", time.gmtime(max(mtimes))
+        )
+
+    def __call__(self, blocking=False):
+        if not self.env["SLR_CVS_SINCE"]:
+            if self._entriesproc is None:
+                self._entriesproc = spawn_command(
+                    self.entriescmd,
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.DEVNULL,
+                )
+            if not blocking and self._entriesproc.poll() is None:
+                return None
+            sod = self._entriesproc.communicate()[0]
+            self._entriesproc = None
+            self.setentries(sod.decode(locale.getpreferredencoding(), "replace"))
+        return RemoteVCSSupport.__call__(self, blocking)
+
+    @property
+    def portable(self):
+        # the checkout is needed, unless it was read already
+        return bool(self.env["SLR_CVS_SINCE"])
+
+    @property
+    def running(self):
+        return self._running or self._entriesproc is not None
+
+    def release(self):
+        RemoteVCSSupport.release(self)
+        if self._entriesproc is not None:
+            reaper.stop(self._entriesproc)
+            self._entriesproc = None
+
+    @property
+    def updatecmd(self):
+        return self.cvscmd(
+            [
+                "rdiff",
+                "-s",
+                "-D",
+                self.env["SLR_CVS_SINCE"],
+                "-r",
+                self.env["ECVS_BRANCH"] or "HEAD",
+                self.env["ECVS_MODULE"],
+            ]
+        )
+
+    def parseoutput(self, out):
+        changes = [l for l in out.splitlines() if l.startswith("File ")]
+        if self.env["SLR_CVS_CHECKOUTREV"] != self.savedrev:
+            return self.env["SLR_CVS_CHECKOUTREV"]
+        elif changes:
+            return entries_rev("\n".join([self.savedrev] + changes) + "\n")
+        return self.savedrev
+
+
+class CVSSupport(CVSCommon, CheckoutVCSSupport):
+    __slots__ = ()
+
+    remote_support = CVSRemoteSupport
+
+    @property
+    def currentrevcmd(self):
+        return ["find", self.workdir] + "-ipath */CVS/Entries -exec cat {} +".split()
+
+    def parsecurrentrev(self, output):
+        return entries_rev(output)
+
+    @property
+    def updatecmd(self):
+        opts = []
+        if self.env["ECVS_LOCAL"]:
+            opts.append("-l")
+        if self.env["ECVS_BRANCH"]:
+            opts.append("-r%s" % self.env["ECVS_BRANCH"])
+        if self.env["ECVS_CLEAN"]:
+            opts.append("-C")
+
+        # XXX: server switching?
 
-        return cmd
+        return self.cvscmd(["update"] + shlex.split(self.env["ECVS_UP_OPTS"]) + opts)
@@ -2,12 +2,48 @@
 # (c) 2011 Michał Górny <mgorny@gentoo.org>
 # Released under the terms of the 2-clause BSD license.
 
-import re
+"""Darcs support.
 
-from . import CheckoutVCSSupport
+The remote checks, against a stub darcs command reporting 42 patches:
 
+>>> from smartliverebuild.config import Config
+>>> from smartliverebuild.distributed import SavedEnviron
+>>> class PMConfig(object):
+...     userpriv_enabled = False
+>>> config = Config(PMConfig())
+>>> config.apply_dict({'config_file': ''})
+>>> config.parse_configfiles()
+>>> opts = config.get_options()
+>>> def darcs(patchcount, cmd='sh -c "echo 42" darcs'):
+...     env = SavedEnviron(EDARCS_REPOSITORY='https://darcs.example.com/foo',
+...         EDARCS_GET_CMD='get --lazy', EDARCS_UPDATE_CMD='pull',
+...         EDARCS_LOCALREPO='foo', EDARCS_TOP_DIR='/var/darcs',
+...         EDARCS_OPTIONS='--set-scripts-executable', EDARCS_DARCS_CMD=cmd,
+...         EDARCS_PATCHCOUNT=patchcount)
+...     return DarcsRemoteSupport('dev-libs/foo:0', environ=env, opts=opts)
+
+>>> darcs('42').updatecmd[4:]
+['log', '--count', '--repo', 'https://darcs.example.com/foo']
+>>> darcs('42')(blocking=True)
+False
+>>> darcs('41')(blocking=True)
+True
+>>> darcs('42', cmd='false')(blocking=True)
+Traceback (most recent call last):
+...
+Exception: update command returned non-zero result
+"""
+
+import re, shlex
+
+from . import CheckoutVCSSupport, RemoteVCSSupport
+
+
+class DarcsCommon(object):
+    """The code shared by the checkout and remote Darcs support."""
+
+    __slots__ = ()
 
-class DarcsSupport(CheckoutVCSSupport):
     reqenv = [
         "EDARCS_REPOSITORY",
         "EDARCS_GET_CMD",
@@ -26,21 +62,50 @@ class DarcsSupport(CheckoutVCSSupport):
     def __str__(self):
         return self.env["EDARCS_REPOSITORY"]
 
-    @property
-    def currentrev(self):
-        result = self.call(["darcs", "show", "repo"])
-        return int(re.search(r"Num Patches: ([0-9]+)", result).group(1))
-
     @property
     def savedrev(self):
         pc = self.env["EDARCS_PATCHCOUNT"]
         return int(pc) if pc else None
 
+
+class DarcsRemoteSupport(DarcsCommon, RemoteVCSSupport):
+    """Check Darcs repositories by counting the patches
+    in the remote repository, without updating the checkout."""
+
+    __slots__ = ()
+
     @property
     def updatecmd(self):
-        return "%s %s --all %s %s >&2" % (
-            self.env["EDARCS_DARCS_CMD"],
-            self.env["EDARCS_UPDATE_CMD"],
-            self.env["EDARCS_OPTIONS"],
+        return shlex.split(self.env["EDARCS_DARCS_CMD"]) + [
+            "log",
+            "--count",
+            "--repo",
             self.env["EDARCS_REPOSITORY"],
+        ]
+
+    def parseoutput(self, out):
+        m = re.search(r"^([0-9]+)\s*$", out, re.M)
+        return int(m.group(1)) if m is not None else None
+
+
+class DarcsSupport(DarcsCommon, CheckoutVCSSupport):
+    __slots__ = ()
+
+    remote_support = DarcsRemoteSupport
+
+    @property
+    def currentrevcmd(self):
+        return ["darcs", "show", "repo"]
+
+    def parsecurrentrev(self, output):
+        return int(re.search(r"Num Patches: ([0-9]+)", output).group(1))
+
+    @property
+    def updatecmd(self):
+        return (
+            shlex.split(self.env["EDARCS_DARCS_CMD"])
+            + shlex.split(self.env["EDARCS_UPDATE_CMD"])
+            + ["--all"]
+            + shlex.split(self.env["EDARCS_OPTIONS"])
+            + [self.env["EDARCS_REPOSITORY"]]
         )
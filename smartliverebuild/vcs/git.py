@@ -6,6 +6,8 @@ from .git_2 import Git2Support
 
 
 class GitSupport(Git2Support):
+    __slots__ = ()
+
     def __init__(self, *args, **kwargs):
         Git2Support.__init__(self, *args, **kwargs)
         if len(self.repo_uris) != 1:
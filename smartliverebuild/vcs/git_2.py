@@ -6,6 +6,8 @@ from .git_r3 import GitR3Support
 
 
 class Git2Support(GitR3Support):
+    __slots__ = ()
+
     def __init__(self, *args, **kwargs):
         kwargs["want_r2"] = True
         GitR3Support.__init__(self, *args, **kwargs)
@@ -2,12 +2,77 @@
 # (c) 2011-2014 Michał Górny <mgorny@gentoo.org>
 # Released under the terms of the 2-clause BSD license.
 
-from . import RemoteVCSSupport, NonLiveEbuild, OtherEclass
+"""Support for git-r3.eclass.
+
+With the path filter, the changes in the repository trigger a rebuild
+only if they touch the paths the package is interested in:
+
+>>> import tempfile
+>>> from smartliverebuild.config import Config
+>>> from smartliverebuild.distributed import SavedEnviron
+>>> from smartliverebuild.vcs import CheckCache
+>>> tmp = tempfile.TemporaryDirectory()
+>>> repo = os.path.join(tmp.name, 'foo')
+>>> git = ['git', '-C', repo, '-c', 'user.name=t', '-c', 'user.email=t@t']
+>>> def commit(path):
+...     os.makedirs(os.path.dirname(os.path.join(repo, path)), exist_ok=True)
+...     with open(os.path.join(repo, path), 'a') as f:
+...         _ = f.write('x')
+...     subprocess.check_call(git + ['add', path])
+...     subprocess.check_call(git + ['commit', '--quiet', '-m', path])
+...     return subprocess.check_output(git + ['rev-parse', 'HEAD'], text=True).strip()
+>>> subprocess.check_call(['git', 'init', '--quiet', repo])
+0
+>>> installed = commit('src/foo.c')
+
+>>> class PMConfig(object):
+...     userpriv_enabled = False
+>>> config = Config(PMConfig())
+>>> config.apply_dict({'config_file': '', 'state_dir': tmp.name,
+...     'path_filter': 'dev-libs/foo: src/ include/*.h'})
+>>> config.parse_configfiles()
+>>> opts = config.get_options()
+>>> def check():
+...     env = SavedEnviron(EGIT_REPO_URI=repo, EGIT_VERSION=installed)
+...     return GitR3Support('dev-libs/foo:0', environ=env, opts=opts,
+...         cache=CheckCache())(blocking=True)
+
+>>> _ = commit('doc/README')
+>>> check()
+False
+>>> _ = commit('include/foo.h')
+>>> check()
+True
+>>> tmp.cleanup()
+"""
+
+import fnmatch, os.path, re, subprocess, time
+
+from . import (
+    CommandChain,
+    RemoteVCSSupport,
+    NonLiveEbuild,
+    OtherEclass,
+    reaper,
+    spawn_command,
+)
+from ..output import out
+from ..tracing import tracer
 
 
 class GitR3Support(RemoteVCSSupport):
+    __slots__ = ("repo_uris", "_step", "_pathsrev", "_newrev")
+
     reqenv = ["EGIT_REPO_URI", "EGIT_VERSION"]
-    optenv = ["EGIT_BRANCH", "EGIT_COMMIT", "EGIT_MASTER"]
+    optenv = [
+        "EGIT_BRANCH",
+        "EGIT_COMMIT",
+        "EGIT_MASTER",
+        "EGIT3_STORE_DIR",
+        "EVCS_STORE_DIRS",
+    ]
+
+    default_timeout = 30
 
     def __init__(self, *args, **kwargs):
         want_r2 = "want_r2" in kwargs
@@ -15,6 +80,9 @@ class GitR3Support(RemoteVCSSupport):
             del kwargs["want_r2"]
 
         RemoteVCSSupport.__init__(self, *args, **kwargs)
+        self._step = None
+        self._pathsrev = None
+        self._newrev = None
         if self.env["EGIT_COMMIT"] and self.env["EGIT_COMMIT"] != (
             self.env.get("EGIT_BRANCH") or "HEAD"
         ):
@@ -37,8 +105,239 @@ class GitR3Support(RemoteVCSSupport):
     @property
     def updatecmd(self):
         cmds = []
-        for r in self.repo_uris:
-            cmds.append(
-                "git ls-remote %s %s" % (r, self.env.get("EGIT_BRANCH") or "HEAD")
-            )
-        return " || ".join(cmds)
+        for r in self.mirror_uris(self.repo_uris):
+            cmds.append(["git", "ls-remote", r, self.env.get("EGIT_BRANCH") or "HEAD"])
+        if len(cmds) == 1:
+            return cmds[0]
+        return CommandChain("||", cmds)
+
+    @property
+    def store_dir(self):
+        """The git-r3 store directory (EGIT3_STORE_DIR)."""
+        if self.env["EGIT3_STORE_DIR"]:
+            return self.env["EGIT3_STORE_DIR"]
+        for d in self.env["EVCS_STORE_DIRS"].split():
+            if os.path.basename(d.rstrip("/")) == "git3-src":
+                return d
+        return self._opts.git_store_dir
+
+    @property
+    def gitdir(self):
+        """The path to the repository clone in git-r3 store, using
+        the same naming rules as git-r3.eclass."""
+        repo_name = re.sub(r"^.*?://[^/]*/", "", self.repo_uris[0]).rstrip("/")
+        for prefix in ("browse/", "cgit/", "git/", "gitroot/", "p/", "pub/scm/"):
+            if repo_name.startswith(prefix):
+                repo_name = repo_name[len(prefix) :]
+                break
+        if repo_name.endswith(".git"):
+            repo_name = repo_name[:-4]
+        repo_name = "%s.git" % repo_name.replace("/", "_")
+        return os.path.join(self.store_dir, repo_name)
+
+    @property
+    def prefetchcmd(self):
+        """The command fetching the new commits into the git-r3 store."""
+        branch = self.env.get("EGIT_BRANCH") or "HEAD"
+        return [
+            "git",
+            "--git-dir=%s" % self.gitdir,
+            "fetch",
+            "--quiet",
+            "--no-tags",
+            self.repo_uris[0],
+            "+%s:refs/slr-prefetch/%s" % (branch, branch),
+        ]
+
+    @property
+    def step_timeout(self):
+        """The timeout for the additional steps. The update timeout
+        is not used since it may be derived from the (much shorter)
+        ls-remote durations."""
+        return self._opts.step_timeout or self._opts.timeout
+
+    @property
+    def prefetched(self):
+        """The repository directories which were prefetched already
+        during the run."""
+        return self._cache.state.setdefault("git-r3-prefetched", set())
+
+    @property
+    def paths_locks(self):
+        """The path filter clones in use during the run (directory ->
+        the check using it)."""
+        return self._cache.state.setdefault("git-r3-paths-locks", {})
+
+    @property
+    def paths(self):
+        """The list of paths the package is interested in (from
+        path_filter option), or None if all paths are relevant."""
+        return self._opts.path_filter.get(self.cpv.split(":")[0])
+
+    @property
+    def pathsdir(self):
+        """The path to the blobless clone used by the path filter,
+        in the state directory."""
+        return os.path.join(
+            self._opts.state_dir, "git-paths", os.path.basename(self.gitdir)
+        )
+
+    def pathscmd(self, newrev):
+        """The command listing the files changed between the installed
+        revision and `newrev'. It maintains a blobless clone
+        in the state directory, so only the commits and trees are
+        fetched."""
+        branch = self.env.get("EGIT_BRANCH") or "HEAD"
+        gitdir = self.pathsdir
+        git = ["git", "--git-dir=%s" % gitdir]
+        return CommandChain(
+            "&&",
+            [
+                ["git", "init", "--quiet", "--bare", gitdir],
+                git + ["config", "remote.origin.url", self.repo_uris[0]],
+                git
+                + [
+                    "fetch",
+                    "--quiet",
+                    "--filter=blob:none",
+                    "--no-tags",
+                    "origin",
+                    "+%s:refs/slr-paths/%s" % (branch, branch),
+                ],
+                # list both the old and the new name of renamed files
+                git + ["diff", "--name-only", "--no-renames", self.savedrev, newrev],
+            ],
+        )
+
+    def __call__(self, blocking=False):
+        """Perform a single main loop iteration. If the repository
+        has changed, perform the additional steps: check whether
+        the changes touch the paths the package is interested in
+        and prefetch the repository into the git-r3 store (if requested).
+        """
+        if self._step is None and self._pathsrev is None:
+            ret = RemoteVCSSupport.__call__(self, blocking)
+            if not ret:
+                return ret
+            newrev = self._newrev
+            if self.paths is None or not isinstance(newrev, str):
+                return self._stepsdone(self._prefetch_or_finish())
+            self._pathsrev = newrev
+
+        if self._step is None:
+            # the clone is shared by all the branches of the repository,
+            # wait for the other checks using it
+            owner = self.paths_locks.setdefault(self.pathsdir, self)
+            if owner is not self:
+                return None
+            try:
+                self._startstep(
+                    "pathfilter",
+                    self.pathscmd(self._pathsrev),
+                    self._endpaths,
+                    stdout=subprocess.PIPE,
+                )
+            except Exception:
+                self._unlockpaths()
+                raise
+
+        proc, callback, starttime = self._step
+        timeout = self.step_timeout
+        running = proc.poll() is None
+        returncode = None
+        sod = b""
+        if running and timeout and time.time() - starttime > timeout:
+            # the steps are optional, carry on as if the step failed
+            reaper.stop(proc)
+        elif running and (not blocking or timeout):
+            return None
+        else:
+            sod = proc.communicate()[0]
+            returncode = proc.returncode
+        self._step = None
+        tracer.end(self)
+        ret = callback(returncode, sod)
+        if ret is None:
+            return self(blocking)
+        return self._stepsdone(ret)
+
+    def _finishupdate(self, newrev):
+        changed = not self.revcmp(self.savedrev, newrev)
+        if not changed:
+            return self._reportupdate(newrev, changed)
+        # the result is reported when the additional steps are done
+        self._newrev = newrev
+        return changed
+
+    def _stepsdone(self, ret):
+        """Report the result of the check if the additional steps
+        are done (`ret' is not None)."""
+        if ret is None:
+            return None
+        if not ret:
+            return self._reportupdate(self._newrev, False, filtered=True)
+        return self._reportupdate(self._newrev, True)
+
+    def _startstep(self, name, cmd, callback, **popenargs):
+        tracer.begin(self, name)
+        self._step = (
+            spawn_command(cmd, env=self.callenv, **popenargs),
+            callback,
+            time.time(),
+        )
+
+    def _unlockpaths(self):
+        if self._pathsrev is not None:
+            if self.paths_locks.get(self.pathsdir) is self:
+                del self.paths_locks[self.pathsdir]
+            self._pathsrev = None
+
+    def _endpaths(self, returncode, output):
+        self._unlockpaths()
+        if returncode != 0:
+            # unable to tell, assume the changes are relevant
+            return self._prefetch_or_finish()
+        changed = output.decode("UTF-8", "replace").split("\n")
+        for f in changed:
+            for p in self.paths:
+                if f and (fnmatch.fnmatch(f, p) or f.startswith(p.rstrip("/") + "/")):
+                    return self._prefetch_or_finish()
+        out.event("pathfilter", self, changed=False, paths=self.paths)
+        return False
+
+    def _prefetch_or_finish(self):
+        if self._opts.prefetch:
+            gitdir = self.gitdir
+            if gitdir not in self.prefetched and os.path.isdir(gitdir):
+                self.prefetched.add(gitdir)
+                self._startstep(
+                    "prefetch",
+                    self.prefetchcmd,
+                    self._endprefetch,
+                    stdout=subprocess.DEVNULL,
+                )
+                return None
+        return True
+
+    def _endprefetch(self, returncode, output):
+        out.event("prefetch", self, gitdir=self.gitdir, success=returncode == 0)
+        return True
+
+    @property
+    def running(self):
+        return self._running or self._step is not None or self._pathsrev is not None
+
+    @property
+    def waiting(self):
+        return (
+            self._step is None
+            and self._pathsrev is not None
+            and self.paths_locks.get(self.pathsdir, self) is not self
+        )
+
+    def release(self):
+        RemoteVCSSupport.release(self)
+        if self._step is not None:
+            reaper.stop(self._step[0])
+            self._step = None
+        self._unlockpaths()
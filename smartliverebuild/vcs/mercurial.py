@@ -2,10 +2,12 @@
 # (c) 2011 Michał Górny <mgorny@gentoo.org>
 # Released under the terms of the 2-clause BSD license.
 
-from . import RemoteVCSSupport, NonLiveEbuild
+from . import CommandChain, RemoteVCSSupport, NonLiveEbuild
 
 
 class MercurialSupport(RemoteVCSSupport):
+    __slots__ = ()
+
     reqenv = ["EHG_REPO_URI", "EHG_REVISION", "HG_REV_ID"]
 
     trustopt = ["--config", "trusted.users=portage"]  # XXX: pm.config.userpriv_uid
@@ -31,8 +33,11 @@ class MercurialSupport(RemoteVCSSupport):
 
     @property
     def updatecmd(self):
-        return "hg identify --id --rev %s %s %s" % (
-            self.env["EHG_REVISION"],
-            self.env["EHG_REPO_URI"],
-            " ".join(self.trustopt),
-        )
+        cmds = [
+            ["hg", "identify", "--id", "--rev", self.env["EHG_REVISION"], u]
+            + self.trustopt
+            for u in self.mirror_uris([self.env["EHG_REPO_URI"]])
+        ]
+        if len(cmds) == 1:
+            return cmds[0]
+        return CommandChain("||", cmds)
@@ -4,10 +4,14 @@
 
 import re
 
-from . import RemoteVCSSupport, NonLiveEbuild
+from . import CommandChain, RemoteVCSSupport, NonLiveEbuild
 
 
 class SubversionSupport(RemoteVCSSupport):
+    __slots__ = ()
+
+    default_timeout = 120
+
     reqenv = ["ESVN_REPO_URI", "ESVN_STORE_DIR", "ESVN_WC_REVISION"]
     optenv = ["ESVN_REVISION", "ESVN_USER", "ESVN_PASSWORD"]
 
@@ -43,17 +47,27 @@ class SubversionSupport(RemoteVCSSupport):
     def revcmp(oldrev, newrev):
         return oldrev >= newrev
 
+    def infocmd(self, uri):
+        """The svn info command for the repository at `uri'."""
+        cmd = [
+            "svn",
+            "--config-dir",
+            "%s/.subversion" % self.env["ESVN_STORE_DIR"],
+            "info",
+            uri,
+        ]
+        if self.env["ESVN_USER"] and self.env["ESVN_PASSWORD"]:
+            cmd += [
+                "--username=%s" % self.env["ESVN_USER"],
+                "--password=%s" % self.env["ESVN_PASSWORD"],
+                "--no-auth-cache",
+            ]
+        return cmd
+
     @property
     def updatecmd(self):
         # XXX: branch?
-        user_pass = ""
-        if self.env["ESVN_USER"] and self.env["ESVN_PASSWORD"]:
-            user_pass = ' --username="%s" --password="%s" --no-auth-cache' % (
-                self.env["ESVN_USER"],
-                self.env["ESVN_PASSWORD"],
-            )
-        return "svn --config-dir %s/.subversion info %s%s" % (
-            self.env["ESVN_STORE_DIR"],
-            self.env["ESVN_REPO_URI"],
-            user_pass,
-        )
+        cmds = [self.infocmd(u) for u in self.mirror_uris([self.env["ESVN_REPO_URI"]])]
+        if len(cmds) == 1:
+            return cmds[0]
+        return CommandChain("||", cmds)
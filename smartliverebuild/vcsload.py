@@ -8,8 +8,9 @@ from .vcs import RemoteVCSSupport
 class VCSLoader(object):
     vcs_cache = {}
 
-    def __init__(self, remote_only=False):
+    def __init__(self, remote_only=False, remote_checks=False):
         self._remote_only = remote_only
+        self._remote_checks = remote_checks or remote_only
 
     def __call__(self, eclassname, allowed=[]):
         if eclassname not in self.vcs_cache:
@@ -27,16 +28,17 @@ class VCSLoader(object):
                         if k.endswith("Support") and k[
                             :-7
                         ].lower() == eclassname.replace("-", ""):
-                            vcscl = getattr(mod, k)
-                            if self._remote_only and not issubclass(
-                                vcscl, RemoteVCSSupport
-                            ):
-                                break
-                            self.vcs_cache[eclassname] = vcscl
+                            self.vcs_cache[eclassname] = getattr(mod, k)
                             break
                     else:
                         raise ImportError(
                             "Unable to find a matching class in %s" % modname
                         )
 
-        return self.vcs_cache[eclassname]
+        vcscl = self.vcs_cache[eclassname]
+        if vcscl is not None and self._remote_checks:
+            if vcscl.remote_support is not None:
+                vcscl = vcscl.remote_support
+            if self._remote_only and not issubclass(vcscl, RemoteVCSSupport):
+                return None
+        return vcscl